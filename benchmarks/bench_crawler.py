@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the crawlers against a local mock SIPO server
+"""
+
+import logging
+import multiprocessing
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from cnsipo import patent_detail, patent_list
+from cnsipo.client import init_client
+from cnsipo.extractor import PARSERS, get_parser
+from cnsipo.mock_sipo import MockSipo, window_ids
+from cnsipo.store import DirStore
+from cnsipo.utils import WorkerPool, Counters, threaded, percentile
+
+CRAWLERS = ['list', 'detail']
+YEAR = "2014"
+
+
+def serve(queue, kwargs):
+    server = MockSipo(**kwargs)
+    queue.put(server.url)
+    server.serve_forever()
+
+
+def start_mock(**kwargs):
+    """Start a mock server in another process(so that its CPU isn't
+    counted), return the process and its URL
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(queue, kwargs))
+    process.daemon = True
+    process.start()
+    return process, queue.get(timeout=10)
+
+
+def timed_client(threads):
+    """Init the crawlers' client which records the latency of each request
+    """
+    client = init_client(pool_maxsize=threads)
+    latencies = []
+    request = client.request
+
+    def timed(*args, **kwargs):
+        start = time.time()
+        try:
+            return request(*args, **kwargs)
+        finally:
+            latencies.append(time.time() - start)
+
+    client.request = timed
+    return latencies
+
+
+def list_tasks(requests, tmp_dir):
+    params, pages = patent_list.init_params.__wrapped__(
+        YEAR, 'fmgb', tmp_dir)
+    for i in range(requests):
+        yield (patent_list.query.__wrapped__, params, YEAR,
+               i % pages + 1, tmp_dir + "/" + str(i / pages))
+
+
+def detail_tasks(requests, tmp_dir, parse):
+    store = DirStore(tmp_dir)
+    for patent_id in window_ids('fmgb', YEAR, YEAR, requests):
+        yield (patent_detail.query.__wrapped__, patent_detail.detail_params,
+               parse, 0, patent_id, store, 30, 0)
+
+
+def run(tasks, threads):
+    """Run the tasks(functions and their arguments) by a pool, return the
+    counters of requests and errors, the latencies and the wall and CPU
+    time
+    """
+    counters = Counters()
+
+    def task(func, *args):
+        counters.incr('tasks')
+        try:
+            func(*args)
+        except Exception:
+            counters.incr('errors')
+
+    latencies = timed_client(threads)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    pool = WorkerPool(threads, capacity=threads * 2)
+    with threaded(pool):
+        pool.add_tasks(task, tasks)
+    wall = time.time() - start
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = end_usage.ru_utime - usage.ru_utime + \
+        end_usage.ru_stime - usage.ru_stime
+    return counters, sorted(latencies), wall, cpu
+
+
+def main(argv=None):
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage)
+    parser.add_option("-n", "--requests", dest="requests", type="int",
+                      default="500", help="number of requests in a run")
+    parser.add_option("-t", "--threads", dest="threads", default="1,4,16,64",
+                      help="comma separated thread counts")
+    parser.add_option("-c", "--crawlers", dest="crawlers",
+                      default=",".join(CRAWLERS),
+                      help="comma separated crawlers: {}".format(
+                          "|".join(CRAWLERS)))
+    parser.add_option("-l", "--latency", dest="latency",
+                      default="uniform:0.005,0.02",
+                      help="latency distribution of the mock server")
+    parser.add_option("-e", "--error-rate", dest="error_rate", type="float",
+                      default="0", help="rate of error pages")
+    parser.add_option("-r", "--reset-rate", dest="reset_rate", type="float",
+                      default="0", help="rate of connection resets")
+    parser.add_option("-p", "--parser", dest="parser", default="regex",
+                      help="page parser: {}".format("|".join(PARSERS)))
+    (options, args) = parser.parse_args(argv)
+
+    logging.disable(logging.WARNING)  # error pages are expected
+    process, url = start_mock(patents=options.requests,
+                              latency=options.latency,
+                              error_rate=options.error_rate,
+                              reset_rate=options.reset_rate)
+    patent_list.URL = url + "/patentoutline.action"
+    patent_detail.BASE_URL = url
+    parse = get_parser(options.parser, 'detail')
+
+    print "{:<8}{:>8}{:>9}{:>8}{:>10}{:>10}{:>10}{:>12}".format(
+        "crawler", "threads", "requests", "errors", "req/s", "p50(ms)",
+        "p99(ms)", "cpu(ms)/req")
+    try:
+        for crawler in options.crawlers.split(","):
+            for threads in [int(t) for t in options.threads.split(",")]:
+                tmp_dir = tempfile.mkdtemp(prefix="bench-")
+                try:
+                    if crawler == 'list':
+                        tasks = list_tasks(options.requests, tmp_dir)
+                    else:
+                        tasks = detail_tasks(options.requests, tmp_dir,
+                                             parse)
+                    counters, latencies, wall, cpu = run(tasks, threads)
+                finally:
+                    shutil.rmtree(tmp_dir)
+                requests = len(latencies)
+                print "{:<8}{:>8}{:>9}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}" \
+                    "{:>12.2f}".format(
+                        crawler, threads, requests, counters.get('errors'),
+                        requests / wall,
+                        percentile(latencies, 50) * 1000,
+                        percentile(latencies, 99) * 1000,
+                        cpu * 1000 / requests)
+    finally:
+        process.terminate()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the page parsers
+"""
+
+import io
+import os
+import sys
+import timeit
+from optparse import OptionParser
+
+from cnsipo.extractor import PARSERS, get_parser
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, "tests", "fixtures")
+
+
+def bench(name, detail_kind, text, number, repeat):
+    parse = get_parser(name, detail_kind)
+    return min(timeit.repeat(lambda: parse(text, 0), number=number,
+                             repeat=repeat)) / number
+
+
+def main(argv=None):
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage)
+    parser.add_option("-n", "--number", dest="number", type="int",
+                      default="200", help="number of parses in a run")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int",
+                      default="3", help="number of runs(the best is taken)")
+    parser.add_option("-p", "--parsers", dest="parsers",
+                      default=",".join(PARSERS),
+                      help="comma separated parsers to benchmark")
+    (options, args) = parser.parse_args(argv)
+
+    print "{:<12}{:<8}{:>12}{:>10}".format(
+        "page", "parser", "usec/page", "speedup")
+    for detail_kind in ['detail', 'transaction']:
+        with io.open(os.path.join(FIXTURES_DIR, detail_kind + ".html"),
+                     encoding='utf-8') as f:
+            text = f.read()
+        base = None
+        for name in options.parsers.split(","):
+            try:
+                cost = bench(name, detail_kind, text, options.number,
+                             options.repeat)
+            except ImportError as e:
+                print "{:<12}{:<8}skipped({})".format(detail_kind, name, e)
+                continue
+            base = base or cost
+            print "{:<12}{:<8}{:>12.1f}{:>9.1f}x".format(
+                detail_kind, name, cost * 1e6, base / cost)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
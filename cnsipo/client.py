@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pooled keep-alive HTTP client shared by all crawlers
+"""
+
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+POOL_CONNECTIONS = 4  # number of per-host connection pools to cache
+POOL_MAXSIZE = 20  # number of connections kept alive in each pool
+# statuses of a proxy refused or blocked by the server
+BLOCKED_STATUSES = (403, 407)
+HEADERS = {
+    'Accept-Encoding': "gzip, deflate",
+    'Connection': "keep-alive",
+}
+
+
+class HttpClient(object):
+    """A HTTP client which reuses connections through pooled sessions.
+
+    If `per_thread` is true, each thread gets its own session(which suits
+    the threaded engine), otherwise all the threads(or greenlets) share one
+    session, whose pool keeps up to `pool_maxsize` connections per host and
+    blocks when they are all in use if `pool_block` is true.
+
+    An optional `controller`(see `cnsipo.utils.ConcurrencyController`)
+    limits the number of in-flight requests and decides their timeouts.
+
+    With a `proxy_pool`(see `cnsipo.proxy.ProxyPool`), each request goes
+    through a proxy taken from it, whose health is updated by the response
+    and `report_error`.
+
+    With a `metrics` registry(see `cnsipo.metrics.Registry`), the latency,
+    the status and the size of each response are recorded.
+    """
+
+    def __init__(self, pool_connections=POOL_CONNECTIONS,
+                 pool_maxsize=POOL_MAXSIZE, per_thread=True,
+                 pool_block=False, controller=None, proxy_pool=None,
+                 metrics=None):
+        self.controller = controller
+        self.proxy_pool = proxy_pool
+        self.metrics = metrics
+        self._pool_connections = pool_connections
+        self._pool_maxsize = pool_maxsize
+        self._pool_block = pool_block
+        self._per_thread = per_thread
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sessions = []
+        self._shared_session = None
+
+    def _new_session(self):
+        session = requests.Session()
+        session.headers.update(HEADERS)
+        adapter = HTTPAdapter(pool_connections=self._pool_connections,
+                              pool_maxsize=self._pool_maxsize,
+                              pool_block=self._pool_block)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self._sessions.append(session)
+        return session
+
+    @property
+    def session(self):
+        if self._per_thread:
+            session = getattr(self._local, 'session', None)
+            if session is None:
+                with self._lock:
+                    session = self._local.session = self._new_session()
+            return session
+
+        with self._lock:
+            if self._shared_session is None:
+                self._shared_session = self._new_session()
+            return self._shared_session
+
+    def request(self, method, url, **kwargs):
+        controller, proxy_pool = self.controller, self.proxy_pool
+        metrics = self.metrics
+        if not (controller or proxy_pool or metrics):
+            return self.session.request(method, url, **kwargs)
+
+        proxy = None
+        if proxy_pool:
+            proxy = self._local.proxy = proxy_pool.acquire()
+            kwargs['proxies'] = proxy.proxies
+        if controller:
+            kwargs['timeout'] = controller.timeout(kwargs.get('timeout'))
+            controller.acquire()
+        start, failed, blocked = time.time(), True, True
+        try:
+            resp = self.session.request(method, url, **kwargs)
+            failed = resp.status_code >= 500 or resp.status_code == 429
+            blocked = failed or resp.status_code in BLOCKED_STATUSES
+            if metrics:
+                metrics.incr('http_response_bytes', len(resp.content))
+            return resp
+        finally:
+            elapsed = time.time() - start
+            if controller:
+                controller.release(elapsed, failed)
+            if metrics:
+                metrics.incr('http_requests')
+                if failed:
+                    metrics.incr('http_errors')
+                metrics.observe('http_request_seconds', elapsed)
+            if proxy:
+                proxy_pool.release(proxy, blocked)
+
+    def report_error(self):
+        """Report an error found in a response(e.g. an error page)
+        """
+        if self.controller:
+            self.controller.record_error()
+        proxy = getattr(self._local, 'proxy', None)
+        if self.proxy_pool and proxy:
+            self.proxy_pool.report_error(proxy)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Return the counters of requests, new connections and reused ones
+        """
+        num_requests, num_connections = 0, 0
+        with self._lock:
+            sessions = list(self._sessions)
+        adapters = {}
+        for session in sessions:
+            for adapter in session.adapters.values():
+                adapters[id(adapter)] = adapter
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool:
+                    num_requests += pool.num_requests
+                    num_connections += pool.num_connections
+        return {'sessions': len(sessions),
+                'requests': num_requests,
+                'connections': num_connections,
+                'reused': max(num_requests - num_connections, 0)}
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+            self._shared_session = None
+        self._local = threading.local()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def init_client(**kwargs):
+    """(Re)create the client shared by the crawlers
+    """
+    global _client
+    if _client:
+        _client.close()
+    _client = HttpClient(**kwargs)
+    return _client
+
+
+def get_client():
+    """Get the client shared by the crawlers(created on demand)
+    """
+    with _client_lock:
+        if _client is None:
+            init_client()
+    return _client
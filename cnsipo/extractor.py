@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""
+Extract patent details and transactions from fetched pages
+"""
+
+import re
+from HTMLParser import HTMLParser
+
+PARSERS = ['bs', 'lxml', 'regex']
+
+TABLE_TAG_PATTERN = re.compile(r"<(/?)table\b[^>]*>", re.I)
+ROW_PATTERN = re.compile(r"<tr\b[^>]*>(.*?)</tr\s*>", re.I | re.S)
+CELL_PATTERN = re.compile(r"<td\b[^>]*>(.*?)</td\s*>", re.I | re.S)
+DIGEST_PATTERN = re.compile(
+    r"<div\b[^>]*\bclass=\"(?:[^\"]*\s)?xm_jsh(?:\s[^\"]*)?\"[^>]*>(.*?)"
+    r"</div\s*>", re.I | re.S)
+TAG_PATTERN = re.compile(r"<[^>]*>")
+IGNORED_PATTERN = re.compile(
+    r"<!--.*?-->|<(script|style)\b.*?</\1\s*>", re.I | re.S)
+# the site's notice(e.g. of too frequent requests) instead of the page
+ERROR_PAGE_PATTERN = re.compile(
+    ur"<title>\s*系统提示\s*</title>|<div\b[^>]*\bclass=\"error\"", re.I)
+DIGEST_XPATH = "//div[contains(concat(' ', normalize-space(@class), ' '), " \
+    "' xm_jsh ')]"
+
+_html_parser = HTMLParser()
+
+
+def is_error_page(text, detail_kind):
+    """Whether the page is an error page(e.g. a notice of too frequent
+    requests) rather than the page of the detail kind
+
+    NOTE: a page of an unexpected layout(e.g. without the digest) isn't an
+    error page, which fails its parsing instead of being retried.
+    """
+    if ERROR_PAGE_PATTERN.search(text):
+        return True
+    return not TABLE_TAG_PATTERN.search(text)
+
+
+# BeautifulSoup
+
+def bs_detail(text, kind):
+    from bs4 import BeautifulSoup
+
+    # TODO: not work for kind 'wgsq'
+    bs = BeautifulSoup(text)
+    details = {}
+    tbl = bs.table.table
+    for row in tbl.findAll('tr'):
+        cells = row.findAll('td')
+        details[cells[0].get_text().encode('utf-8')] = \
+            cells[1].get_text().encode('utf-8')
+    digest = bs.find_all("div", class_="xm_jsh")[0]
+    details['摘要'] = digest.get_text().encode('utf-8')
+    return details
+
+
+def bs_transaction(text, kind):
+    from bs4 import BeautifulSoup
+
+    bs = BeautifulSoup(text)
+    trans = []
+    for tbl in bs.findAll('table'):
+        t = tbl.table
+        if t:
+            key_val = {}
+            rows = t.findAll('tr')
+            cells = rows[1].findAll('td')
+            for i in [0, 2]:
+                key_val[cells[i].get_text().encode('utf-8')] \
+                    = cells[i + 1].get_text().encode('utf-8')
+            trans.append(key_val)
+    return trans
+
+
+# lxml
+
+def _lxml_root(text):
+    from lxml import html
+
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return html.fromstring(
+        text, parser=html.HTMLParser(encoding='utf-8', remove_comments=True))
+
+
+def _lxml_text(elem):
+    text = elem.text_content()
+    return text.encode('utf-8') if isinstance(text, unicode) else str(text)
+
+
+def _lxml_inner_table(tbl):
+    return next(tbl.iterdescendants('table'), None)
+
+
+def lxml_detail(text, kind):
+    root = _lxml_root(text)
+    details = {}
+    tbl = _lxml_inner_table(next(root.iter('table')))
+    for row in tbl.iter('tr'):
+        cells = list(row.iter('td'))
+        details[_lxml_text(cells[0])] = _lxml_text(cells[1])
+    digest = root.xpath(DIGEST_XPATH)[0]
+    details['摘要'] = _lxml_text(digest)
+    return details
+
+
+def lxml_transaction(text, kind):
+    root = _lxml_root(text)
+    trans = []
+    for tbl in root.iter('table'):
+        t = _lxml_inner_table(tbl)
+        if t is not None:
+            key_val = {}
+            rows = list(t.iter('tr'))
+            cells = list(rows[1].iter('td'))
+            for i in [0, 2]:
+                key_val[_lxml_text(cells[i])] = _lxml_text(cells[i + 1])
+            trans.append(key_val)
+    return trans
+
+
+# regex(assumes well-formed tables, rows and cells)
+
+def _regex_text(html):
+    text = _html_parser.unescape(TAG_PATTERN.sub("", html))
+    return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+def _regex_inner_tables(text):
+    """Return a list of (outer table's start, inner table's html) for each
+    table containing tables in the order of the outer tables
+    """
+    stack, inner_tables = [], {}
+    for m in TABLE_TAG_PATTERN.finditer(text):
+        if not m.group(1):
+            for start in stack:
+                inner_tables.setdefault(start, [m.start(), None])
+            stack.append(m.start())
+        elif stack:
+            start = stack.pop()
+            for span in inner_tables.values():
+                if span[0] == start and span[1] is None:
+                    span[1] = m.end()
+    return [(outer, text[span[0]:span[1]])
+            for outer, span in sorted(inner_tables.items())]
+
+
+def _regex_cells(row):
+    return [_regex_text(cell) for cell in CELL_PATTERN.findall(row)]
+
+
+def regex_detail(text, kind):
+    text = IGNORED_PATTERN.sub("", text)
+    details = {}
+    inner_tables = _regex_inner_tables(text)
+    if not inner_tables or \
+            inner_tables[0][0] != TABLE_TAG_PATTERN.search(text).start():
+        raise IndexError("no table in the first table")
+    tbl = inner_tables[0][1]
+    for row in ROW_PATTERN.findall(tbl):
+        cells = _regex_cells(row)
+        details[cells[0]] = cells[1]
+    digest = DIGEST_PATTERN.search(text)
+    if not digest:  # as the other parsers
+        raise IndexError("no digest")
+    details['摘要'] = _regex_text(digest.group(1))
+    return details
+
+
+def regex_transaction(text, kind):
+    text = IGNORED_PATTERN.sub("", text)
+    trans = []
+    for _, tbl in _regex_inner_tables(text):
+        key_val = {}
+        cells = _regex_cells(ROW_PATTERN.findall(tbl)[1])
+        for i in [0, 2]:
+            key_val[cells[i]] = cells[i + 1]
+        trans.append(key_val)
+    return trans
+
+
+def get_parser(name, detail_kind):
+    """Get the function parsing a page's text of the detail kind with
+    the named parser(one of `PARSERS`)
+    """
+    if name not in PARSERS:
+        raise ValueError("unknown parser: {}".format(name))
+    return globals()["{}_{}".format(name, detail_kind)]
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""
+Queued logging written by a single thread, and filters for the hot paths
+"""
+
+import atexit
+import logging
+from Queue import Queue, Full
+from threading import Thread, Lock
+
+from cnsipo.utils import TokenBucket
+
+QUEUE_SIZE = 10000  # max number of the records waiting to be written
+MAX_KEYS = 1000  # max number of the messages tracked by a filter
+_STOP = object()
+
+
+class QueueHandler(logging.Handler):
+    """A handler which puts the records onto a queue without blocking, the
+    records below `block_level` are dropped(and counted) when it's full,
+    while those at or above it wait for room, so no warning or error is lost
+
+    The messages are formatted by the writer thread(see `QueueListener`),
+    so their arguments shouldn't be changed after logging.
+    """
+
+    def __init__(self, queue, block_level=logging.WARNING):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.block_level = block_level
+        self.dropped = 0
+
+    def handle(self, record):
+        # no need to lock the handler, the queue is thread-safe
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        if record.exc_info:  # the traceback is formatted here
+            record.exc_text = logging._defaultFormatter.formatException(
+                record.exc_info)
+            record.exc_info = None
+        if record.levelno >= self.block_level:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class QueueListener(object):
+    """A thread which writes the records from the queue by the handlers
+    """
+
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                break
+            self.handle(record)
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def stop(self):
+        """Write the queued records and stop the thread
+        """
+        if self._thread:
+            self.queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+            for handler in self.handlers:
+                try:
+                    handler.flush()
+                except (IOError, ValueError):  # closed, as logging.shutdown
+                    pass
+
+
+class _MessageFilter(logging.Filter):
+    """A filter of the records at or below `max_level` by their messages
+    (i.e. the format strings, so the arguments of a hot-path message should
+    be passed to the logger instead of formatted beforehand)
+    """
+
+    def __init__(self, max_level=logging.WARNING, max_keys=MAX_KEYS):
+        logging.Filter.__init__(self)
+        self.max_level = max_level
+        self.max_keys = max_keys
+        self.suppressed = 0
+        self._states = {}
+        self._lock = Lock()
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        key = (record.name, record.levelno, record.msg)
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                if len(self._states) >= self.max_keys:  # e.g. formatted ones
+                    self._states.clear()
+                state = self._states[key] = self.new_state()
+            passed = self.passes(state)
+            if not passed:
+                self.suppressed += 1
+                state[-1] += 1
+                return False
+            suppressed, state[-1] = state[-1], 0
+        if suppressed:
+            record.msg = "%s (%d similar suppressed)" % (record.getMessage(),
+                                                         suppressed)
+            record.args = None
+        return True
+
+    def new_state(self):
+        """Return the state of a message, whose last item is the number of
+        its records suppressed since the last one passed(by the subclasses)
+        """
+
+    def passes(self, state):
+        """Whether a record of the message in the state passes, updating
+        the state(by the subclasses)
+        """
+
+
+class RateLimitFilter(_MessageFilter):
+    """Pass up to `rate` records per second(in bursts of up to `burst`) of
+    each message
+    """
+
+    def __init__(self, rate, burst=1, **kwargs):
+        _MessageFilter.__init__(self, **kwargs)
+        self.rate = rate
+        self.burst = burst
+
+    def new_state(self):
+        return [TokenBucket(self.rate, self.burst), 0]
+
+    def passes(self, state):
+        bucket = state[0]
+        if bucket.wait_time() > 0:
+            return False
+        bucket.take()
+        return True
+
+
+class SampleFilter(_MessageFilter):
+    """Pass 1 in `n` records of each message(the 1st, the n+1th...)
+    """
+
+    def __init__(self, n, **kwargs):
+        _MessageFilter.__init__(self, **kwargs)
+        self.n = n
+
+    def new_state(self):
+        return [0, 0]
+
+    def passes(self, state):
+        state[0] += 1
+        return state[0] % self.n == 1 % self.n
+
+
+def enqueue_handlers(logger, queue_size=QUEUE_SIZE, filters=()):
+    """Move the logger's handlers behind a queue written by a single thread
+    (stopped at exit), return the listener(None if there are no handlers to
+    move)
+    """
+    handlers = list(logger.handlers)
+    if not handlers or any(isinstance(h, QueueHandler) for h in handlers):
+        return None
+    queue = Queue(queue_size)
+    handler = QueueHandler(queue)
+    handler.setLevel(min(h.level for h in handlers))
+    for f in filters:
+        handler.addFilter(f)
+    listener = QueueListener(queue, handlers)
+    for h in handlers:
+        logger.removeHandler(h)
+    logger.addHandler(handler)
+    listener.start()
+
+    def stop():
+        listener.stop()
+        # the records logged later(e.g. by other exit functions) are written
+        # directly, instead of waiting for the stopped listener
+        logger.removeHandler(handler)
+        for h in handlers:
+            logger.addHandler(h)
+        if handler.dropped:
+            listener.handle(logging.makeLogRecord(dict(
+                name=logger.name, levelno=logging.WARNING,
+                levelname="WARNING", msg="%d log records dropped(the queue "
+                "was full)", args=(handler.dropped,))))
+
+    atexit.register(stop)
+    return listener
+
+
+def add_logging_options(parser):
+    """Add the logging options to the `OptionParser`
+    """
+    parser.add_option("--log-queue-size", dest="log_queue_size", type="int",
+                      default=QUEUE_SIZE,
+                      help="max number of log records waiting to be written "
+                      "by the logging thread(0: log synchronously)")
+    parser.add_option("--log-rate", dest="log_rate", type="float",
+                      default="0",
+                      help="max log records per second of each "
+                      "message(warnings and below, 0: unlimited)")
+    parser.add_option("--log-sample", dest="log_sample", type="int",
+                      default="1",
+                      help="log 1 in N records of each message(warnings "
+                      "and below)")
+
+
+def setup_logging(logger, options):
+    """Set up the logger by the logging options(see `add_logging_options`),
+    return the listener(if any)
+    """
+    filters = []
+    if options.log_sample > 1:
+        filters.append(SampleFilter(options.log_sample))
+    if options.log_rate > 0:
+        filters.append(RateLimitFilter(options.log_rate,
+                                       max(int(options.log_rate), 1)))
+    if options.log_queue_size <= 0:
+        for f in filters:
+            logger.addFilter(f)
+        return None
+    return enqueue_handlers(logger, options.log_queue_size, filters)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent crawl manifest
+"""
+
+import sqlite3
+import sys
+import time
+from optparse import OptionParser
+from threading import Lock
+
+DONE, EMPTY, FAILED = STATUSES = ['done', 'empty', 'failed']
+EMPTY_SIZE = 10  # results smaller than this are deemed empty
+ANY_KIND = '*'  # kind of the records shared by all the kinds
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS manifest (
+        kind TEXT NOT NULL,
+        detail_kind TEXT NOT NULL,
+        app_no TEXT NOT NULL,
+        year TEXT,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        size INTEGER,
+        fetched_at REAL,
+        PRIMARY KEY (kind, detail_kind, app_no))""",
+    """CREATE INDEX IF NOT EXISTS manifest_status
+        ON manifest (kind, detail_kind, year, status)""",
+]
+
+
+class Manifest(object):
+    """A SQLite manifest of the crawled patents keyed by
+    (kind, detail_kind, app_no), which records each patent's status(one of
+    `STATUSES`), number of attempts, last error, result size and fetch time.
+
+    Records are committed in batches of `batch_size`(or at least every
+    `commit_interval` seconds), so a crash loses at most a batch, which
+    will be simply fetched again.
+    """
+
+    def __init__(self, filename, batch_size=500, commit_interval=5):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self._lock = Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.text_factory = str
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for stmt in SCHEMA:
+            self._conn.execute(stmt)
+        self._conn.commit()
+        self._uncommitted = 0
+        self._committed_at = time.time()
+
+    def view(self, kind, detail_kind, year=None):
+        """Return a view bound to the kind, detail kind and year
+        """
+        return ManifestView(self, kind, detail_kind, year)
+
+    def get(self, kind, detail_kind, app_no):
+        """Return the (status, attempts, last_error, size, fetched_at) of the
+        patent or None if it's never been tried
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT status, attempts, last_error, size, fetched_at "
+                "FROM manifest WHERE kind=? AND detail_kind=? AND app_no=?",
+                (kind, detail_kind, app_no)).fetchone()
+
+    def record(self, kind, detail_kind, app_no, status, year=None, size=None,
+               error=None):
+        """Record an attempt on the patent
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO manifest "
+                "(kind, detail_kind, app_no, status) VALUES (?, ?, ?, ?)",
+                (kind, detail_kind, app_no, status))
+            self._conn.execute(
+                "UPDATE manifest SET status=?, attempts=attempts+1, "
+                "last_error=?, year=COALESCE(?, year), "
+                "size=COALESCE(?, size), fetched_at=COALESCE(?, fetched_at) "
+                "WHERE kind=? AND detail_kind=? AND app_no=?",
+                (status, error, year, size, None if status == FAILED else now,
+                 kind, detail_kind, app_no))
+            self._uncommitted += 1
+            if self._uncommitted >= self.batch_size or \
+                    now - self._committed_at >= self.commit_interval:
+                self._commit()
+
+    def _commit(self):
+        self._conn.commit()
+        self._uncommitted = 0
+        self._committed_at = time.time()
+
+    def keys(self, kind, detail_kind, year=None, statuses=STATUSES):
+        """Yield the app_no's of the patents in the given statuses
+        """
+        sql = "SELECT app_no FROM manifest WHERE kind=? AND detail_kind=?"
+        args = [kind, detail_kind]
+        if year is not None:
+            sql += " AND year=?"
+            args.append(year)
+        sql += " AND status IN ({})".format(",".join("?" * len(statuses)))
+        args.extend(statuses)
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        for row in rows:
+            yield row[0]
+
+    def progress(self, kind=None, detail_kind=None, year=None):
+        """Return a list of (kind, detail_kind, year, status, count, attempts)
+        """
+        sql = "SELECT kind, detail_kind, year, status, COUNT(*), " \
+            "SUM(attempts) FROM manifest"
+        conds, args = [], []
+        for name, value in (('kind', kind), ('detail_kind', detail_kind),
+                            ('year', year)):
+            if value is not None:
+                conds.append("{}=?".format(name))
+                args.append(value)
+        if conds:
+            sql += " WHERE " + " AND ".join(conds)
+        sql += " GROUP BY kind, detail_kind, year, status"
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+
+class ManifestView(object):
+    """A manifest's view of the patents in a kind, detail kind and year
+    """
+
+    def __init__(self, manifest, kind, detail_kind, year=None):
+        self.manifest = manifest
+        self.kind = kind
+        self.detail_kind = detail_kind
+        self.year = year
+
+    def should_fetch(self, app_no, check_level):
+        """Whether to fetch the patent(at `check_level` 1 only the done and
+        empty ones are skipped, at 2 the empty ones are fetched again)
+        """
+        if not check_level:
+            return True
+        row = self.manifest.get(self.kind, self.detail_kind, app_no)
+        if row is None or row[0] == FAILED:
+            return True
+        return row[0] == EMPTY and check_level > 1
+
+    def record_done(self, app_no, size):
+        status = DONE if size >= EMPTY_SIZE else EMPTY
+        self.manifest.record(self.kind, self.detail_kind, app_no, status,
+                             year=self.year, size=size)
+
+    def record_failed(self, app_no, error):
+        self.manifest.record(self.kind, self.detail_kind, app_no, FAILED,
+                             year=self.year, error=str(error))
+
+    def keys(self, statuses=STATUSES):
+        return self.manifest.keys(self.kind, self.detail_kind, self.year,
+                                  statuses)
+
+    def progress(self):
+        """Return a dict of status -> count
+        """
+        return dict((row[3], row[4]) for row in self.manifest.progress(
+            self.kind, self.detail_kind, self.year))
+
+
+def main(argv=None):
+    usage = "usage: %prog [options] manifest_file"
+    parser = OptionParser(usage)
+    parser.add_option("-k", "--kind", dest="kind",
+                      help="patent type(e.g. fmgb)")
+    parser.add_option("-K", "--detail-kind", dest="detail_kind",
+                      help="detail kind(e.g. detail)")
+    parser.add_option("-y", "--year", dest="year", help="year")
+    (options, args) = parser.parse_args(argv)
+    if len(args) == 0:
+        parser.error("missing arguments")
+
+    manifest = Manifest(args[0])
+    print "kind\tdetail_kind\tyear\tstatus\tcount\tattempts"
+    for row in manifest.progress(options.kind, options.detail_kind,
+                                 options.year):
+        print "\t".join(str(col) for col in row)
+    manifest.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+"""
+Crawler metrics exported in the Prometheus text format
+"""
+
+import bisect
+import os
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from contextlib import contextmanager
+from threading import Lock
+
+from cnsipo.utils import periodically
+
+# upper bounds(seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+           5, 10, 30)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+class Histogram(object):
+    """A thread-safe histogram of the observed values in buckets
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = Lock()
+        self._counts = [0] * (len(self.buckets) + 1)  # the last: +Inf
+        self._sum = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """Return the (bucket counts, count, sum), the counts aren't
+        cumulative
+        """
+        with self._lock:
+            counts = list(self._counts)
+            return counts, sum(counts), self._sum
+
+    def quantile(self, q):
+        """Estimate the q-th(0-1) quantile by interpolating in its bucket
+        """
+        counts, count, _ = self.snapshot()
+        if not count:
+            return None
+        rank, seen = q * count, 0
+        for i, n in enumerate(counts):
+            if n and seen + n >= rank:
+                if i == len(self.buckets):  # +Inf
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Registry(object):
+    """Named counters, histograms and gauges of the crawler
+
+    Gauges are functions called on export, and `Counters` of the existing
+    components(e.g. the worker pool's) are exported as counters with a
+    prefix, see `add_counters`.
+    """
+
+    def __init__(self, namespace="cnsipo"):
+        self.namespace = namespace
+        self._lock = Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._sources = []
+        self._helps = {}
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def histogram(self, name, help=None, buckets=BUCKETS):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(buckets)
+                self._helps[name] = help
+            return histogram
+
+    def observe(self, name, value):
+        self.histogram(name).observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        """Observe the seconds taken by the block
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def gauge(self, name, func, help=None):
+        """Register a gauge whose value is `func()`
+        """
+        with self._lock:
+            self._gauges[name] = func
+            self._helps[name] = help
+
+    def add_counters(self, counters, prefix):
+        """Export the `Counters` as `{prefix}_{name}`
+        """
+        with self._lock:
+            self._sources.append((prefix, counters))
+
+    def get(self, name):
+        return self._counters.get(name, 0)
+
+    def counters(self):
+        """Return a dict of all the counters
+        """
+        with self._lock:
+            result = dict(self._counters)
+            sources = list(self._sources)
+        for prefix, counters in sources:
+            for name, value in counters.snapshot().items():
+                result["{}_{}".format(prefix, name)] = value
+        return result
+
+    def gauges(self):
+        with self._lock:
+            gauges = dict(self._gauges)
+        result = {}
+        for name, func in gauges.items():
+            try:
+                result[name] = func()
+            except Exception:  # e.g. the component is closed
+                continue
+        return result
+
+    def render(self):
+        """Render the metrics in the Prometheus text format
+        """
+        lines = []
+
+        def header(name, kind):
+            help = self._helps.get(name)
+            if help:
+                lines.append("# HELP {} {}".format(self._name(name), help))
+            lines.append("# TYPE {} {}".format(self._name(name), kind))
+
+        for name, value in sorted(self.counters().items()):
+            header(name, "counter")
+            lines.append("{} {}".format(self._name(name), value))
+        for name, value in sorted(self.gauges().items()):
+            header(name, "gauge")
+            lines.append("{} {}".format(self._name(name), value))
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        for name, histogram in histograms:
+            header(name, "histogram")
+            counts, count, total = histogram.snapshot()
+            cumulative = 0
+            for bound, n in zip(histogram.buckets + ("+Inf",), counts):
+                cumulative += n
+                lines.append('{}_bucket{{le="{}"}} {}'.format(
+                    self._name(name), bound, cumulative))
+            lines.append("{}_sum {}".format(self._name(name), total))
+            lines.append("{}_count {}".format(self._name(name), count))
+        return "\n".join(lines) + "\n"
+
+    def _name(self, name):
+        return "{}_{}".format(self.namespace, name) if self.namespace \
+            else name
+
+    def summary(self):
+        """Return a one-line summary: the counters, the gauges and the
+        count, p50, p99 and total seconds of each histogram
+        """
+        parts = ["{}={}".format(k, v)
+                 for k, v in sorted(self.counters().items())]
+        parts.extend("{}={}".format(k, v)
+                     for k, v in sorted(self.gauges().items()))
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        for name, histogram in histograms:
+            _, count, total = histogram.snapshot()
+            if count:
+                parts.append("{}(n={}, p50={:.3f}, p99={:.3f}, sum={:.1f})"
+                             .format(name, count, histogram.quantile(0.5),
+                                     histogram.quantile(0.99), total))
+        return ", ".join(parts)
+
+    def write_textfile(self, filename):
+        """Write the metrics to a file atomically(e.g. for the textfile
+        collector of the node exporter)
+        """
+        tmp = filename + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp, filename)
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve the metrics at http://{host}:{port}/metrics in a daemon
+        thread, return the server
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = MetricsServer((host, port), Handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        return server
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def export_pool(registry, pool):
+    """Register the gauges of a `WorkerPool`
+    """
+    for name, key in (('queue_depth', 'queued'),
+                      ('active_workers', 'in_flight'),
+                      ('workers', 'workers'),
+                      ('delayed_tasks', 'delayed')):
+        registry.gauge(name, lambda key=key: pool.stats()[key])
+
+
+@contextmanager
+def exporting(registry, logger, interval, filename=None, port=None):
+    """Serve the metrics at `port` and log their summary(and write them to
+    `filename`) every `interval` seconds while running the block
+    """
+    server = registry.serve(port) if port else None
+    if server:
+        logger.info("metrics at http://{}:{}/metrics".format(
+            *server.server_address))
+
+    def report():
+        if filename:
+            registry.write_textfile(filename)
+        logger.info("metrics: {}".format(registry.summary()))
+
+    try:
+        with periodically(report, interval):
+            yield
+    finally:
+        report()
+        if server:
+            server.shutdown()
+            server.server_close()
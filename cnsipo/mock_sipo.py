@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local mock of the SIPO site serving the recorded fixture pages
+"""
+
+import calendar
+import datetime
+import os
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from optparse import OptionParser
+
+from cnsipo.utils import Counters, TokenBucket
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, "tests", "fixtures")
+PAGES = ['outline', 'detail', 'transaction', 'error']
+PATENTS = 10000  # number of patents of a kind in a year
+FIXTURE_APP_NO = "2014100000011"  # app_no in the detail fixture
+# patent type(the 5th digit of app_no) by the selected kind
+TYPES = {'fmgb': '1', 'fmsq': '1', 'xxsq': '2', 'wgsq': '3'}
+
+WINDOW_PATTERN = re.compile(r"BETWEEN\['([\d.]+)','([\d.]+)'\]")
+ITEMS_PATTERN = re.compile(r'(  <div class="cp_linr">.*?</div>\n)+', re.S)
+ITEM_ID_PATTERN = re.compile(r"\d{13}")
+COUNT_PATTERN = re.compile(r'  ksjs\.num\w+\.value = "\d+";\n')
+LICENSE_PATTERN = re.compile(r'(  ksjs\.strLicenseCode\.value = ".*";\n)')
+
+
+def parse_latency(spec):
+    """Parse a latency distribution(in seconds) into a function of a
+    `random.Random`, e.g. "0.05", "uniform:0.01,0.1", "normal:0.05,0.01",
+    "lognormal:-3,0.5" or "exp:0.05"
+    """
+    name, _, args = spec.partition(":")
+    if not args:
+        value = float(name)
+        return lambda r: value
+    args = [float(arg) for arg in args.split(",")]
+    if name == 'uniform':
+        return lambda r: r.uniform(*args)
+    if name == 'normal':
+        return lambda r: max(r.gauss(*args), 0)
+    if name == 'lognormal':
+        return lambda r: r.lognormvariate(*args)
+    if name == 'exp':
+        return lambda r: r.expovariate(1 / args[0])
+    raise ValueError("unknown latency distribution: {}".format(spec))
+
+
+def _parse_day(s, last=False):
+    """Parse the first(or the last) day of "YYYY", "YYYY.MM" or
+    "YYYY.MM.DD"
+    """
+    parts = [int(i) for i in s.split(".")]
+    year = parts[0]
+    month = parts[1] if len(parts) > 1 else (12 if last else 1)
+    day = parts[2] if len(parts) > 2 else \
+        (calendar.monthrange(year, month)[1] if last else 1)
+    return datetime.date(year, month, day)
+
+
+def window_ids(kind, first, last, patents):
+    """Return the ID's of the patents of the kind applied in the window,
+    the `patents` of a year are evenly distributed over its days
+    """
+    first, last = _parse_day(first), _parse_day(last, True)
+    year_days = 366 if calendar.isleap(first.year) else 365
+    start = patents * (first.timetuple().tm_yday - 1) // year_days
+    end = patents * last.timetuple().tm_yday // year_days \
+        if last.year == first.year else patents
+    prefix = "{}{}".format(first.year, TYPES.get(kind, '1'))
+    return ["{}{:07d}{}".format(prefix, i + 1, (i + 1) % 10)
+            for i in range(start, end)]
+
+
+class MockSipo(ThreadingMixIn, HTTPServer):
+    """A mock of the SIPO site, which serves patentoutline.action,
+    patentdetail.action and fullTran.action from the fixture pages
+
+    Each request is delayed by `latency`(see `parse_latency`), and answered
+    with an error page at `error_rate` or by a connection reset at
+    `reset_rate`. If `throttle` is positive, each client address is limited
+    to `throttle` requests per second, beyond which it gets error pages as
+    the site does.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128  # or connections beyond 5 wait for SYN retries
+
+    def __init__(self, address=("127.0.0.1", 0), fixtures_dir=FIXTURES_DIR,
+                 patents=PATENTS, latency=None, error_rate=0, reset_rate=0,
+                 throttle=0, seed=None):
+        HTTPServer.__init__(self, address, MockHandler)
+        self.pages = {}
+        for name in PAGES:
+            with open(os.path.join(fixtures_dir, name + ".html")) as f:
+                self.pages[name] = f.read()
+        self.patents = patents
+        self.latency = parse_latency(latency) if latency else None
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.throttle = throttle
+        self.counters = Counters()
+        self.random = random.Random(seed)
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def start(self):
+        """Serve in a daemon thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def is_throttled(self, client):
+        if not self.throttle:
+            return False
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = self._buckets[client] = TokenBucket(self.throttle,
+                                                             self.throttle)
+            if bucket.wait_time() > 0:
+                return True
+            bucket.take()
+            return False
+
+    def outline_page(self, params):
+        kind = params.get('selected', 'fmgb')
+        page_size = int(params.get('pageSize', 20))
+        page_now = int(params.get('pageNow', 1))
+        window = WINDOW_PATTERN.search(params.get('strWord', ""))
+        if not window:
+            return self.pages['error']
+        ids = window_ids(kind, window.group(1), window.group(2),
+                         self.patents)
+        counts = "".join('  ksjs.{}.value = "{}";\n'.format(k, len(ids))
+                         for k in sorted(params) if k.startswith("num") and
+                         k != 'numSortMethod')
+        page = COUNT_PATTERN.sub("", self.pages['outline'])
+        page = LICENSE_PATTERN.sub(lambda m: m.group(1) + counts, page)
+        template = ITEMS_PATTERN.search(page).group(1)
+        items = "".join(ITEM_ID_PATTERN.sub(patent_id, template)
+                        for patent_id in ids[(page_now - 1) * page_size:
+                                             page_now * page_size])
+        return ITEMS_PATTERN.sub(lambda m: items, page)
+
+    def detail_page(self, params):
+        app_no = re.search(r"='([^']+)'", params.get('strWhere', ""))
+        if not app_no:
+            return self.pages['error']
+        return self.pages['detail'].replace(FIXTURE_APP_NO, app_no.group(1))
+
+    def transaction_page(self, params):
+        if not params.get('an'):
+            return self.pages['error']
+        return self.pages['transaction']
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1  # a response in one write, which Nagle won't delay
+    disable_nagle_algorithm = True
+    routes = {
+        '/patentoutline.action': MockSipo.outline_page,
+        '/patentdetail.action': MockSipo.detail_page,
+        '/fullTran.action': MockSipo.transaction_page,
+    }
+
+    def do_GET(self):
+        self.serve()
+
+    def do_POST(self):
+        self.serve()
+
+    def serve(self):
+        server = self.server
+        server.counters.incr('requests')
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length:
+            params.update(urlparse.parse_qsl(self.rfile.read(length)))
+        route = self.routes.get(url.path)
+        if route is None:
+            self.respond(404, "not found")
+            return
+
+        if server.latency:
+            time.sleep(server.latency(server.random))
+        if server.random.random() < server.reset_rate:
+            server.counters.incr('resets')
+            self.reset()
+        elif server.is_throttled(self.client_address[0]):
+            server.counters.incr('throttled')
+            self.respond(200, server.pages['error'])
+        elif server.random.random() < server.error_rate:
+            server.counters.incr('errors')
+            self.respond(200, server.pages['error'])
+        else:
+            self.respond(200, route(server, params))
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reset(self):
+        """Reset the connection(RST instead of FIN)
+        """
+        self.request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                struct.pack('ii', 1, 0))
+        self.wfile.close()
+        self.rfile.close()
+        self.request.close()
+        self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+def main(argv=None):
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage)
+    parser.add_option("-H", "--host", dest="host", default="127.0.0.1",
+                      help="address to listen on")
+    parser.add_option("-p", "--port", dest="port", type="int",
+                      default="8000", help="port to listen on")
+    parser.add_option("-f", "--fixtures-dir", dest="fixtures_dir",
+                      default=FIXTURES_DIR,
+                      help="directory of the pages: {}(default: "
+                      "tests/fixtures of the source tree)".format(
+                          "|".join(p + ".html" for p in PAGES)))
+    parser.add_option("-N", "--patents", dest="patents", type="int",
+                      default=str(PATENTS),
+                      help="number of patents of a kind in a year")
+    parser.add_option("-l", "--latency", dest="latency",
+                      help="latency distribution(seconds), e.g. 0.05, "
+                      "uniform:0.01,0.1, normal:0.05,0.01, "
+                      "lognormal:-3,0.5 or exp:0.05")
+    parser.add_option("-e", "--error-rate", dest="error_rate", type="float",
+                      default="0", help="rate of error pages")
+    parser.add_option("-r", "--reset-rate", dest="reset_rate", type="float",
+                      default="0", help="rate of connection resets")
+    parser.add_option("-t", "--throttle", dest="throttle", type="float",
+                      default="0",
+                      help="requests per second of a client before it gets "
+                      "error pages(0: unlimited)")
+    parser.add_option("-s", "--seed", dest="seed", type="int",
+                      help="random seed")
+    (options, args) = parser.parse_args(argv)
+    if not os.path.isdir(options.fixtures_dir):
+        # the default is in the source tree, not installed with the package
+        parser.error("missing the directory of the pages {}, "
+                     "pass -f {{fixtures_dir}}".format(options.fixtures_dir))
+    try:
+        server = MockSipo((options.host, options.port), options.fixtures_dir,
+                          options.patents, options.latency,
+                          options.error_rate, options.reset_rate,
+                          options.throttle, options.seed)
+    except ValueError as e:
+        parser.error(e)
+
+    print "serving at {0}(export CNSIPO_BASE_URL={0})".format(server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print server.counters.snapshot()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,6 +13,8 @@ import psycopg2
 
 from cnsipo.shared import get_logger
 from cnsipo.patent_parser import PatentParser
+from cnsipo.logs import add_logging_options, setup_logging
+from cnsipo.profiler import add_profile_options, start_profiling
 
 logger = get_logger()
 
@@ -157,9 +159,13 @@ def main(argv=None):
                       help="action:C(reate), U(pdate), A(ll)(default)")
     parser.add_option("-n", "--dry-run", action="store_true", dest="dry_run",
                       help="show what would have been done")
+    add_logging_options(parser)
+    add_profile_options(parser)
     (options, args) = parser.parse_args(argv)
     if len(args) < 1:
         parser.error("missing arguments")
+    setup_logging(logger, options)
+    start_profiling(options)
 
     action = options.action
     save_methods = [save_collab_info, save_attrs]
@@ -13,6 +13,8 @@ from optparse import OptionParser
 import psycopg2
 
 from cnsipo.shared import get_logger, DETAIL_KINDS
+from cnsipo.store import open_store, STORE_LAYOUTS
+from cnsipo.profiler import add_profile_options, start_profiling
 
 logger = get_logger()
 
@@ -94,8 +96,8 @@ def parse_data(detail_map, flds_map, flds, batch_vals):
 
 def import_data(conn, stmt, detail_kind, year, input_dir, include_file,
                 exclude_file, error_file, start=0, end=-1,
-                batch_size=1000, dry_run=False):
-    dirname = os.path.join(input_dir, year)
+                batch_size=1000, dry_run=False, layout=STORE_LAYOUTS[0]):
+    store = open_store(layout, os.path.join(input_dir, year), readonly=True)
     i = 0
     batch_vals = []
     failed_vals = []
@@ -104,48 +106,52 @@ def import_data(conn, stmt, detail_kind, year, input_dir, include_file,
     with conn.cursor() as cursor:
         if include_file:
             with open(include_file) as f:
-                detail_files = f.read().splitlines()
+                records = [(d, None) for d in f.read().splitlines()]
         else:
-            detail_files = os.listdir(dirname)
+            records = store.scan()
+        excluded = set()
         if exclude_file:
             with open(exclude_file) as f:
-                excluded = f.read().splitlines()
-                detail_files = [d for d in detail_files if d not in excluded]
-        for detail_file in detail_files:
+                excluded = set(f.read().splitlines())
+        for detail_file, data in records:
+            if detail_file in excluded:
+                continue
             i += 1
             if i <= start:
                 continue
             if end >= 0 and i > end:
                 break
 
-            with open(os.path.join(dirname, detail_file), 'r') as f:
-                vals = None
-                try:
-                    json_obj = json.load(f)
-                    if isinstance(json_obj, list):  # transaction case
-                        for details in json_obj:
-                            vals = parse_data(
-                                details, flds_map, flds, batch_vals)
-                            vals[APP_NO] = detail_file
-                    else:  # detail case
-                        vals = parse_data(json_obj, flds_map, flds, batch_vals)
-                        assert vals[APP_NO] == detail_file
-                # except (KeyError, AssertionError) as e:
-                except Exception as e:
-                    if vals is None:
-                        vals = {}
-                    vals[APP_NO] = detail_file  # in case of early exception
-                    failed_vals.append(vals)  # OK even in transaction case
-                    logger.error("{}({})".format(detail_file, e))
-                    continue
-
-                if dry_run:  # only show 1 insertion in each transaction
-                    print "execute: {}\n{}".format(stmt, vals)
-                elif len(batch_vals) >= batch_size:
-                    insert_data(conn, cursor, stmt, batch_vals, failed_vals)
+            vals = None
+            try:
+                if data is None:
+                    data = store.get(detail_file)
+                json_obj = json.loads(data)
+                if isinstance(json_obj, list):  # transaction case
+                    for details in json_obj:
+                        vals = parse_data(
+                            details, flds_map, flds, batch_vals)
+                        vals[APP_NO] = detail_file
+                else:  # detail case
+                    vals = parse_data(json_obj, flds_map, flds, batch_vals)
+                    assert vals[APP_NO] == detail_file
+            # except (KeyError, AssertionError) as e:
+            except Exception as e:
+                if vals is None:
+                    vals = {}
+                vals[APP_NO] = detail_file  # in case of early exception
+                failed_vals.append(vals)  # OK even in transaction case
+                logger.error("{}({})".format(detail_file, e))
+                continue
+
+            if dry_run:  # only show 1 insertion in each transaction
+                print "execute: {}\n{}".format(stmt, vals)
+            elif len(batch_vals) >= batch_size:
+                insert_data(conn, cursor, stmt, batch_vals, failed_vals)
         # leftover
         if batch_vals:
             insert_data(conn, cursor, stmt, batch_vals, failed_vals)
+    store.close()
     if failed_vals:
         with open(error_file, 'w') as f:
             for val in failed_vals:
@@ -174,6 +180,8 @@ def main(argv=None):
                       help="patent table's prefix")
     parser.add_option("-i", "--input-dir", dest="input_dir", default="input",
                       help="input directory(contains patent details)")
+    parser.add_option("-S", "--store", dest="store", default=STORE_LAYOUTS[0],
+                      help="input layout: {}".format("|".join(STORE_LAYOUTS)))
     parser.add_option("-I", "--include-file", dest="include_file",
                       help="a file containing included filenames")
     parser.add_option("-x", "--exclude-file", dest="exclude_file",
@@ -188,9 +196,11 @@ def main(argv=None):
                       help="end index")
     parser.add_option("-n", "--dry-run", action="store_true", dest="dry_run",
                       help="show what would have been done")
+    add_profile_options(parser)
     (options, args) = parser.parse_args(argv)
     if len(args) == 0:
         parser.error("missing arguments")
+    start_profiling(options)
 
     detail_kind = options.detail_kind - 1
     try:
@@ -199,6 +209,9 @@ def main(argv=None):
         parser.error("detail_kind should be an integer between 1 and {}".
                      format(len(DETAIL_KINDS)))
 
+    if options.store not in STORE_LAYOUTS:
+        parser.error("store should be one of {}".format(STORE_LAYOUTS))
+
     input_dir = options.input_dir
     include_file = options.include_file
     exclude_file = options.exclude_file
@@ -221,7 +234,8 @@ def main(argv=None):
                         input_dir=input_dir,
                         include_file=include_file, exclude_file=exclude_file,
                         error_file=error_file+year, start=start, end=end,
-                        batch_size=batch_size, dry_run=dry_run)
+                        batch_size=batch_size, dry_run=dry_run,
+                        layout=options.store)
     return 0
 
 
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+Diff freshly listed patent ID's against the fetched ones into delta batches
+"""
+
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+from optparse import OptionParser
+
+from cnsipo.shared import get_logger
+from cnsipo.store import open_store, STORE_LAYOUTS
+from cnsipo.patent_merge import read_page_ids, read_lines, sorted_runs, \
+    merge_runs, unique, difference, CHUNK_SIZE
+
+logger = get_logger()
+
+
+class IdIndex(object):
+    """A sorted unique ID file(`{dirname}/{year}`) of the patents fetched in
+    a year, which is only replaced as a whole
+    """
+
+    def __init__(self, dirname, year):
+        self.filename = os.path.join(dirname, year)
+
+    def __iter__(self):
+        if not os.path.exists(self.filename):
+            return iter([])
+        return read_lines(self.filename)
+
+    def update(self, sorted_ids):
+        """Merge the sorted ID's into the index, return the number of the
+        new ones
+        """
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp = self.filename + ".tmp"
+        added = 0
+        with open(tmp, 'w') as f:
+            for patent_id in unique(heapq.merge(iter(self),
+                                                _tagged(sorted_ids))):
+                if isinstance(patent_id, _New):
+                    added += 1
+                f.write(patent_id + "\n")
+        os.rename(tmp, self.filename)
+        return added
+
+
+class _New(str):
+    """An ID which is not in the index yet"""
+
+
+def _tagged(ids):
+    for patent_id in ids:
+        yield _New(patent_id)
+
+
+def read_sources(sources):
+    """Yield the ID's in the sources, each of which is an ID file or a
+    directory of page files(by `patent_list.py`)
+    """
+    for source in sources:
+        if os.path.isdir(source):
+            for patent_id in read_page_ids(source):
+                yield patent_id
+        else:
+            for line in read_lines(source):
+                if line.strip():
+                    yield line.strip()
+
+
+def diff(ids, index, delta_file, chunk_size=CHUNK_SIZE, tmp_dir=None):
+    """Write the sorted unique ID's which are not in the index to the delta
+    file, return the number of them
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="delta-", dir=tmp_dir)
+    try:
+        runs = sorted_runs(ids, tmp_dir, chunk_size)
+        dirname = os.path.dirname(delta_file)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        count = 0
+        with open(delta_file, 'w') as f:
+            for patent_id in difference(merge_runs(runs), index):
+                f.write(patent_id + "\n")
+                count += 1
+        return count
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def commit(index, delta_file, store=None):
+    """Merge the delta into the index(only the ID's fetched into the store
+    if given), return the number of the committed ID's
+    """
+    ids = read_lines(delta_file)
+    if store is not None:
+        ids = (patent_id for patent_id in ids if store.exists(patent_id))
+    return index.update(ids)
+
+
+def main(argv=None):
+    usage = "usage: %prog [options] index_dir year [id_source1 ...]"
+    parser = OptionParser(usage)
+    parser.add_option("-o", "--delta-dir", dest="delta_dir", default="delta",
+                      help="directory of the delta ID files({delta_dir}/"
+                      "{year}, to be fetched by patent_detail.py -i and "
+                      "imported by patent_db.py -I)")
+    parser.add_option("-c", "--commit", action="store_true", dest="commit",
+                      help="merge the delta into the index after it's "
+                      "fetched")
+    parser.add_option("-b", "--bootstrap", action="store_true",
+                      dest="bootstrap",
+                      help="build the index from the fetched details of "
+                      "-O instead")
+    parser.add_option("-O", "--output-dir", dest="output_dir",
+                      help="output directory of patent_detail.py, with -c "
+                      "only the fetched ID's of the delta are committed")
+    parser.add_option("-S", "--store", dest="store", default=STORE_LAYOUTS[0],
+                      help="output layout: {}".format("|".join(STORE_LAYOUTS)))
+    parser.add_option("-C", "--chunk-size", dest="chunk_size", type="int",
+                      default=str(CHUNK_SIZE),
+                      help="number of ID's sorted in memory at a time")
+    parser.add_option("-T", "--tmp-dir", dest="tmp_dir",
+                      help="directory of temporary files")
+    (options, args) = parser.parse_args(argv)
+    if len(args) < 2:
+        parser.error("missing arguments")
+    if options.store not in STORE_LAYOUTS:
+        parser.error("store should be one of {}".format(STORE_LAYOUTS))
+    if options.bootstrap and not options.output_dir:
+        parser.error("bootstrap requires the output directory")
+
+    index_dir, year, sources = args[0], args[1], args[2:]
+    index = IdIndex(index_dir, year)
+    delta_file = os.path.join(options.delta_dir, year)
+    store = None
+    if options.output_dir:
+        store = open_store(options.store,
+                           os.path.join(options.output_dir, year),
+                           readonly=True)
+
+    if options.bootstrap:
+        tmp_dir = tempfile.mkdtemp(prefix="delta-", dir=options.tmp_dir)
+        try:
+            runs = sorted_runs(store.keys(), tmp_dir, options.chunk_size)
+            print "indexed {} ID's".format(index.update(merge_runs(runs)))
+        finally:
+            shutil.rmtree(tmp_dir)
+    elif options.commit:
+        print "committed {} ID's".format(commit(index, delta_file, store))
+    else:
+        if not sources:
+            parser.error("missing id sources")
+        count = diff(read_sources(sources), index, delta_file,
+                     options.chunk_size, options.tmp_dir)
+        print "{} new ID's in {}".format(count, delta_file)
+    if store is not None:
+        store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,14 +7,24 @@ Retrieve patent details and transactions
 import json
 import os
 import sys
+import urllib
+from operator import itemgetter
 from optparse import OptionParser
 
-import requests
-from bs4 import BeautifulSoup
-
-from cnsipo.utils import retry, JobQueue, threaded
+from cnsipo.utils import retry, threaded, create_job_queue, ENGINES, \
+    ConcurrencyController, WorkerPool, SyncWriter, RetryPolicy, \
+    RETRY_MODES, ProcessStage, Counters, patch_engine
+from cnsipo.store import open_store, STORE_LAYOUTS, SegmentStore
+from cnsipo.manifest import Manifest, STATUSES, DONE, ANY_KIND
+from cnsipo.extractor import PARSERS, get_parser, is_error_page
+from cnsipo.patent_shard import parse_shard, select_shard
+from cnsipo.client import init_client, get_client
+from cnsipo.proxy import ProxyPool, load_proxies
+from cnsipo.metrics import exporting, export_pool
+from cnsipo.logs import add_logging_options, setup_logging
+from cnsipo.profiler import add_profile_options, start_profiling
 from cnsipo.shared import get_logger, ContentError, FORGIVEN_ERROR, \
-    DETAIL_KINDS
+    DETAIL_KINDS, CRAWL_COUNTERS, CIRCUIT_BREAKER, BASE_URL, METRICS
 
 
 KINDS = ['fmgb', 'fmsq', 'syxx', 'wgsq']
@@ -22,98 +32,231 @@ STR_SRC = ['fmmost', 'fmmost', 'xxmost', 'wgmost']
 STR_WHERE = ['GB', 'SQ', 'GB', 'SQ']
 DELAY = 3
 RETRIES = 1000
+# detail kinds whose requests don't depend on the patent kind(e.g. 'fmgb'
+# and 'fmsq' share the same transactions), which are fetched once for all
+# the kinds sharing a manifest
+SHARED_DETAIL_KINDS = ['transaction']
+NO_DATA = "no valid data found"
 
 logger = get_logger()
 
 
+class ParseError(Exception):
+    """Error of parsing a page in another process"""
+    pass
+
+
 def detail_params(patent_id, kind):
     params = {
         'strSources': STR_SRC[kind],
         'strWhere': "申请号='{}' and {}INDEX=1".format(
             patent_id, STR_WHERE[kind]), 'strLicenseCode': "", 'pageNow': 1
     }
-    return "http://epub.sipo.gov.cn/patentdetail.action", params
-
-
-def detail_parse(bs, kind):
-    # TODO: not work for kind 'wgsq'
-    details = {}
-    tbl = bs.table.table
-    for row in tbl.findAll('tr'):
-        cells = row.findAll('td')
-        details[cells[0].get_text().encode('utf-8')] = \
-            cells[1].get_text().encode('utf-8')
-    digest = bs.find_all("div", class_="xm_jsh")[0]
-    details['摘要'] = digest.get_text().encode('utf-8')
-    return details
+    return BASE_URL + "/patentdetail.action", params
 
 
 def transaction_params(patent_id, kind):
     params = {'an': "{}".format(patent_id)}
-    return "http://epub.sipo.gov.cn/fullTran.action", params
-
+    return BASE_URL + "/fullTran.action", params
 
-def transaction_parse(bs, kind):
-    trans = []
-    for tbl in bs.findAll('table'):
-        t = tbl.table
-        if t:
-            key_val = {}
-            rows = t.findAll('tr')
-            cells = rows[1].findAll('td')
-            for i in [0, 2]:
-                key_val[cells[i].get_text().encode('utf-8')] \
-                    = cells[i + 1].get_text().encode('utf-8')
-            trans.append(key_val)
-    return trans
 
-
-@retry(FORGIVEN_ERROR, tries=RETRIES, delay=DELAY, backoff=1, logger=logger)
+@retry(FORGIVEN_ERROR, tries=RETRIES, delay=DELAY, backoff=1, logger=logger,
+       counters=CRAWL_COUNTERS, breaker=CIRCUIT_BREAKER)
 def query(get_params, parse, kind,
-          patent_id, dirname, timeout, check_level, dry_run=False):
-    if not os.path.isdir(dirname):
-        os.makedirs(dirname)
-    output_path = os.path.join(dirname, patent_id)
-    if check_level and os.path.exists(output_path):
-        if check_level > 1 and os.path.getsize(output_path) < 10:
-            logger.info("REDO with id: {}(empty result)".format(patent_id))
+          patent_id, store, timeout, check_level, dry_run=False,
+          manifest=None, detail_kind=DETAIL_KINDS[0], archive=None,
+          parse_stage=None):
+    if manifest:
+        if not manifest.should_fetch(patent_id, check_level):
+            logger.debug("SKIP the patent %s", patent_id)
+            METRICS.incr('skipped')
+            return
+    elif check_level and store.exists(patent_id):
+        if check_level > 1 and store.size(patent_id) < 10:
+            logger.info("REDO with id: %s(empty result)", patent_id)
         else:
-            logger.debug("SKIP the patent {}".format(patent_id))
+            logger.debug("SKIP the patent %s", patent_id)
+            METRICS.incr('skipped')
             return
 
-    msg = "doing with patent: {}".format(patent_id)
     if dry_run:
-        print msg
+        print "doing with patent: {}".format(patent_id)
         return
 
-    logger.debug(msg)
+    logger.debug("doing with patent: %s", patent_id)
     try:
         url, params = get_params(patent_id, kind)
-        resp = requests.post(url, params=params, timeout=timeout)
-        bs = BeautifulSoup(resp.text)
-        result = parse(bs, kind)
-        if not result:  # empty
-            raise ContentError("no valid data found")
-        with open(output_path, 'w') as f:
-            json.dump(result, f, ensure_ascii=False)
-            f.write("\n")
-        logger.info("DONE with the patent: {}".format(patent_id))
-    except AttributeError as e:
-        logger.warn("an error page for the patent: ({})".format(patent_id))
-        raise ContentError("attribute error")
+        resp = get_client().post(url, params=params, timeout=timeout)
+        if is_error_page(resp.text, detail_kind):  # no need to parse it
+            logger.warn("an error page for the patent: (%s)", patent_id)
+            METRICS.incr('content_errors')
+            get_client().report_error()
+            raise ContentError("error page")
+        page = resp.text.encode('utf-8')
+        if archive:
+            archive.put(archive_key(patent_id, url, params), page)
+        if parse_stage:  # parsed by another process
+            _, data, error = parse_stage.call(
+                (parse, kind, detail_kind, patent_id, page))
+            if error and error != NO_DATA:
+                raise ParseError(error)
+        else:
+            with METRICS.timer('parse_seconds'):
+                data = dump_result(parse(resp.text, kind))
+        if data is None:  # empty
+            METRICS.incr('content_errors')
+            raise ContentError(NO_DATA)
+        with METRICS.timer('write_seconds'):
+            store.put(patent_id, data)
+        if manifest:
+            manifest.record_done(patent_id, len(data))
+        logger.info("DONE with the patent: %s", patent_id)
     except FORGIVEN_ERROR as e:
-        logger.debug("FAIL(may retry) with the patent: {}({})".format(
-            patent_id, e))
+        logger.debug("FAIL(may retry) with the patent: %s(%s)", patent_id, e)
+        if manifest:
+            manifest.record_failed(patent_id, e)
         raise
     except Exception as e:
         logger.error("FAIL(no retry) with the patent: {}({})".format(
             patent_id, e))
+        if manifest:
+            manifest.record_failed(patent_id, e)
         exc_type, exc_obj, exc_tb = sys.exc_info()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         logger.error("{}|{}|{}".format(exc_type, fname, exc_tb.tb_lineno))
         raise
 
 
+@retry(FORGIVEN_ERROR, tries=RETRIES, delay=DELAY, backoff=1, logger=logger,
+       counters=CRAWL_COUNTERS, breaker=CIRCUIT_BREAKER)
+def query_all(parts, kind, patent_id, timeout, check_level, dry_run=False,
+              parse_stage=None):
+    """Query all the parts(a list of (get_params, parse, detail_kind, store,
+    manifest, archive)) of the patent back to back, i.e. on the same pooled
+    connection of the thread.
+
+    A failed part doesn't stop the others, and a retry skips the parts
+    already done unless `check_level` is 0.
+    """
+    error = None
+    for get_params, parse, detail_kind, store, manifest, archive in parts:
+        try:
+            query.__wrapped__(get_params, parse, kind, patent_id, store,
+                              timeout, check_level, dry_run=dry_run,
+                              manifest=manifest, detail_kind=detail_kind,
+                              archive=archive, parse_stage=parse_stage)
+        except Exception as e:
+            error = error or e
+    if error:
+        raise error
+
+
+def archive_key(patent_id, url, params):
+    """The key of a page in the archive
+    """
+    return "{}|{}?{}".format(patent_id, url,
+                             urllib.urlencode(sorted(params.items())))
+
+
+def archived_pages(archive, get_params, kind, patent_ids=None):
+    """Yield the (patent_id, page) pairs archived for the kind(all of
+    them if `patent_ids` is None)
+    """
+    if patent_ids is None:
+        for key, page in archive.scan():
+            patent_id = key.split("|", 1)[0]
+            if key == archive_key(patent_id, *get_params(patent_id, kind)):
+                yield patent_id, page
+        return
+
+    for patent_id in patent_ids:
+        key = archive_key(patent_id, *get_params(patent_id, kind))
+        if archive.exists(key):
+            yield patent_id, archive.get(key)
+        else:
+            logger.warn("no archived page for the patent: {}".format(
+                patent_id))
+
+
+def dump_result(result):
+    """The result of parsing in a JSON line, None if it's empty
+    """
+    if not result:
+        return None
+    return json.dumps(result, ensure_ascii=False) + "\n"
+
+
+def parse_page(parse, kind, detail_kind, patent_id, page):
+    """Parse a page(in a worker process), return the patent ID, the result
+    in JSON and the error(if any)
+    """
+    try:
+        text = page.decode('utf-8')
+        if is_error_page(text, detail_kind):
+            return patent_id, None, "error page"
+        data = dump_result(parse(text, kind))
+        if data is None:
+            return patent_id, None, NO_DATA
+        return patent_id, data, None
+    except Exception as e:
+        return patent_id, None, "{}: {}".format(type(e).__name__, e)
+
+
+def save_result(store, manifest, result):
+    """Save a result of `parse_page`, return whether it's done
+    """
+    patent_id, data, error = result
+    if error:
+        logger.warn("FAIL to parse the page of the patent: %s(%s)",
+                    patent_id, error)
+        METRICS.incr('content_errors')
+        if manifest:
+            manifest.record_failed(patent_id, error)
+        return False
+
+    with METRICS.timer('write_seconds'):
+        store.put(patent_id, data)
+    if manifest:
+        manifest.record_done(patent_id, len(data))
+    logger.info("DONE with the patent: %s", patent_id)
+    return True
+
+
+def reparse(pages, parse, kind, detail_kind, store, processes=None,
+            manifest=None, capacity=1000):
+    """Rebuild the results from the archived pages by a process pool,
+    return the numbers of done and failed pages
+    """
+    counters = Counters()
+
+    def on_result(result):
+        counters.incr('done' if save_result(store, manifest, result)
+                      else 'failed')
+
+    stage = ProcessStage(parse_page, processes, capacity, logger=logger)
+    try:
+        for patent_id, page in pages:
+            stage.submit((parse, kind, detail_kind, patent_id, page),
+                         on_result)
+        stage.close()
+    except:
+        stage.terminate()
+        raise
+    return counters.get('done'), counters.get('failed')
+
+
+def read_ids(lines, start=0, end=-1):
+    """Lazily yield the patent IDs within the index range from the lines
+    """
+    i = 1
+    for line in lines:
+        i += 1
+        if end >= 0 and i > end:
+            break
+        if i > start:
+            yield line.strip()
+
+
 def main(argv=None):
     usage = "usage: %prog [options] yearOrId1 [yearOrId2 ...]"
     parser = OptionParser(usage)
@@ -121,18 +264,104 @@ def main(argv=None):
                       help="patent type(1-4)")
     parser.add_option("-K", "--detail-kind", dest="detail_kind", type="int",
                       default="1",
-                      help="1: {} 2: {}".format(*DETAIL_KINDS))
+                      help="1: {} 2: {} 3: both in one pass(written to "
+                      "{{output_dir}}/{{detail_kind}})".format(*DETAIL_KINDS))
     parser.add_option("-i", "--input-dir", dest="input_dir", default="input",
                       help="input directory(contains ID files)")
     parser.add_option("-o", "--output-dir",
                       dest="output_dir", default="output",
                       help="output directory")
+    parser.add_option("-S", "--store", dest="store", default=STORE_LAYOUTS[0],
+                      help="output layout: {}(segment: pack the results "
+                      "into large files)".format("|".join(STORE_LAYOUTS)))
+    parser.add_option("-z", "--compress", action="store_true",
+                      dest="compress",
+                      help="compress the results(in segment layout)")
+    parser.add_option("-M", "--manifest-file", dest="manifest_file",
+                      help="SQLite file recording the crawl state, which "
+                      "replaces file checks on resumption")
+    parser.add_option("-x", "--redo", dest="redo",
+                      help="redo the patents in the manifest in the given "
+                      "status(es): failed|empty|failed,empty")
+    parser.add_option("-p", "--parser", dest="parser", default=PARSERS[0],
+                      help="page parser: {}(lxml requires `lxml`, regex "
+                      "is the fastest)".format("|".join(PARSERS)))
+    parser.add_option("-a", "--archive-dir", dest="archive_dir",
+                      help="directory to archive the raw pages(compressed) "
+                      "for reparsing")
+    parser.add_option("--reparse", action="store_true", dest="reparse",
+                      help="rebuild the results from the archived pages "
+                      "without fetching")
+    parser.add_option("-w", "--parse-workers", dest="parse_workers",
+                      type="int", default="0",
+                      help="number of parsing processes(0: parse in the "
+                      "fetching threads, or as many as CPUs to reparse)")
+    parser.add_option("-W", "--parse-queue-size", dest="parse_queue_size",
+                      type="int", default="100",
+                      help="max number of fetched pages waiting for "
+                      "parsing processes")
     parser.add_option("-t", "--threads", dest="threads", type="int",
                       default="20",
-                      help="number of threads")
+                      help="number of threads(or concurrent tasks)")
+    parser.add_option("-E", "--engine", dest="engine", default=ENGINES[0],
+                      help="fetch engine: {}".format("|".join(ENGINES)))
+    parser.add_option("-P", "--pool-size", dest="pool_size", type="int",
+                      help="number of kept-alive connections"
+                      "(default: number of threads)")
+    parser.add_option("-q", "--queue-size", dest="queue_size", type="int",
+                      default="1000",
+                      help="max number of queued tasks(0: unbounded)")
     parser.add_option("-T", "--timeout", dest="timeout", type="int",
                       default="5",
-                      help="connection timeout")
+                      help="connection timeout(initial one if adaptive)")
+    parser.add_option("-A", "--adaptive", action="store_true",
+                      dest="adaptive",
+                      help="adapt concurrency(up to the number of threads) "
+                      "and timeout to the server's latency and errors")
+    parser.add_option("-R", "--report-interval", dest="report_interval",
+                      type="int", default="60",
+                      help="interval(in seconds) of reporting progress")
+    parser.add_option("-C", "--checkpoint-file", dest="checkpoint_file",
+                      help="file to save the IDs of the queued and unread "
+                      "tasks when interrupted(otherwise the queued ones are "
+                      "drained)")
+    parser.add_option("-r", "--retry-mode", dest="retry_mode",
+                      default=RETRY_MODES[0],
+                      help="retry mode: {}(defer: free the worker and "
+                      "retry later)".format("|".join(RETRY_MODES)))
+    parser.add_option("-m", "--max-attempts", dest="max_attempts",
+                      type="int", default=RETRIES,
+                      help="max attempts of a task(in defer mode)")
+    parser.add_option("-j", "--jitter", dest="jitter", type="float",
+                      default="0.5",
+                      help="randomized fraction of retry delay"
+                      "(in defer mode)")
+    parser.add_option("-D", "--dead-letter-file", dest="dead_letter_file",
+                      help="file to save the IDs of the tasks which "
+                      "failed too many times(in defer mode)")
+    parser.add_option("-b", "--breaker-threshold", dest="breaker_threshold",
+                      type="int", default="20",
+                      help="number of consecutive failures to pause all "
+                      "the requests(0: never)")
+    parser.add_option("-B", "--breaker-cooldown", dest="breaker_cooldown",
+                      type="int", default="30",
+                      help="seconds to pause before probing the server")
+    parser.add_option("-H", "--shard", dest="shard",
+                      help="crawl only the shard i/N(e.g. 0/4) of the ID's, "
+                      "which are hashed consistently onto N shards")
+    parser.add_option("-X", "--proxy-file", dest="proxy_file",
+                      help="file of the proxies to spread the requests "
+                      "over(one URL per line)")
+    parser.add_option("-L", "--proxy-rate", dest="proxy_rate", type="float",
+                      default="0",
+                      help="maximum requests per second through each "
+                      "proxy(0: unlimited)")
+    parser.add_option("--metrics-file", dest="metrics_file",
+                      help="file to write the metrics to(in the Prometheus "
+                      "text format) every report interval")
+    parser.add_option("--metrics-port", dest="metrics_port", type="int",
+                      help="port to serve the metrics at(/metrics) on "
+                      "localhost")
     parser.add_option("-s", "--start", dest="start", type="int", default="0",
                       help="start index")
     parser.add_option("-e", "--end", dest="end", type="int", default="-1",
@@ -143,20 +372,29 @@ def main(argv=None):
                       "2: check file size")
     parser.add_option("-n", "--dry-run", action="store_true", dest="dry_run",
                       help="show what would have been done")
-    (options, args) = parser.parse_args()
+    add_logging_options(parser)
+    add_profile_options(parser)
+    (options, args) = parser.parse_args(argv)
+    patch_engine(options.engine)  # before any thread or lock is created
     if len(args) == 0:
         parser.error("missing arguments")
 
     get_params, parse = None, None
     kind = options.kind - 1
     kind_str = KINDS[kind]
+    all_kinds = options.detail_kind == len(DETAIL_KINDS) + 1
     try:
-        detail_kind = DETAIL_KINDS[options.detail_kind - 1]
+        detail_kinds = DETAIL_KINDS if all_kinds else \
+            [DETAIL_KINDS[options.detail_kind - 1]]
+        detail_kind = detail_kinds[0]
         get_params = globals()[detail_kind + "_params"]
-        parse = globals()[detail_kind + "_parse"]
     except:
         parser.error("detail_kind should be an integer between 1 and {}".
-                     format(len(DETAIL_KINDS)))
+                     format(len(DETAIL_KINDS) + 1))
+    try:
+        parse = get_parser(options.parser, detail_kind)
+    except ValueError:
+        parser.error("parser should be one of {}".format(PARSERS))
 
     input_dir = options.input_dir
     output_dir = options.output_dir
@@ -165,33 +403,232 @@ def main(argv=None):
     end = options.end
     check_level = options.check_level
     dry_run = options.dry_run
+    if options.engine not in ENGINES:
+        parser.error("engine should be one of {}".format(ENGINES))
+    if options.store not in STORE_LAYOUTS:
+        parser.error("store should be one of {}".format(STORE_LAYOUTS))
+    redo = options.redo.split(",") if options.redo else None
+    if all_kinds and (redo or options.reparse):
+        parser.error("redo and reparse require a single detail kind")
+    if redo:
+        if not options.manifest_file:
+            parser.error("redo requires a manifest file")
+        if [s for s in redo if s not in STATUSES or s == DONE]:
+            parser.error("redo status should be failed or empty")
+    shard = None
+    if options.shard:
+        try:
+            shard = parse_shard(options.shard)
+        except ValueError:
+            parser.error("shard should be i/N, where 0 <= i < N")
+    if options.retry_mode not in RETRY_MODES:
+        parser.error("retry mode should be one of {}".format(RETRY_MODES))
+
+    store_kwargs = {'compress': True} if options.compress else {}
+    stores = []
+    manifest, views = None, []
+    if options.manifest_file:
+        manifest = Manifest(options.manifest_file)
+
+    def open_stores(year=None, detail_kind=None):
+        """Open the output store and the archive(if any) of the year(and
+        the detail kind if all the kinds are fetched, while the archive is
+        always by the detail kind, as the runs of the kinds may share it)
+        """
+        subdir = os.path.join(detail_kind or "", year or "")
+        store = open_store(options.store, os.path.join(output_dir, subdir),
+                           **store_kwargs)
+        stores.append(store)
+        archive = None
+        if options.archive_dir:
+            # only read by reparsing, maybe while a crawl is archiving
+            archive = SegmentStore(
+                os.path.join(options.archive_dir,
+                             detail_kind or detail_kinds[0], year or ""),
+                compress=True, readonly=options.reparse)
+            stores.append(archive)
+        return store, archive
+
+    def view(year=None, detail_kind=detail_kind):
+        if not manifest:
+            return None
+        shared = detail_kind in SHARED_DETAIL_KINDS
+        views.append(manifest.view(ANY_KIND if shared else kind_str,
+                                   detail_kind, year))
+        logger.info("manifest progress of {}: {}".format(
+            year or "ids", views[-1].progress()))
+        return views[-1]
 
-    job_queue = JobQueue(1 if dry_run else options.threads)
-    with threaded(job_queue):
+    def parts(year=None):
+        """Open the outputs of all the detail kinds, see `query_all`
+        """
+        result = []
+        for detail_kind in detail_kinds:
+            store, archive = open_stores(year, detail_kind)
+            result.append((globals()[detail_kind + "_params"],
+                           get_parser(options.parser, detail_kind),
+                           detail_kind, store, view(year, detail_kind),
+                           archive))
+        return result
+
+    def close():
+        for store in stores:
+            store.close()
+        if manifest:
+            for v in views:
+                logger.info("manifest progress of {}: {}".format(
+                    v.year or "ids", v.progress()))
+            manifest.close()
+
+    if options.reparse:
+        if not options.archive_dir:
+            parser.error("reparse requires an archive directory")
+        processes = options.parse_workers or None
         if len(args[0]) == 4:  # assumed years
             for year in args:
-                dirname = os.path.join(output_dir, year)
+                store, archive = open_stores(year)
+                print "reparse patents' {}(kind: {}) in year {}".format(
+                    detail_kind, kind_str, year)
+                pages = archived_pages(archive, get_params, kind)
+                print "done: {}, failed: {}".format(*reparse(
+                    pages, parse, kind, detail_kind, store, processes,
+                    view(year)))
+        else:  # assumed ids
+            store, archive = open_stores()
+            pages = archived_pages(archive, get_params, kind, args)
+            print "done: {}, failed: {}".format(*reparse(
+                pages, parse, kind, detail_kind, store, processes, view()))
+        close()
+        return 0
+
+    task = query_all if all_kinds else query
+    retry_policy = None
+    if options.retry_mode == 'defer':
+        if options.engine != 'thread':
+            parser.error("retry mode 'defer' requires engine 'thread'")
+        task = task.__wrapped__  # retried by the pool instead
+        retry_policy = RetryPolicy(FORGIVEN_ERROR, tries=options.max_attempts,
+                                   delay=DELAY, backoff=1,
+                                   jitter=options.jitter)
+
+    threads = 1 if dry_run else options.threads
+    parse_stage = None
+    if options.parse_workers and not dry_run:
+        if options.engine != 'thread':
+            parser.error("parse workers require engine 'thread'")
+        # forked before any thread starts
+        parse_stage = ProcessStage(parse_page, options.parse_workers,
+                                   options.parse_queue_size, logger=logger)
+    setup_logging(logger, options)  # its thread started after the fork
+    start_profiling(options)
+    checkpoint, dead_letter = None, None
+    if options.checkpoint_file:
+        checkpoint = SyncWriter(options.checkpoint_file)
+    if options.dead_letter_file:
+        dead_letter = SyncWriter(options.dead_letter_file)
+
+    def on_cancel(future):
+        checkpoint.write_line(future.key)
+
+    def on_dead(future, e):
+        logger.error("GIVE UP the patent: {}({})".format(future.key, e))
+        if dead_letter:
+            dead_letter.write_line(future.key)
+
+    job_queue = create_job_queue(options.engine, threads, options.queue_size,
+                                 counters=CRAWL_COUNTERS,
+                                 on_cancel=on_cancel if checkpoint else None,
+                                 logger=logger,
+                                 report_interval=options.report_interval,
+                                 retry_policy=retry_policy, on_dead=on_dead,
+                                 breaker=CIRCUIT_BREAKER)
+    CIRCUIT_BREAKER.configure(options.breaker_threshold,
+                              options.breaker_cooldown, logger=logger)
+    if isinstance(job_queue, WorkerPool):
+        job_queue.handle_interrupt()
+        export_pool(METRICS, job_queue)
+    controller = None
+    if options.adaptive:
+        controller = ConcurrencyController(threads, initial=threads / 4,
+                                           logger=logger)
+    proxy_pool = None
+    if options.proxy_file:
+        proxy_pool = ProxyPool(load_proxies(options.proxy_file),
+                               options.proxy_rate, logger=logger)
+    init_client(pool_maxsize=options.pool_size or threads,
+                per_thread=options.engine == 'thread', controller=controller,
+                proxy_pool=proxy_pool, metrics=METRICS)
+    task_kwargs = dict(key=itemgetter(3), timeout=timeout,
+                       check_level=check_level, dry_run=dry_run,
+                       detail_kind=detail_kind, parse_stage=parse_stage)
+    if all_kinds:  # args: (parts, kind, patent_id)
+        task_kwargs.update(key=itemgetter(2))
+        del task_kwargs['detail_kind']
+
+    def select(ids):
+        return select_shard(ids, *shard) if shard else ids
+
+    with exporting(METRICS, logger, options.report_interval,
+                   options.metrics_file, options.metrics_port), \
+            threaded(job_queue):
+        if len(args[0]) == 4 and all_kinds:  # assumed years
+            for year in args:
+                year_parts = parts(year)
+                print "start on patents' {}(kind: {}) in year {}".format(
+                    "+".join(detail_kinds), kind_str, year)
+                with open(os.path.join(input_dir, year)) as f:
+                    job_queue.add_tasks(
+                        task, ((year_parts, kind, patent_id)
+                               for patent_id in select(
+                                   read_ids(f, start, end))),
+                        **task_kwargs)
+        elif all_kinds:  # assumed ids
+            id_parts = parts()
+            for patent_id in args:
+                print "start on patent {}'s {}(kind: {})".format(
+                    patent_id, "+".join(detail_kinds), kind_str)
+                job_queue.add_tasks(task, [(id_parts, kind, patent_id)],
+                                    **task_kwargs)
+        elif len(args[0]) == 4:  # assumed years
+            for year in args:
+                store, archive = open_stores(year)
+                kwargs = dict(task_kwargs, manifest=view(year),
+                              archive=archive)
                 print "start on patents' {}(kind: {}) in year {}".format(
                     detail_kind, kind_str, year)
+                if redo:
+                    ids = select(read_ids(views[-1].keys(redo), start, end))
+                    kwargs['check_level'] = 0
+                    job_queue.add_tasks(
+                        task, ((get_params, parse, kind, patent_id, store)
+                               for patent_id in ids), **kwargs)
+                    continue
                 with open(os.path.join(input_dir, year)) as f:
-                    i = 1
-                    for line in f:
-                        i += 1
-                        if i > start and (end < 0 or i <= end):
-                            job_queue.add_task(query,
-                                               get_params, parse, kind,
-                                               line.strip(), dirname,
-                                               timeout=timeout,
-                                               check_level=check_level,
-                                               dry_run=dry_run)
+                    job_queue.add_tasks(
+                        task, ((get_params, parse, kind, patent_id, store)
+                               for patent_id in select(
+                                   read_ids(f, start, end))),
+                        **kwargs)
         else:  # assumed ids
+            store, archive = open_stores()
+            kwargs = dict(task_kwargs, manifest=view(), archive=archive)
             for patent_id in args:
                 print "start on patent {}'s {}(kind: {})".format(
                     patent_id, detail_kind, kind_str)
-                dirname = output_dir
-                job_queue.add_task(query, get_params, parse, kind,
-                                   patent_id, dirname, timeout=timeout,
-                                   check_level=check_level, dry_run=dry_run)
+                job_queue.add_tasks(
+                    task, [(get_params, parse, kind, patent_id, store)],
+                    **kwargs)
+    if parse_stage:
+        parse_stage.close()
+    for writer in (checkpoint, dead_letter):
+        if writer:
+            writer.close()
+    close()
+    if isinstance(job_queue, WorkerPool):
+        logger.info("pool stats: {}".format(job_queue.stats()))
+    logger.info("HTTP connections: {}".format(get_client().stats()))
+    if proxy_pool:
+        logger.info("proxies: {}".format(proxy_pool.stats()))
     return 0
 
 
@@ -7,48 +7,62 @@ Retrieve patent ID's
 import re
 import os
 import sys
+import calendar
 from optparse import OptionParser
 
 import requests
 
-from cnsipo.utils import retry, JobQueue, threaded
-from cnsipo.shared import get_logger, ContentError, FORGIVEN_ERROR
+from cnsipo.utils import retry, threaded, create_job_queue, ENGINES, \
+    ConcurrencyController, WorkerPool, JobQueue, Progress, periodically, \
+    patch_engine
+from cnsipo.client import init_client, get_client
+from cnsipo.proxy import ProxyPool, load_proxies
+from cnsipo.metrics import exporting, export_pool
+from cnsipo.logs import add_logging_options, setup_logging
+from cnsipo.profiler import add_profile_options, start_profiling
+from cnsipo.shared import get_logger, ContentError, FORGIVEN_ERROR, \
+    CRAWL_COUNTERS, CIRCUIT_BREAKER, BASE_URL, METRICS
 
-URL = 'http://epub.sipo.gov.cn/patentoutline.action'
+URL = BASE_URL + '/patentoutline.action'
 DELAY = 3
 RETRIES = 1000
 PAGE_SIZE = 20
 KINDS = ['fmgb', 'fmsq', 'syxx', 'wgsq']
+WINDOWS = ['year', 'month', 'day']
+MAX_PAGES = 500
 
 logger = get_logger()
 
 
-@retry(FORGIVEN_ERROR, tries=RETRIES, delay=2*DELAY, backoff=2, logger=logger)
-def init_params(year, kind, input_dir):
+@retry(FORGIVEN_ERROR, tries=RETRIES, delay=2*DELAY, backoff=2, logger=logger,
+       counters=CRAWL_COUNTERS, breaker=CIRCUIT_BREAKER)
+def init_params(year, kind, input_dir, window=None):
     if not os.path.isdir(input_dir):
         os.makedirs(input_dir)
-    logger.info("init with year: {}, kind: {}".format(year, kind))
+    label, first, last = window or (year, year, year)
+    logger.info("init with year: {}, kind: {}, window: {}".format(
+        year, kind, label))
 
     params = {
         'showType': 0,
         'selected': kind,
         'pageSize': PAGE_SIZE,
         'numSortMethod': 0,
-        'strWord': "申请日=BETWEEN['{0}','{0}']".format(year),
+        'strWord': "申请日=BETWEEN['{}','{}']".format(first, last),
         'pageNow': 1,
     }
     if kind == 'syxx':  # ugly, huh?
         params['selected'] = "xxsq"
     params["num" + kind.upper()] = 0  # important
     try:
-        input_file = "{}/{}-{}.html".format(input_dir, kind, year)
+        input_file = "{}/{}-{}.html".format(input_dir, kind, label)
         if os.path.exists(input_file):
             logger.debug("retreiving page from cache file: {}".format(
                 input_file))
         else:
             logger.debug("retreiving page from web and write to: {}".format(
                 input_file))
-            resp = requests.post(URL, params=params)
+            resp = get_client().post(URL, params=params)
             with open(input_file, 'w') as f:
                 for chunk in resp.iter_content(65536):
                     f.write(chunk)
@@ -64,7 +78,9 @@ def init_params(year, kind, input_dir):
                 pages += 1
             return params, pages
     except KeyError:
-        logger.warn("an error page for year: {}, kind: {}".format(year, kind))
+        logger.warn("an error page for year: {}, kind: {}, window: {}".format(
+            year, kind, label))
+        get_client().report_error()
         raise ContentError("key error")
     except FORGIVEN_ERROR as e:
         logger.debug("FAIL(may retry) with the year: {}, kind: {}({})".format(
@@ -79,32 +95,38 @@ def init_params(year, kind, input_dir):
         raise
 
 
-@retry(FORGIVEN_ERROR, tries=RETRIES, delay=DELAY, backoff=1, logger=logger)
-def query(params, year, page_now, dirname, timeout=5, dry_run=False):
+@retry(FORGIVEN_ERROR, tries=RETRIES, delay=DELAY, backoff=1, logger=logger,
+       counters=CRAWL_COUNTERS, breaker=CIRCUIT_BREAKER)
+def query(params, year, page_now, dirname, timeout=5, dry_run=False,
+          label=None):
     params = dict(params)
     params['pageNow'] = page_now
     dirname = "{}/{}".format(dirname, year)
     if not os.path.isdir(dirname):
         os.makedirs(dirname)
-    output_file = os.path.join(dirname, str(page_now))
+    output_file = os.path.join(dirname, "{}-{}".format(label, page_now)
+                               if label else str(page_now))
     if os.path.exists(output_file):
-        logger.debug("SKIP with year: {}, page_now: {}".format(year, page_now))
+        logger.debug("SKIP with year: %s, page_now: %s", year, page_now)
+        METRICS.incr('skipped')
         return
 
-    logger.debug("doing with year: {}, page_now: {}".format(year, page_now))
+    logger.debug("doing with year: %s, page_now: %s", year, page_now)
     if dry_run:
         return
 
     try:
-        resp = requests.post(URL, params=params, timeout=timeout)
+        resp = get_client().post(URL, params=params, timeout=timeout)
         if resp.status_code != requests.codes.ok:
             raise Exception("bad status code: {}".format(resp.status_code))
 
-        with open(output_file, 'w') as f:
-            for patent_id in set(
-                    re.findall("javascript:zl_xm\('([^']*)'", resp.text)):
+        with METRICS.timer('parse_seconds'):
+            patent_ids = set(
+                re.findall("javascript:zl_xm\('([^']*)'", resp.text))
+        with METRICS.timer('write_seconds'), open(output_file, 'w') as f:
+            for patent_id in patent_ids:
                 f.write("{}\n".format(patent_id))
-        logger.info("DONE with year: {}, page#: {}".format(year, page_now))
+        logger.info("DONE with year: %s, page#: %s", year, page_now)
     except FORGIVEN_ERROR as e:
         logger.debug("FAIL(may retry) with the year: {}, page#: {}({})".format(
             year, page_now, e))
@@ -118,54 +140,302 @@ def query(params, year, page_now, dirname, timeout=5, dry_run=False):
         raise
 
 
+def date_windows(label):
+    """Return the windows(label, first day, last day) dividing the window
+    labeled "YYYY"(into months) or "YYYY.MM"(into days)
+    """
+    dates = [int(i) for i in label.split(".")]
+    if len(dates) == 1:
+        return [("{}.{:02d}".format(dates[0], month),
+                 "{}.{:02d}.01".format(dates[0], month),
+                 "{}.{:02d}.{:02d}".format(
+                     dates[0], month, calendar.monthrange(dates[0], month)[1]))
+                for month in range(1, 13)]
+    if len(dates) == 2:
+        return [("{}.{:02d}.{:02d}".format(dates[0], dates[1], day),) * 3
+                for day in range(1, calendar.monthrange(*dates)[1] + 1)]
+    return []
+
+
+def year_windows(year, window):
+    """Return the windows of the year in the granularity(one of `WINDOWS`)
+    """
+    windows = [(str(year), ) * 3]
+    for _ in range(WINDOWS.index(window)):
+        windows = [w for label, _, _ in windows for w in date_windows(label)]
+    return windows
+
+
+def init_windows(year, kind, input_dir, window, threads, max_pages=MAX_PAGES):
+    """Initialize the windows of the year concurrently, a window with more
+    than `max_pages`(unless None) pages is divided into smaller ones if
+    possible.
+    Return a list of (window, params, pages) in the order of windows, or
+    raise the first error after all the windows are tried.
+    """
+    results, errors = {}, []
+
+    def init(window):
+        try:
+            results[window] = init_params(year, kind, input_dir, window)
+        except Exception as e:
+            logger.error("FAIL to init the window: {}({})".format(
+                window[0], e))
+            errors.append(e)
+
+    windows = year_windows(year, window)
+    while windows:
+        job_queue = JobQueue(min(threads, len(windows)))
+        with threaded(job_queue):
+            for w in windows:
+                job_queue.add_task(init, w)
+        divided = []
+        for w in windows:
+            if w not in results or max_pages is None or \
+                    results[w][1] <= max_pages:
+                continue
+            sub_windows = date_windows(w[0])
+            if sub_windows:
+                logger.info("divide the window {}({} pages)".format(
+                    w[0], results.pop(w)[1]))
+                divided.extend(sub_windows)
+            else:
+                logger.warn("too many pages({}) in the window {}".format(
+                    results[w][1], w[0]))
+        windows = divided
+    if errors:  # or the pages of the window would be missed silently
+        raise errors[0]
+    return [(w, ) + results[w] for w in sorted(results)]
+
+
+def parse_range(s, lower, upper):
+    """Parse the comma separated numbers or ranges(e.g. "1,3-4") within
+    [lower, upper]
+    """
+    numbers = []
+    for part in s.split(","):
+        first, _, last = part.partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if not lower <= first <= last <= upper:
+            raise ValueError("bad range: {}".format(part))
+        numbers.extend(range(first, last + 1))
+    return numbers
+
+
+def init_pairs(pairs, input_dir, window, threads, max_pages=None):
+    """Initialize the (year, kind) pairs concurrently, return a dict of
+    pair -> list of (window, params, pages), or None if it failed
+    """
+    results = {}
+    inner_threads = max(1, threads / max(len(pairs), 1))
+
+    def init(pair):
+        try:
+            results[pair] = init_windows(pair[0], pair[1], input_dir,
+                                         window, inner_threads, max_pages)
+        except Exception as e:
+            logger.error("FAIL to init the year {} of kind {}({})".format(
+                pair[0], pair[1], e))
+            results[pair] = None
+
+    job_queue = JobQueue(min(threads, len(pairs)))
+    with threaded(job_queue):
+        for pair in pairs:
+            job_queue.add_task(init, pair)
+    return results
+
+
+def round_robin(iterables):
+    """Yield the items of the iterables in turn
+    """
+    iterators = [iter(it) for it in iterables]
+    while iterators:
+        for it in list(iterators):
+            try:
+                yield next(it)
+            except StopIteration:
+                iterators.remove(it)
+
+
+def page_tasks(progress, name, year, windows, dirname, timeout, dry_run):
+    """Yield the arguments of `query_page` for the pages of the windows
+    """
+    for label, params, start, end in windows:
+        for i in xrange(start, end + 1):
+            yield (progress, name, params, year, i, dirname, timeout,
+                   dry_run, label)
+
+
+def query_page(progress, pair, *args, **kwargs):
+    """Query a page of the (year, kind) pair and count it in the progress
+    """
+    query(*args, **kwargs)
+    progress.incr(pair)
+
+
 def main(argv=None):
-    usage = "usage: %prog [options] year"
+    usage = "usage: %prog [options] year1[-year2] [year3[-year4] ...]"
     parser = OptionParser(usage)
 
-    parser.add_option("-k", "--kind", dest="kind", type="int", default="1",
-                      help="patent type(1-4)")
+    parser.add_option("-k", "--kind", dest="kind", default="1",
+                      help="patent type(s)(1-4), e.g. 1 or 1,3 or 1-4")
     parser.add_option("-i", "--input-dir", dest="input_dir", default="input",
                       help="input directory(save downloaded pages)")
     parser.add_option("-o", "--output-dir",
                       dest="output_dir", default="output",
                       help="output directory")
     parser.add_option("-t", "--threads", dest="threads", default="20",
-                      help="number of threads")
+                      help="number of threads(or concurrent tasks)")
+    parser.add_option("-E", "--engine", dest="engine", default=ENGINES[0],
+                      help="fetch engine: {}".format("|".join(ENGINES)))
+    parser.add_option("-P", "--pool-size", dest="pool_size",
+                      help="number of kept-alive connections"
+                      "(default: number of threads)")
+    parser.add_option("-q", "--queue-size", dest="queue_size", default="1000",
+                      help="max number of queued tasks(0: unbounded)")
     parser.add_option("-T", "--timeout", dest="timeout", default="5",
-                      help="connection timeout")
+                      help="connection timeout(initial one if adaptive)")
+    parser.add_option("-A", "--adaptive", action="store_true",
+                      dest="adaptive",
+                      help="adapt concurrency(up to the number of threads) "
+                      "and timeout to the server's latency and errors")
+    parser.add_option("-R", "--report-interval", dest="report_interval",
+                      default="60",
+                      help="interval(in seconds) of reporting progress")
+    parser.add_option("-b", "--breaker-threshold", dest="breaker_threshold",
+                      default="20",
+                      help="number of consecutive failures to pause all "
+                      "the requests(0: never)")
+    parser.add_option("-B", "--breaker-cooldown", dest="breaker_cooldown",
+                      default="30",
+                      help="seconds to pause before probing the server")
+    parser.add_option("-w", "--window", dest="window", default=WINDOWS[0],
+                      help="query window: {}(month or day: query and page "
+                      "through each window of the year on its own)".format(
+                          "|".join(WINDOWS)))
+    parser.add_option("-M", "--max-pages", dest="max_pages",
+                      default=str(MAX_PAGES),
+                      help="max pages of a window before it's divided into "
+                      "smaller ones(with month or day window)")
+    parser.add_option("-X", "--proxy-file", dest="proxy_file",
+                      help="file of the proxies to spread the requests "
+                      "over(one URL per line)")
+    parser.add_option("-L", "--proxy-rate", dest="proxy_rate", default="0",
+                      help="maximum requests per second through each "
+                      "proxy(0: unlimited)")
+    parser.add_option("--metrics-file", dest="metrics_file",
+                      help="file to write the metrics to(in the Prometheus "
+                      "text format) every report interval")
+    parser.add_option("--metrics-port", dest="metrics_port", type="int",
+                      help="port to serve the metrics at(/metrics) on "
+                      "localhost")
     parser.add_option("-s", "--start", dest="start", default="1",
-                      help="start page")
+                      help="start page(with year window)")
     parser.add_option("-e", "--end", dest="end", default="-1",
-                      help="end page")
+                      help="end page(with year window)")
     parser.add_option("-n", "--dry-run", action="store_true", dest="dry_run",
                       help="show what would have been done")
+    add_logging_options(parser)
+    add_profile_options(parser)
     (options, args) = parser.parse_args(argv)
+    patch_engine(options.engine)  # before any thread or lock is created
     if len(args) == 0:
         parser.error("missing arguments")
+    setup_logging(logger, options)
+    start_profiling(options)
 
-    year = args[0]
     input_dir = options.input_dir
     output_dir = options.output_dir
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
     try:
-        kind = KINDS[options.kind - 1]
-    except:
-        parser.error("kind should be an integer between 1 and {}". format(
+        kinds = [KINDS[k - 1] for k in
+                 parse_range(options.kind, 1, len(KINDS))]
+    except ValueError:
+        parser.error("kind should be integers between 1 and {}". format(
             len(KINDS)))
+    try:
+        years = [str(y) for arg in args for y in parse_range(arg, 1, 9999)]
+    except ValueError:
+        parser.error("bad years: {}".format(" ".join(args)))
+
+    if options.engine not in ENGINES:
+        parser.error("engine should be one of {}".format(ENGINES))
+    if options.window not in WINDOWS:
+        parser.error("window should be one of {}".format(WINDOWS))
 
     dry_run = options.dry_run
     timeout = int(options.timeout)
-    params, pages = init_params(year, kind, input_dir)
-    start = int(options.start)
-    end = int(options.end)
-    if end < 0:
-        end = pages
-    job_queue = JobQueue(1 if dry_run else int(options.threads))
-    with threaded(job_queue):
-        for i in range(start, end + 1):
-            job_queue.add_task(query, params, year, i, dirname=output_dir,
-                               timeout=timeout, dry_run=dry_run)
+    threads = 1 if dry_run else int(options.threads)
+    job_queue = create_job_queue(options.engine, threads,
+                                 int(options.queue_size),
+                                 counters=CRAWL_COUNTERS, logger=logger,
+                                 report_interval=int(options.report_interval),
+                                 breaker=CIRCUIT_BREAKER)
+    CIRCUIT_BREAKER.configure(int(options.breaker_threshold),
+                              int(options.breaker_cooldown), logger=logger)
+    controller = None
+    if options.adaptive:
+        controller = ConcurrencyController(threads, initial=threads / 4,
+                                           logger=logger)
+    proxy_pool = None
+    if options.proxy_file:
+        proxy_pool = ProxyPool(load_proxies(options.proxy_file),
+                               float(options.proxy_rate), logger=logger)
+    init_client(pool_maxsize=int(options.pool_size or threads),
+                per_thread=options.engine == 'thread', controller=controller,
+                proxy_pool=proxy_pool, metrics=METRICS)
+    pairs = [(year, kind) for kind in kinds for year in years]
+    by_year = options.window == WINDOWS[0]
+    results = init_pairs(pairs, input_dir, options.window, threads,
+                         None if by_year else int(options.max_pages))
+    failed = [pair for pair in pairs if results[pair] is None]
+    progress = Progress()
+    pair_tasks = []
+    for year, kind in pairs:
+        if (year, kind) in failed:
+            continue
+        name = "{}-{}".format(kind, year)
+        dirname = output_dir
+        if len(kinds) > 1:
+            dirname = os.path.join(output_dir, kind)
+        windows = []
+        for w, params, pages in results[(year, kind)]:
+            if by_year:
+                start = int(options.start)
+                end = pages if int(options.end) < 0 else int(options.end)
+                windows.append((None, params, start, end))
+            else:
+                windows.append((w[0], params, 1, pages))
+        total = sum(max(end - start + 1, 0) for _, _, start, end in windows)
+        progress.add(name, total)
+        logger.info("{}: {} windows with {} pages".format(
+            name, len(windows), total))
+        pair_tasks.append(page_tasks(progress, name, year, windows, dirname,
+                                     timeout, dry_run))
+
+    def report():
+        logger.info("progress: {}".format(progress))
+
+    if isinstance(job_queue, WorkerPool):
+        job_queue.handle_interrupt()
+        export_pool(METRICS, job_queue)
+    with periodically(report, int(options.report_interval)), \
+            exporting(METRICS, logger, int(options.report_interval),
+                      options.metrics_file, options.metrics_port):
+        with threaded(job_queue):
+            job_queue.add_tasks(query_page, round_robin(pair_tasks))
+    report()
+    if isinstance(job_queue, WorkerPool):
+        logger.info("pool stats: {}".format(job_queue.stats()))
+    logger.info("HTTP connections: {}".format(get_client().stats()))
+    if proxy_pool:
+        logger.info("proxies: {}".format(proxy_pool.stats()))
+    if failed:
+        logger.error("INCOMPLETE, FAIL to init: {}".format(", ".join(
+            "{}-{}".format(kind, year) for year, kind in failed)))
+        return 1
     return 0
 
 
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+"""
+Merge the patent ID's of pages into unique(and sharded) ID files
+"""
+
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict
+from optparse import OptionParser
+
+from cnsipo.shared import get_logger
+from cnsipo.utils import Counters, shard_ring
+
+CHUNK_SIZE = 1000000  # number of ID's sorted in memory at a time
+
+logger = get_logger()
+
+
+def read_page_ids(dirname):
+    """Yield the ID's in the page files of the directory
+    """
+    for filename in sorted(os.listdir(dirname)):
+        with open(os.path.join(dirname, filename)) as f:
+            for line in f:
+                patent_id = line.strip()
+                if patent_id:
+                    yield patent_id
+
+
+def sorted_runs(ids, tmp_dir, chunk_size=CHUNK_SIZE):
+    """Sort the ID's into runs of at most `chunk_size` ID's, return the
+    run files
+    """
+    runs = []
+    chunk = []
+    for patent_id in ids:
+        chunk.append(patent_id)
+        if len(chunk) >= chunk_size:
+            runs.append(_write_run(sorted(chunk), tmp_dir))
+            chunk = []
+    if chunk:
+        runs.append(_write_run(sorted(chunk), tmp_dir))
+    return runs
+
+
+def _write_run(sorted_ids, tmp_dir):
+    fd, run = tempfile.mkstemp(prefix="run-", dir=tmp_dir)
+    with os.fdopen(fd, 'w') as f:
+        for patent_id in sorted_ids:
+            f.write(patent_id + "\n")
+    return run
+
+
+def read_lines(filename):
+    with open(filename) as f:
+        for line in f:
+            yield line.rstrip("\n")
+
+
+def unique(sorted_ids):
+    """Yield the unique ID's of the sorted ones
+    """
+    last = None
+    for patent_id in sorted_ids:
+        if patent_id != last:
+            yield patent_id
+            last = patent_id
+
+
+def merge_runs(runs):
+    """Yield the sorted unique ID's of the run files
+    """
+    return unique(heapq.merge(*[read_lines(run) for run in runs]))
+
+
+def difference(sorted_ids, sorted_excluded):
+    """Yield the sorted ID's which are not in the sorted excluded ones
+    """
+    excluded = iter(sorted_excluded)
+    last = next(excluded, None)
+    for patent_id in sorted_ids:
+        while last is not None and last < patent_id:
+            last = next(excluded, None)
+        if patent_id != last:
+            yield patent_id
+
+
+class IdWriter(object):
+    """A writer of an ID file and its shards(`shards` > 0), the i-th shard
+    file is `{dirname}/shard-{i}/{name}`
+    """
+
+    def __init__(self, dirname, name, shards=0, counters=None):
+        self.shards = shards
+        self.counters = counters
+        self._ring = shard_ring(shards) if shards else None
+        self._files = []
+        self._fp = self._open(dirname, name)
+        for i in range(shards):
+            self._files.append(self._open(
+                os.path.join(dirname, "shard-{}".format(i)), name))
+
+    def _open(self, dirname, name):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        return open(os.path.join(dirname, name), 'w')
+
+    def write(self, patent_id):
+        line = patent_id + "\n"
+        self._fp.write(line)
+        if self.shards:
+            shard = self._ring.node_of(patent_id)
+            self._files[shard].write(line)
+            if self.counters:
+                self.counters.incr("shard-{}".format(shard))
+
+    def close(self):
+        for fp in [self._fp] + self._files:
+            fp.close()
+
+
+def merge_ids(sources, output_dir, year, shards=0, cross_kind=False,
+              chunk_size=CHUNK_SIZE, tmp_dir=None):
+    """Merge the ID's of the year in the sources(an ordered dict of
+    kind -> list of directories) into sorted unique ones in
+    `{output_dir}/{year}`, or `{output_dir}/{kind}/{year}` if `cross_kind`
+    is true, in which case an ID is kept only in the first kind listing it.
+
+    Return the counters of each kind(read, unique, cross-kind duplicates
+    and written) and each shard.
+    """
+    counters = OrderedDict()
+    tmp_dir = tempfile.mkdtemp(prefix="merge-", dir=tmp_dir)
+    try:
+        kind_runs = OrderedDict()
+        for kind, dirnames in sources.items():
+            counters[kind] = c = Counters()
+            runs = []
+            for dirname in dirnames:
+                ids = read_page_ids(dirname)
+                runs.extend(sorted_runs(_counted(ids, c, 'read'), tmp_dir,
+                                        chunk_size))
+            # merged into one run to be read by the later kinds
+            kind_runs[kind] = [_write_run(
+                _counted(merge_runs(runs), c, 'unique'), tmp_dir)]
+            for run in runs:
+                os.remove(run)
+            logger.debug("{}: {} ID's in {} runs".format(
+                kind, c.get('read'), len(runs)))
+
+        if not cross_kind:  # all the kinds together
+            all_runs = [r for rs in kind_runs.values() for r in rs]
+            counters['all'] = c = Counters()
+            _write_ids(merge_runs(all_runs), output_dir, year, shards, c)
+            return counters
+
+        for i, (kind, runs) in enumerate(kind_runs.items()):
+            earlier = [r for rs in kind_runs.values()[:i] for r in rs]
+            c = counters[kind]
+            ids = merge_runs(runs)
+            if earlier:
+                ids = difference(ids, merge_runs(earlier))
+            _write_ids(ids, os.path.join(output_dir, kind), year, shards, c)
+            c.incr('cross_kind_duplicates',
+                   c.get('unique') - c.get('written'))
+        return counters
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _counted(items, counters, name):
+    for item in items:
+        counters.incr(name)
+        yield item
+
+
+def _write_ids(ids, dirname, year, shards, counters):
+    writer = IdWriter(dirname, year, shards, counters)
+    try:
+        for patent_id in ids:
+            writer.write(patent_id)
+            counters.incr('written')
+    finally:
+        writer.close()
+
+
+def main(argv=None):
+    usage = "usage: %prog [options] output_dir id_dir1 [id_dir2 ...]"
+    parser = OptionParser(usage)
+    parser.add_option("-x", "--cross-kind", action="store_true",
+                      dest="cross_kind",
+                      help="dedupe across kinds(id_dir's are "
+                      "{kind}/{year}, and an ID is kept in the first kind "
+                      "listing it)")
+    parser.add_option("-N", "--shards", dest="shards", type="int",
+                      default="0",
+                      help="number of hash-partitioned shards to write "
+                      "in {output_dir}/shard-{i}")
+    parser.add_option("-c", "--chunk-size", dest="chunk_size", type="int",
+                      default=str(CHUNK_SIZE),
+                      help="number of ID's sorted in memory at a time")
+    parser.add_option("-T", "--tmp-dir", dest="tmp_dir",
+                      help="directory of temporary files")
+    (options, args) = parser.parse_args(argv)
+    if len(args) < 2:
+        parser.error("missing arguments")
+
+    output_dir = args[0]
+    years = OrderedDict()  # year -> kind -> directories
+    for dirname in args[1:]:
+        if not os.path.isdir(dirname):
+            parser.error("{} is not a directory".format(dirname))
+        dirname = os.path.normpath(dirname)
+        year = os.path.basename(dirname)
+        kind = os.path.basename(os.path.dirname(dirname))
+        years.setdefault(year, OrderedDict()).setdefault(kind, []).append(
+            dirname)
+
+    for year, sources in years.items():
+        print "merging year {}'s id files...".format(year)
+        counters = merge_ids(sources, output_dir, year, options.shards,
+                             options.cross_kind, options.chunk_size,
+                             options.tmp_dir)
+        for name, c in counters.items():
+            print "{}: {}".format(name, ", ".join(
+                "{}={}".format(k, v) for k, v in sorted(c.snapshot().items())))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -200,7 +200,7 @@ class PatentParser(object):
         if country is None and self.CN_ADDR_PATTERN.search(address):
             country = self.MAINLAND
 
-        logger.warn("unrecognized address: {}".format(address))
+        logger.warn("unrecognized address: %s", address)
         return country, None
 
     def parse_applicant(self, applicant):
@@ -244,7 +244,7 @@ class PatentParser(object):
         if self.ex_re3.search(applicant):
             return
 
-        logger.warn("unrecognized applicant: {}".format(applicant))
+        logger.warn("unrecognized applicant: %s", applicant)
 
     def parse_applicants(self, applicants, address=None, include_org=False):
         """Parse applicant(s) and return types and states pairs.
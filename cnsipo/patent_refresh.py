@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+"""
+Refresh the transactions of the patents most likely to have changed
+"""
+
+import heapq
+import json
+import os
+import sys
+import time
+from optparse import OptionParser
+
+import psycopg2
+
+from cnsipo.shared import get_logger, DETAIL_KINDS
+from cnsipo.store import open_store, STORE_LAYOUTS
+from cnsipo.manifest import Manifest, ANY_KIND
+from cnsipo.extractor import PARSERS, get_parser
+from cnsipo.patent_db import FIELDS, FIELDS_MAP, APP_NO, parse_data
+from cnsipo.patent_detail import query, transaction_params
+from cnsipo.client import init_client
+from cnsipo.utils import WorkerPool, threaded, Counters
+
+logger = get_logger()
+
+TRANSACTION = DETAIL_KINDS[1]
+# legal lifetimes(years) by the patent type, i.e. the 5th digit of app_no
+LIFETIMES = {'1': 20, '2': 10, '3': 10}
+DEFAULT_LIFETIME = 20
+# transaction types after which nothing is expected to happen
+FINAL_TYPES = ["终止", "撤回", "驳回", "放弃", "届满", "无效"]
+# transaction types of applications still under examination
+PENDING_TYPES = ["实质审查", "公布", "公开"]
+PENDING_WEIGHT = 2.0
+
+CANDIDATE_STMT = """SELECT d.app_no, d.app_date, t.pub_date, t.data_type
+    FROM {detail} d LEFT JOIN (
+        SELECT DISTINCT ON (app_no) app_no, pub_date, data_type
+        FROM {transaction} ORDER BY app_no, pub_date DESC, trans_id DESC
+    ) t ON t.app_no = d.app_no
+    WHERE extract(year from d.app_date) = {year};"""
+
+
+def _to_time(d):
+    if d is None:
+        return None
+    return time.mktime(d.timetuple())
+
+
+def score(app_no, app_date, last_date, last_type, fetched_at, now=None):
+    """Score how likely the transactions of the patent have changed since
+    they're last fetched(0 for a dead patent): the days since the last
+    fetch(or the last transaction if never fetched), weighted by the
+    remaining part of its lifetime and doubled while it's under
+    examination
+    """
+    now = now or time.time()
+    if last_type and any(t in last_type for t in FINAL_TYPES):
+        return 0.0
+    lifetime = LIFETIMES.get(app_no[4:5], DEFAULT_LIFETIME)
+    born = _to_time(app_date) or now
+    youth = 1 - (now - born) / (lifetime * 365.25 * 86400)
+    if youth <= 0:  # expired
+        return 0.0
+    since = fetched_at or _to_time(last_date) or born
+    result = max(now - since, 0) / 86400 * youth
+    if not last_type or any(t in last_type for t in PENDING_TYPES):
+        result *= PENDING_WEIGHT
+    return result
+
+
+def load_candidates(conn, detail_tbl, trans_tbl, year, batch_size=10000):
+    """Yield the (app_no, app_date, last_date, last_type) of the patents
+    applied in the year
+    """
+    stmt = CANDIDATE_STMT.format(detail=detail_tbl, transaction=trans_tbl,
+                                 year=int(year))
+    with conn.cursor() as cursor:
+        logger.debug("executing {}".format(stmt))
+        cursor.execute(stmt)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+
+def plan(candidates, manifest, budget, now=None):
+    """Return the [(score, year, app_no)] of at most `budget` patents of
+    the highest positive scores, `candidates` are (year, candidate) pairs
+    """
+    now = now or time.time()
+
+    def scored():
+        for year, (app_no, app_date, last_date, last_type) in candidates:
+            fetched_at = None
+            if manifest:
+                row = manifest.get(ANY_KIND, TRANSACTION, app_no)
+                fetched_at = row and row[4]
+            s = score(app_no, app_date, last_date, last_type, fetched_at,
+                      now)
+            if s > 0:
+                yield s, year, app_no
+
+    return heapq.nlargest(budget, scored())
+
+
+def refetch(selected, stores, parse, threads, timeout, manifest=None):
+    """Fetch the transactions of the selected patents(one request each),
+    return the app_no's fetched of each year
+    """
+    pool = WorkerPool(threads)
+    futures = []
+    with threaded(pool):
+        for _, year, app_no in selected:
+            view = manifest.view(ANY_KIND, TRANSACTION, year) \
+                if manifest else None
+            futures.append((year, app_no, pool.submit_keyed(
+                app_no, query.__wrapped__, transaction_params, parse, 0,
+                app_no, stores[year], timeout, 0, manifest=view,
+                detail_kind=TRANSACTION)))
+    fetched = {}
+    for year, app_no, future in futures:
+        if future.exception():
+            logger.warn("FAIL to refresh the patent: {}({})".format(
+                app_no, future.exception()))
+        else:
+            fetched.setdefault(year, []).append(app_no)
+    return fetched
+
+
+def update_db(conn, trans_tbl, store, app_nos, batch_size=1000):
+    """Replace the transactions of the patents with the fetched ones, return
+    the counters of updated patents, inserted and deleted rows
+    """
+    flds = FIELDS[1]
+    insert = "INSERT INTO {} ({}) VALUES ({});".format(
+        trans_tbl, ",".join(flds), ",".join(["%(" + i + ")s" for i in flds]))
+    delete = "DELETE FROM {} WHERE app_no = %s;".format(trans_tbl)
+    counters = Counters()
+    with conn.cursor() as cursor:
+        for i, app_no in enumerate(app_nos):
+            batch_vals = []
+            try:
+                for details in json.loads(store.get(app_no)):
+                    vals = parse_data(details, FIELDS_MAP[1], flds,
+                                      batch_vals)
+                    vals[APP_NO] = app_no
+            except (ValueError, KeyError) as e:
+                logger.error("{}({})".format(app_no, e))
+                counters.incr('failed')
+                continue
+            # NOTE: only the patent is rolled back on errors, not the
+            # uncommitted ones before it in the batch
+            cursor.execute("SAVEPOINT patent;")
+            try:
+                cursor.execute(delete, (app_no,))
+                deleted = cursor.rowcount
+                cursor.executemany(insert, batch_vals)
+            except psycopg2.DatabaseError as e:
+                logger.error("unexpected database error: {}({})".format(
+                    app_no, e))
+                cursor.execute("ROLLBACK TO SAVEPOINT patent;")
+                counters.incr('failed')
+                continue
+            cursor.execute("RELEASE SAVEPOINT patent;")
+            counters.incr('deleted', deleted)
+            counters.incr('inserted', len(batch_vals))
+            counters.incr('updated')
+            if (i + 1) % batch_size == 0:
+                conn.commit()
+        conn.commit()
+    return counters
+
+
+def refresh(conn, selected, years, trans_tbl, parse, manifest, options):
+    """Fetch the selected patents and update the database with them
+    """
+    stores = dict((year, open_store(
+        options.store, os.path.join(options.output_dir, year)))
+        for year in years)
+    init_client(pool_maxsize=options.threads)
+    fetched = refetch(selected, stores, parse, options.threads,
+                      options.timeout, manifest)
+    for year, app_nos in sorted(fetched.items()):
+        counters = update_db(conn, trans_tbl, stores[year], app_nos,
+                             int(options.batch_size))
+        print "year {}: {}".format(year, ", ".join(
+            "{}={}".format(k, v)
+            for k, v in sorted(counters.snapshot().items())))
+    for store in stores.values():
+        store.close()
+
+
+def main(argv=None):
+    usage = "usage: %prog [options] year1 [year2 ...]"
+    parser = OptionParser(usage)
+    import getpass
+    username = getpass.getuser()
+
+    parser.add_option("-d", "--database", dest="database", default="cnsipo",
+                      help="database name")
+    parser.add_option("-u", "--user", dest="user", default=username,
+                      help="database username")
+    parser.add_option("-p", "--password", dest="password",
+                      help="database password")
+    parser.add_option("-H", "--host", dest="host", default="localhost",
+                      help="database host")
+    parser.add_option("-t", "--patent_table",
+                      dest="patent_table_prefix", default="patent_",
+                      help="patent table's prefix")
+    parser.add_option("-M", "--manifest-file", dest="manifest_file",
+                      help="manifest file shared with patent_detail.py, "
+                      "which records when each patent's fetched")
+    parser.add_option("-B", "--budget", dest="budget", type="int",
+                      default="1000",
+                      help="maximum number of requests(patents) to refresh")
+    parser.add_option("-o", "--output-dir", dest="output_dir",
+                      default="output",
+                      help="output directory of the transactions")
+    parser.add_option("-S", "--store", dest="store", default=STORE_LAYOUTS[0],
+                      help="output layout: {}".format("|".join(STORE_LAYOUTS)))
+    parser.add_option("-P", "--parser", dest="parser", default=PARSERS[0],
+                      help="page parser: {}".format("|".join(PARSERS)))
+    parser.add_option("-c", "--threads", dest="threads", type="int",
+                      default="10", help="number of threads")
+    parser.add_option("-T", "--timeout", dest="timeout", type="int",
+                      default="30", help="timeout of a request")
+    parser.add_option("-b", "--batch-size", dest="batch_size", default="1000",
+                      help="number of patents updated in a transaction")
+    parser.add_option("-n", "--dry-run", action="store_true", dest="dry_run",
+                      help="only show the patents to refresh")
+    (options, args) = parser.parse_args(argv)
+    if len(args) == 0:
+        parser.error("missing arguments")
+    if options.store not in STORE_LAYOUTS:
+        parser.error("store should be one of {}".format(STORE_LAYOUTS))
+    try:
+        parse = get_parser(options.parser, TRANSACTION)
+    except ValueError:
+        parser.error("parser should be one of {}".format(PARSERS))
+
+    detail_tbl = options.patent_table_prefix + DETAIL_KINDS[0]
+    trans_tbl = options.patent_table_prefix + TRANSACTION
+    manifest = None
+    if options.manifest_file:
+        manifest = Manifest(options.manifest_file)
+
+    with psycopg2.connect(
+            "dbname='{}' user='{}' host='{}' password='{}'".format(
+                options.database, options.user,
+                options.host, options.password)) as conn:
+        candidates = ((year, c) for year in args for c in load_candidates(
+            conn, detail_tbl, trans_tbl, year))
+        selected = plan(candidates, manifest, options.budget)
+        print "{} patents to refresh".format(len(selected))
+        if options.dry_run:
+            for s, year, app_no in selected:
+                print "{}\t{}\t{:.1f}".format(year, app_no, s)
+        else:
+            refresh(conn, selected, args, trans_tbl, parse, manifest,
+                    options)
+    if manifest:
+        manifest.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
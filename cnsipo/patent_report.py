@@ -13,6 +13,7 @@ from optparse import OptionParser
 import psycopg2
 
 from cnsipo.shared import get_logger
+from cnsipo.profiler import add_profile_options, start_profiling
 
 logger = get_logger()
 
@@ -97,9 +98,11 @@ def main(argv=None):
     parser.add_option("-o", "--output-dir",
                       dest="output_dir", default="output",
                       help="output directory")
+    add_profile_options(parser)
     (options, args) = parser.parse_args(argv)
     if len(args) < 1:
         parser.error("missing arguments")
+    start_profiling(options)
 
     uig_tbl = options.patent_uig_tbl
     # detail_tbl = options.patent_detail_tbl
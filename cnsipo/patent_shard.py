@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shard patent ID's over machines and verify the shards' outputs
+"""
+
+import sys
+from optparse import OptionParser
+
+from cnsipo.shared import get_logger
+from cnsipo.store import open_store, STORE_LAYOUTS
+from cnsipo.utils import shard_ring
+
+logger = get_logger()
+
+
+def parse_shard(s):
+    """Parse a shard "i/N" into (i, N), where 0 <= i < N
+    """
+    index, _, count = s.partition("/")
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError("bad shard: {}".format(s))
+    return index, count
+
+
+def select_shard(ids, index, count):
+    """Yield the ID's in the shard
+    """
+    ring = shard_ring(count)
+    for patent_id in ids:
+        if ring.node_of(patent_id) == index:
+            yield patent_id
+
+
+def verify(ids, stores):
+    """Verify the outputs of all the shards(`stores` in the order of
+    shards) against the input ID's, return a dict of the expected, done,
+    missing, misplaced(in another shard) and duplicated(in more than one
+    shard) ID's of each shard
+    """
+    ring = shard_ring(len(stores))
+    keys = [set(store.keys()) for store in stores]
+    results = [dict(expected=0, done=0, missing=[], misplaced=[],
+                    duplicated=[]) for _ in stores]
+    for patent_id in ids:
+        index = ring.node_of(patent_id)
+        result = results[index]
+        result['expected'] += 1
+        found = [i for i, k in enumerate(keys) if patent_id in k]
+        if index in found:
+            result['done'] += 1
+        else:
+            result['missing'].append(patent_id)
+        for i in found:
+            if i != index:
+                results[i]['misplaced'].append(patent_id)
+        if len(found) > 1:
+            result['duplicated'].append(patent_id)
+    return results
+
+
+def main(argv=None):
+    usage = "usage: %prog [options] id_file output_dir0 [output_dir1 ...]"
+    parser = OptionParser(usage)
+    parser.add_option("-S", "--store", dest="store", default=STORE_LAYOUTS[0],
+                      help="output layout: {}".format("|".join(STORE_LAYOUTS)))
+    parser.add_option("-p", "--plan", action="store_true", dest="plan",
+                      help="only show the number of ID's of each shard")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose",
+                      help="list the missing, misplaced and duplicated ID's")
+    (options, args) = parser.parse_args(argv)
+    if len(args) < 2:
+        parser.error("missing arguments")
+    if options.store not in STORE_LAYOUTS:
+        parser.error("store should be one of {}".format(STORE_LAYOUTS))
+
+    with open(args[0]) as f:
+        ids = [line.strip() for line in f if line.strip()]
+    output_dirs = args[1:]
+    if options.plan:
+        ring = shard_ring(len(output_dirs))
+        counts = [0] * len(output_dirs)
+        for patent_id in ids:
+            counts[ring.node_of(patent_id)] += 1
+        for i, count in enumerate(counts):
+            print "shard {}/{}: {}".format(i, len(counts), count)
+        return 0
+
+    stores = [open_store(options.store, d, readonly=True)
+              for d in output_dirs]
+    results = verify(ids, stores)
+    for store in stores:
+        store.close()
+    ok = True
+    for i, result in enumerate(results):
+        print "shard {}/{}({}): expected={}, done={}, missing={}, " \
+            "misplaced={}, duplicated={}".format(
+                i, len(results), output_dirs[i], result['expected'],
+                result['done'], len(result['missing']),
+                len(result['misplaced']), len(result['duplicated']))
+        for name in ['missing', 'misplaced', 'duplicated']:
+            if result[name]:
+                ok = False
+                if options.verbose:
+                    print "  {}: {}".format(name, " ".join(result[name]))
+    print "OK" if ok else "INCOMPLETE"
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+Profile a run by cProfile and(optionally) by sampling the stacks of all
+the threads
+"""
+
+import atexit
+import cProfile
+import os
+import pstats
+import sys
+import thread
+import threading
+from collections import Counter
+
+TOP = 20  # number of the hot functions in the summary
+
+
+def frame_label(code):
+    return "{} ({}:{})".format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+class Sampler(object):
+    """A thread which samples the stacks of all the other threads every
+    `interval` seconds, which costs little to the sampled threads(unlike
+    cProfile, which traces the calls of its own thread only)
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        me = thread.get_ident()
+        while not self._stopped.wait(self.interval):
+            self.sample(me)
+
+    def sample(self, ignored=None):
+        for ident, frame in sys._current_frames().items():
+            if ident == ignored:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def stop(self):
+        if self._thread:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def write_collapsed(self, filename):
+        """Write the stacks in the collapsed format of FlameGraph(one
+        "frame;frame;... count" per line)
+        """
+        with open(filename, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("{} {}\n".format(stack, count))
+
+    def top(self, n=TOP):
+        """Return the (function, self samples, total samples) of the `n`
+        functions on top of the most sampled stacks
+        """
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for label in set(frames):
+                total[label] += count
+        return [(label, count, total[label])
+                for label, count in own.most_common(n)]
+
+
+class Profiler(object):
+    """Profile the run by cProfile(the calling thread) into
+    `{prefix}.pstats`, and by a `Sampler`(all the threads) into
+    `{prefix}.collapsed` if `interval` is positive
+    """
+
+    def __init__(self, prefix, interval=0, top=TOP, stream=sys.stderr):
+        self.prefix = prefix
+        self.top = top
+        self.stream = stream
+        self.profile = cProfile.Profile()
+        self.sampler = Sampler(interval) if interval > 0 else None
+        self._running = False
+
+    def start(self):
+        if self.sampler:
+            self.sampler.start()
+        self.profile.enable()
+        self._running = True
+        return self
+
+    def stop(self):
+        """Stop profiling, write the profiles and their summary
+        """
+        if not self._running:
+            return
+        self._running = False
+        self.profile.disable()
+        if self.sampler:
+            self.sampler.stop()
+        dirname = os.path.dirname(self.prefix)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.profile.dump_stats(self.prefix + ".pstats")
+        if self.sampler:
+            self.sampler.write_collapsed(self.prefix + ".collapsed")
+        self.summarize()
+
+    def summarize(self):
+        out = self.stream
+        out.write("profile written to {}.pstats\n".format(self.prefix))
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('tottime').print_stats(self.top)
+        if not self.sampler:
+            return
+        # of the thread samples, where idle threads are sampled waiting
+        samples = max(sum(self.sampler.stacks.values()), 1)
+        out.write("{} samples of all threads written to {}.collapsed, "
+                  "top functions(self% total% function):\n".format(
+                      self.sampler.samples, self.prefix))
+        for label, own, total in self.sampler.top(self.top):
+            out.write("{:>7.1f}{:>8.1f}  {}\n".format(
+                own * 100.0 / samples, total * 100.0 / samples, label))
+
+
+def add_profile_options(parser):
+    """Add the profiling options to the `OptionParser`
+    """
+    parser.add_option("--profile", dest="profile",
+                      help="profile the run by cProfile into "
+                      "{prefix}.pstats and summarize the hot functions at "
+                      "exit")
+    parser.add_option("--profile-interval", dest="profile_interval",
+                      type="float", default="0",
+                      help="also sample the stacks of all the threads every "
+                      "N milliseconds into {prefix}.collapsed(0: no "
+                      "sampling)")
+    parser.add_option("--profile-top", dest="profile_top", type="int",
+                      default=TOP,
+                      help="number of the hot functions in the summary")
+
+
+def start_profiling(options):
+    """Start profiling by the profiling options(see `add_profile_options`)
+    till exit, return the profiler(if any)
+    """
+    if not options.profile:
+        return None
+    profiler = Profiler(options.profile, options.profile_interval / 1000.0,
+                        options.profile_top)
+    atexit.register(profiler.stop)
+    return profiler.start()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+Egress proxy pool shared by the crawlers
+"""
+
+import time
+from threading import Condition
+
+from cnsipo.utils import TokenBucket
+
+
+class Proxy(object):
+    """A proxy with its own rate limit and health
+
+    `score` is the moving average of its successes(1 for a success and 0
+    for a failure), `failures` counts its consecutive failures, and
+    `reset_failures` keeps those reset by the last success in case its
+    content turns out to be an error(see `ProxyPool.report_error`).
+    """
+
+    def __init__(self, url, rate=0, burst=1):
+        self.url = url
+        self.proxies = {'http': url, 'https': url}
+        self.bucket = TokenBucket(rate, burst)
+        self.score = 1.0
+        self.failures = 0
+        self.reset_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0
+        self.in_flight = 0
+        self.last_used = 0
+        self.requests = 0
+        self.errors = 0
+
+    def __repr__(self):
+        return "Proxy({})".format(self.url)
+
+
+class ProxyPool(object):
+    """A pool of proxies which spreads the requests over them
+
+    Each request takes a token of a proxy(see `TokenBucket`): `acquire`
+    picks the available one of the fewest in-flight requests(then the best
+    score, then the least recently used), or waits for the earliest one.
+
+    After `max_failures` consecutive failures(errors reported by `release`
+    or `report_error`), a proxy is ejected for `cooldown` seconds(doubled
+    on each ejection up to `max_cooldown`), and then readmitted on
+    probation, i.e. ejected again by one more failure.
+
+    NOTE: as it allocates a lock, create it after monkey-patching(by the
+    'async' engine) if any.
+    """
+
+    def __init__(self, urls, rate=0, burst=1, max_failures=3, cooldown=30,
+                 max_cooldown=600, decay=0.1, logger=None):
+        if not urls:
+            raise ValueError("no proxies")
+        self.proxies = [Proxy(url, rate, burst) for url in urls]
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.decay = decay
+        self.logger = logger
+        self._cond = Condition()
+
+    def acquire(self):
+        """Block until a proxy is available and return it
+        """
+        with self._cond:
+            while True:
+                now = time.time()
+                admitted = [p for p in self.proxies
+                            if p.ejected_until <= now]
+                if admitted:
+                    proxy = min(admitted, key=lambda p: (
+                        p.bucket.wait_time(now), p.in_flight, -p.score,
+                        p.last_used))
+                    wait = proxy.bucket.wait_time(now)
+                    if wait <= 0:
+                        proxy.bucket.take(now)
+                        proxy.in_flight += 1
+                        proxy.last_used = now
+                        proxy.requests += 1
+                        return proxy
+                else:
+                    wait = min(p.ejected_until for p in self.proxies) - now
+                # NOTE: at most 1s so as to be interruptible
+                self._cond.wait(min(max(wait, 0.001), 1))
+
+    def release(self, proxy, failed=False):
+        """Release the proxy taken by `acquire` with the request's result
+        """
+        with self._cond:
+            proxy.in_flight -= 1
+            self._record(proxy, failed)
+            self._cond.notify_all()
+
+    def report_error(self, proxy):
+        """Report an error found in a response through the proxy(e.g. an
+        error page) after it's released, which undoes the reset of its
+        consecutive failures by that response
+        """
+        with self._cond:
+            proxy.failures = max(proxy.failures, proxy.reset_failures)
+            proxy.reset_failures = 0
+            self._record(proxy, True)
+
+    def _record(self, proxy, failed):
+        proxy.score += self.decay * ((0 if failed else 1) - proxy.score)
+        if not failed:
+            proxy.reset_failures, proxy.failures = proxy.failures, 0
+            return
+
+        proxy.errors += 1
+        proxy.failures += 1
+        if proxy.failures >= self.max_failures:
+            cooldown = min(self.cooldown * 2 ** proxy.ejections,
+                           self.max_cooldown)
+            proxy.ejections += 1
+            proxy.ejected_until = time.time() + cooldown
+            proxy.failures = self.max_failures - 1  # on probation
+            if self.logger:
+                self.logger.warn("proxy {} ejected for {}s(score: {:.2f})"
+                                 .format(proxy.url, cooldown, proxy.score))
+
+    def stats(self):
+        """Return a dict of proxy url -> its requests, errors, score and
+        ejections
+        """
+        with self._cond:
+            return dict((p.url, {'requests': p.requests, 'errors': p.errors,
+                                 'score': round(p.score, 3),
+                                 'ejections': p.ejections})
+                        for p in self.proxies)
+
+
+def load_proxies(filename):
+    """Read the proxy URL's(e.g. http://10.0.0.1:3128), one per line,
+    ignoring blank lines and comments
+    """
+    with open(filename) as f:
+        lines = [line.split("#", 1)[0].strip() for line in f]
+    return [line for line in lines if line]
@@ -6,7 +6,6 @@ Shared by all main scripts
 
 import os
 import sys
-import inspect
 import logging
 import logging.config
 import re
@@ -15,6 +14,8 @@ import ConfigParser
 
 import requests
 
+from cnsipo.utils import Counters, CircuitBreaker
+from cnsipo.metrics import Registry
 
 LOGGER_NAME = "patent"
 
@@ -26,8 +27,8 @@ def fallback_logger(stream=sys.stdout):
 
 
 def get_logger():
-    frame = inspect.stack()[1]
-    caller_file = inspect.getmodule(frame[0]).__file__
+    # the caller's frame only(`inspect.stack()` reads the source of all)
+    caller_file = sys._getframe(1).f_globals['__file__']
     main_name = re.search("(\w+)\.py", caller_file).group(1)
     log_conf_file = os.path.join(main_name + "-logging.conf")
     if not os.path.exists(log_conf_file):
@@ -59,3 +60,19 @@ FORGIVEN_ERROR = (requests.exceptions.HTTPError,
 
 
 DETAIL_KINDS = ['detail', 'transaction']
+
+# base URL of the site(e.g. that of a mock server by `cnsipo.mock_sipo`)
+BASE_URL = os.environ.get("CNSIPO_BASE_URL",
+                          "http://epub.sipo.gov.cn").rstrip("/")
+
+# counters shared by a crawler's retries and its worker pool
+CRAWL_COUNTERS = Counters()
+
+# metrics of a crawler(its requests, stages and worker pool), see
+# `cnsipo.metrics`
+METRICS = Registry()
+METRICS.add_counters(CRAWL_COUNTERS, 'tasks')
+
+# circuit breaker shared by a crawler's retries and its worker pool
+# (disabled until configured by the crawler)
+CIRCUIT_BREAKER = CircuitBreaker()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stores of fetched patent data
+"""
+
+import fcntl
+import os
+import re
+import struct
+import zlib
+from threading import Lock
+
+
+class DirStore(object):
+    """A store keeping each record in a file named by its key
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def size(self, key):
+        return os.path.getsize(self._path(key))
+
+    def get(self, key):
+        with open(self._path(key)) as f:
+            return f.read()
+
+    def put(self, key, data):
+        if not os.path.isdir(self.dirname):
+            try:
+                os.makedirs(self.dirname)
+            except OSError:  # created by another thread
+                if not os.path.isdir(self.dirname):
+                    raise
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def keys(self):
+        if not os.path.isdir(self.dirname):
+            return []
+        return [k for k in os.listdir(self.dirname)
+                if not k.endswith(".tmp")]
+
+    def scan(self):
+        """Yield all the (key, data) pairs
+        """
+        for key in self.keys():
+            yield key, self.get(key)
+
+    def close(self):
+        pass
+
+
+class SegmentStore(object):
+    """An append-only store packing records into large segment files
+
+    Each segment file(`seg-NNNNNN`) is a sequence of records, a record
+    consists of a header(magic, flags, key length, data length and CRC32)
+    followed by the key and the data, which is compressed by zlib if
+    `compress` is true. The index file maps each key to its latest record's
+    segment, offset, length and the original data size. A record is indexed
+    only after it is completely written, while a torn record(e.g. by a
+    crash) at a segment's end is truncated when the store is reopened, so a
+    write is either done or not at all.
+
+    A writer holds an exclusive lock of the directory(the lock file) till
+    it's closed, so another writer fails to open it. A `readonly` store
+    takes no lock and never changes the files, so it may read the records
+    written so far while a writer is appending to them.
+    """
+
+    MAGIC = 0xC5
+    HEADER = struct.Struct(">BBHII")
+    FLAG_COMPRESSED = 1
+    INDEX_FILE = "index"
+    LOCK_FILE = "lock"
+    SEGMENT_PATTERN = re.compile(r"^seg-(\d{6})$")
+
+    def __init__(self, dirname, compress=False, segment_size=256 << 20,
+                 readonly=False):
+        self.dirname = dirname
+        self.compress = compress
+        self.segment_size = segment_size
+        self.readonly = readonly
+        self._lock = Lock()
+        self._index = {}  # key -> (segment, offset, length, size)
+        self._readers = {}
+        self._lock_fp = self._index_fp = self._writer = None
+        self._segment = None
+        if readonly:
+            self._load()
+            return
+
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._lock_fp = open(os.path.join(dirname, self.LOCK_FILE), 'a')
+        try:
+            fcntl.flock(self._lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self._lock_fp.close()
+            raise IOError("{} is being written by another store".format(
+                dirname))
+        self._load()
+        self._index_fp = open(self._index_path(), 'a')
+        self._segment = max(self._segments() or [0])
+        self._writer = open(self._segment_path(self._segment), 'ab')
+
+    def _index_path(self):
+        return os.path.join(self.dirname, self.INDEX_FILE)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.dirname, "seg-{:06d}".format(segment))
+
+    def _segments(self):
+        if not os.path.isdir(self.dirname):  # a readonly store of nothing
+            return []
+        return sorted(int(m.group(1)) for m in (
+            self.SEGMENT_PATTERN.match(f) for f in os.listdir(self.dirname))
+            if m)
+
+    def _load(self):
+        """Load the index and recover the records missing from it(only in
+        memory if readonly)
+        """
+        ends = {}  # segment -> end of its last indexed record
+        if os.path.exists(self._index_path()):
+            with open(self._index_path(), 'r' if self.readonly else 'r+') \
+                    as f:
+                lines = f.read().split("\n")
+                if lines[-1] and not self.readonly:
+                    # torn line, which will be recovered below
+                    f.truncate(f.tell() - len(lines[-1]))
+                for line in lines[:-1]:
+                    fields = line.split()
+                    key = fields[0]
+                    segment, offset, length, size = map(int, fields[1:])
+                    self._index[key] = (segment, offset, length, size)
+                    ends[segment] = max(ends.get(segment, 0), offset + length)
+
+        recovered = []
+        for segment in self._segments():
+            path = self._segment_path(segment)
+            offset = ends.get(segment, 0)
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                for key, _, length, size in self._read_records(f):
+                    entry = (segment, offset, length, size)
+                    self._index[key] = entry
+                    recovered.append((key, entry))
+                    offset += length
+            if self.readonly:  # may be still being written
+                continue
+            if offset < os.path.getsize(path):  # torn record
+                with open(path, 'r+b') as f:
+                    f.truncate(offset)
+        if recovered and not self.readonly:
+            with open(self._index_path(), 'a') as f:
+                for key, entry in recovered:
+                    f.write(self._index_line(key, entry))
+
+    def _index_line(self, key, entry):
+        return "{}\t{}\t{}\t{}\t{}\n".format(key, *entry)
+
+    def _read_records(self, f):
+        """Yield (key, data, record length, data size) of the valid records
+        """
+        while True:
+            header = f.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                return
+            magic, flags, key_len, data_len, crc = self.HEADER.unpack(header)
+            if magic != self.MAGIC:
+                return
+            body = f.read(key_len + data_len)
+            if len(body) < key_len + data_len or \
+                    zlib.crc32(body) & 0xffffffff != crc:
+                return
+            key, data = body[:key_len], body[key_len:]
+            if flags & self.FLAG_COMPRESSED:
+                data = zlib.decompress(data)
+            yield key, data, self.HEADER.size + len(body), len(data)
+
+    def _read(self, segment, offset, length):
+        with self._lock:
+            if segment == self._segment:
+                self._writer.flush()
+            reader = self._readers.get(segment)
+            if reader is None:
+                reader = self._readers[segment] = open(
+                    self._segment_path(segment), 'rb')
+            reader.seek(offset)
+            return reader.read(length)
+
+    def exists(self, key):
+        return key in self._index
+
+    def size(self, key):
+        return self._index[key][3]
+
+    def keys(self):
+        return self._index.keys()
+
+    def get(self, key):
+        segment, offset, length, _ = self._index[key]
+        record = self._read(segment, offset, length)
+        flags, key_len = self.HEADER.unpack(record[:self.HEADER.size])[1:3]
+        data = record[self.HEADER.size + key_len:]
+        if flags & self.FLAG_COMPRESSED:
+            data = zlib.decompress(data)
+        return data
+
+    def put(self, key, data):
+        if self.readonly:
+            raise IOError("{} is opened readonly".format(self.dirname))
+        if not key or len(key) > 0xffff or key.split()[0] != key:
+            raise ValueError("bad key: {!r}".format(key))
+
+        size = len(data)
+        flags = 0
+        if self.compress:
+            data = zlib.compress(data)
+            flags |= self.FLAG_COMPRESSED
+        body = key + data
+        header = self.HEADER.pack(self.MAGIC, flags, len(key), len(data),
+                                  zlib.crc32(body) & 0xffffffff)
+        with self._lock:
+            offset = self._writer.tell()
+            if offset and offset + len(header) + len(body) > \
+                    self.segment_size:
+                self._writer.close()
+                self._segment += 1
+                self._writer = open(self._segment_path(self._segment), 'ab')
+                offset = 0
+            self._writer.write(header)
+            self._writer.write(body)
+            self._writer.flush()
+            entry = (self._segment, offset, len(header) + len(body), size)
+            self._index_fp.write(self._index_line(key, entry))
+            self._index_fp.flush()
+            self._index[key] = entry
+
+    def scan(self):
+        """Yield all the latest (key, data) pairs in the order of storage
+        """
+        entries = sorted((entry, key) for key, entry in self._index.items())
+        for (segment, offset, length, _), key in entries:
+            yield key, self.get(key)
+
+    def close(self):
+        with self._lock:
+            for fp in [self._writer, self._index_fp, self._lock_fp]:
+                if fp:
+                    fp.close()
+            self._writer = self._index_fp = self._lock_fp = None
+            for reader in self._readers.values():
+                reader.close()
+            self._readers = {}
+
+
+STORE_LAYOUTS = ['file', 'segment']
+
+
+def open_store(layout, dirname, readonly=False, **kwargs):
+    """Open a store in the given layout(one of `STORE_LAYOUTS`), only to
+    read it if `readonly`(e.g. while a crawl is writing it)
+    """
+    if layout == 'file':  # whose reads change nothing
+        return DirStore(dirname)
+    elif layout == 'segment':
+        return SegmentStore(dirname, readonly=readonly, **kwargs)
+    else:
+        raise ValueError("unknown store layout: {}".format(layout))
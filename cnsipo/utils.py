@@ -6,10 +6,16 @@ Universal utitlities
 
 import sys
 import time
-from functools import wraps
+import signal
+import hashlib
+import random
+import heapq
+import itertools
+import bisect
+from functools import wraps, partial
 from contextlib import contextmanager
-from Queue import Queue
-from threading import Thread
+from Queue import Queue, Full
+from threading import Thread, Condition, Event, Lock, BoundedSemaphore
 
 
 def apply_function(f, *args, **kwargs):
@@ -25,7 +31,8 @@ def apply_function(f, *args, **kwargs):
 
 
 def retry(forgivable_exceptions, forgive=lambda x: True,
-          tries=5, delay=5, backoff=2, logger=None):
+          tries=5, delay=5, backoff=2, logger=None, counters=None,
+          breaker=None):
     """Retry decorator with exponential backoff.
 
     `forgivable_exceptions` is a type of Exception(or Exception tuple)
@@ -37,6 +44,10 @@ def retry(forgivable_exceptions, forgive=lambda x: True,
     Furthermore, if the return value is a function, it will be invoked
     before the next try. This function takes the retried call's first
     argument(if any) as its argument(which is typically the calling object).
+    If `counters`(see `Counters`) is given, each retry increments its
+    'retried' counter. If `breaker`(see `CircuitBreaker`) is given, each
+    try waits for it to be closed and reports whether the try is forgivably
+    failed.
 
     Inspired by:
     http://www.saltycrane.com/blog/2009/11/trying-out-retry-decorator-python/
@@ -47,12 +58,26 @@ def retry(forgivable_exceptions, forgive=lambda x: True,
         if tries < 1:
             raise ValueError("tries must be at least 1")
 
+        def call(*args, **kwargs):
+            if not breaker:
+                return f(*args, **kwargs)
+
+            breaker.wait()
+            success = True
+            try:
+                return f(*args, **kwargs)
+            except forgivable_exceptions:
+                success = False
+                raise
+            finally:
+                breaker.record(success)
+
         @wraps(f)
         def wrapper(*args, **kwargs):
             mtries, mdelay = tries, delay
             while mtries > 1:
                 try:
-                    return f(*args, **kwargs)
+                    return call(*args, **kwargs)
                 except forgivable_exceptions as e:
                     forgiven = apply_function(forgive, e) or e
                     if isinstance(forgiven, BaseException):
@@ -66,24 +91,119 @@ def retry(forgivable_exceptions, forgive=lambda x: True,
                         logger.debug(msg)
                     else:
                         print msg
+                    if counters:
+                        counters.incr('retried')
                     time.sleep(mdelay)
                     mtries -= 1
                     mdelay *= backoff
                     if callable(forgiven):
                         forgiven(args[0] if len(args) else None)
-            return f(*args, **kwargs)  # last chance
+            return call(*args, **kwargs)  # last chance
 
+        wrapper.__wrapped__ = f  # so that callers can retry in their way
         return wrapper
 
     return decorator
 
 
+class CircuitBreaker(object):
+    """A circuit breaker shared by all the callers of a service
+
+    After `threshold` consecutive failures, the breaker opens and `wait`
+    blocks all the callers. Once `cooldown` seconds passed, one caller is let
+    through to probe the service: the breaker closes if the probe succeeds,
+    otherwise it opens again with a doubled cooldown(up to `max_cooldown`).
+    The breaker is disabled if `threshold` is 0.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=0, cooldown=30, max_cooldown=600,
+                 logger=None):
+        self.configure(threshold, cooldown, max_cooldown, logger)
+
+    def configure(self, threshold, cooldown=30, max_cooldown=600,
+                  logger=None):
+        """(Re)configure and reset the breaker
+
+        NOTE: as it allocates a lock, call it after monkey-patching(by the
+        'async' engine) if any.
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.logger = logger
+        self.state = self.CLOSED
+        self._failures = 0
+        self._open_until = 0
+        self._next_cooldown = cooldown
+        self._cond = Condition()
+
+    def wait(self):
+        """Block until the breaker is closed or the caller is the probe
+        """
+        if not self.threshold:
+            return
+
+        with self._cond:
+            while self.state != self.CLOSED:
+                if self.state == self.OPEN and \
+                        time.time() >= self._open_until:
+                    self.state = self.HALF_OPEN
+                    self._log("circuit half-open, probing...")
+                    return
+                timeout = 1  # NOTE: so as to be interruptible
+                if self.state == self.OPEN:
+                    timeout = min(self._open_until - time.time(), timeout)
+                self._cond.wait(max(timeout, 0.01))
+
+    def record(self, success):
+        """Record a call's result
+        """
+        if not self.threshold:
+            return
+
+        with self._cond:
+            if success:
+                self._failures = 0
+                if self.state != self.CLOSED:
+                    self.state = self.CLOSED
+                    self._next_cooldown = self.cooldown
+                    self._log("circuit closed, resuming...")
+                    self._cond.notify_all()
+                return
+
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and
+                    self._failures >= self.threshold):
+                self.state = self.OPEN
+                self._open_until = time.time() + self._next_cooldown
+                self._log("circuit open after {} failures, pausing for {} "
+                          "seconds...".format(self._failures,
+                                              self._next_cooldown))
+                self._next_cooldown = min(self._next_cooldown * 2,
+                                          self.max_cooldown)
+                self._cond.notify_all()  # let the waiters reschedule
+
+    def _log(self, msg):
+        if self.logger:
+            self.logger.warn(msg)
+
+
 class JobQueue(object):
     """A threaded job queue
+
+    If `capacity` is positive, at most `capacity` tasks are queued and
+    `add_task` blocks until a worker takes one, so that the memory stays
+    flat however many tasks are fed.
     """
 
-    def __init__(self, threads):
+    def __init__(self, threads, capacity=0):
         self._threads = threads
+        self._capacity = capacity
         self._thread_enabled = threads > 1
         self._queue = None
 
@@ -99,7 +219,7 @@ class JobQueue(object):
         if self._queue:  # threads already created
             return
 
-        queue = self._queue = Queue()
+        queue = self._queue = Queue(self._capacity)
 
         def work():
             while True:
@@ -124,6 +244,815 @@ class JobQueue(object):
         else:
             func(*args, **kwargs)
 
+    def add_tasks(self, func, args_iter, key=None, **kwargs):
+        """Add tasks lazily from an iterable of positional argument tuples,
+        `kwargs` is passed to every task.
+
+        `key` is an optional function which maps a task's argument tuple to
+        the task's key(ignored unless the queue supports keyed tasks).
+        """
+        for args in args_iter:
+            self.add_task(func, *args, **kwargs)
+
+
+class Counters(object):
+    """Thread-safe named counters
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counts = {}
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    def get(self, name):
+        return self._counts.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class Future(object):
+    """The pending result of a task submitted to a `WorkerPool`
+    """
+
+    def __init__(self, key=None):
+        self.key = key
+        self.attempts = 0
+        self._done = Event()
+        self._result = None
+        self._exception = None
+        self._cancelled = False
+        self._callbacks = []
+        self._lock = Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("the task is not done yet")
+        if self._exception:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("the task is not done yet")
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def cancel(self):
+        self._cancelled = True
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+RETRY_MODES = ['sleep', 'defer']
+
+
+class RetryPolicy(object):
+    """How a `WorkerPool` retries the failed tasks
+
+    A task failed with any of `forgivable_exceptions` is retried after a
+    delay growing exponentially by `backoff`(capped by `max_delay`) and
+    randomized by `jitter`(a fraction of the delay), until it has been
+    attempted `tries` times.
+    """
+
+    def __init__(self, forgivable_exceptions, tries=5, delay=5, backoff=2,
+                 jitter=0.0, max_delay=None):
+        if tries < 1:
+            raise ValueError("tries must be at least 1")
+
+        self.forgivable_exceptions = forgivable_exceptions
+        self.tries = tries
+        self.delay = delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.max_delay = max_delay
+
+    def forgivable(self, e):
+        return isinstance(e, self.forgivable_exceptions)
+
+    def next_delay(self, attempts):
+        """Return the delay before the next try after `attempts` attempts
+        """
+        delay = self.delay * self.backoff ** (attempts - 1)
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(delay, 0)
+
+
+class DelayQueue(object):
+    """A thread-safe queue whose items are ordered by the time they are due
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = Condition()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put(self, item, delay=0):
+        with self._cond:
+            heapq.heappush(self._heap,
+                           (time.time() + delay, next(self._counter), item))
+            self._cond.notify()
+
+    def get(self):
+        """Remove and return the earliest item, blocking until it is due
+        """
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                wait = self._heap[0][0] - time.time()
+                if wait <= 0:
+                    return heapq.heappop(self._heap)[-1]
+                self._cond.wait(wait)
+
+    def clear(self):
+        """Remove and return all the items
+        """
+        with self._cond:
+            items = [item for _, _, item in sorted(self._heap)]
+            self._heap = []
+            return items
+
+
+class WorkerPool(JobQueue):
+    """A self-healing threaded worker pool
+
+    Unlike `JobQueue`, a task's exception never kills its worker: it is
+    logged and kept in the task's `Future`, and a worker killed by any other
+    way(e.g. `SystemExit`) is replaced at once. `counters`(see `Counters`)
+    keeps the numbers of succeeded, failed, cancelled and(if shared with
+    `retry`) retried tasks; `stats` also reports the in-flight tasks and the
+    throughput, which are logged every `report_interval` seconds if given.
+
+    `shutdown` stops accepting new tasks, then the queued tasks are either
+    drained(i.e. still run) or cancelled and passed(as their futures) to
+    `on_cancel`, which typically checkpoints them by their keys. So are the
+    tasks left unread by `add_tasks`, so the checkpoint covers the rest of
+    the input.
+
+    If `retry_policy`(see `RetryPolicy`) is given, instead of sleeping in
+    its worker, a failed task is put into a delay queue, from which it will
+    be queued again once its delay is over. A task failing too many times
+    is passed(as its future along with the exception) to `on_dead`, which
+    typically saves it to a dead-letter file.
+
+    If `breaker`(see `CircuitBreaker`) is given, no task is dispatched
+    while it is open, and with `retry_policy` each try reports whether it is
+    forgivably failed to it.
+
+    Tasks with the same key are coalesced: while a keyed task is in
+    flight(queued, running or delayed), submitting another one of the key
+    just returns the former's future, so they never run at the same time.
+    """
+
+    def __init__(self, threads, capacity=0, counters=None, on_cancel=None,
+                 logger=None, report_interval=None, retry_policy=None,
+                 on_dead=None, breaker=None):
+        super(WorkerPool, self).__init__(threads, capacity)
+        self.counters = counters or Counters()
+        self.on_cancel = on_cancel
+        self.logger = logger
+        self.report_interval = report_interval
+        self.retry_policy = retry_policy
+        self.on_dead = on_dead
+        self.breaker = breaker
+        self._delay_queue = DelayQueue() if retry_policy else None
+        self._retrying = 0
+        self._in_flight = 0
+        self._keyed = {}  # key -> future of the in-flight task
+        self._lock = Lock()
+        self._workers = 0
+        self._start_time = None
+        self._stopping = False
+        self._drain = True
+
+    def start(self):
+        if self._threads <= 1:
+            return
+
+        self._thread_enabled = True
+        if self._queue:
+            return
+
+        self._queue = Queue(self._capacity)
+        self._start_time = time.time()
+        for _ in range(self._threads):
+            self._spawn_worker()
+        if self.report_interval:
+            t = Thread(target=self._report)
+            t.daemon = True
+            t.start()
+        if self._delay_queue is not None:
+            t = Thread(target=self._schedule)
+            t.daemon = True
+            t.start()
+
+    def _spawn_worker(self):
+        with self._lock:
+            self._workers += 1
+        t = Thread(target=self._work)
+        t.daemon = True
+        t.start()
+
+    def _work(self):
+        queue = self._queue
+        try:
+            while True:
+                future, func, args, kwargs = queue.get()
+                try:
+                    self._run(future, func, args, kwargs)
+                finally:
+                    queue.task_done()
+        finally:  # only reached if the worker is killed
+            with self._lock:
+                self._workers -= 1
+            if self.logger:
+                self.logger.error("a worker died, spawning a new one")
+            self.counters.incr('healed')
+            self._spawn_worker()
+
+    def _run(self, future, func, args, kwargs):
+        if self._stopping and not self._drain:
+            self._cancel(future)
+            return
+
+        if self.breaker:
+            self.breaker.wait()
+        with self._lock:
+            self._in_flight += 1
+        future.attempts += 1
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self._record(e)
+            if self._defer(future, func, args, kwargs, e):
+                return
+            self.counters.incr('failed')
+            if self.logger:
+                self.logger.error("task {} failed: {}".format(
+                    future.key or func.__name__, e))
+            future.set_exception(e)
+        except BaseException as e:
+            self.counters.incr('failed')
+            future.set_exception(e)
+            raise
+        else:
+            self._record(None)
+            self.counters.incr('succeeded')
+            future.set_result(result)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _record(self, e):
+        if self.breaker and self.retry_policy:
+            self.breaker.record(e is None or
+                                not self.retry_policy.forgivable(e))
+
+    def _defer(self, future, func, args, kwargs, e):
+        """Put the failed task into the delay queue if it is retriable
+        """
+        policy = self.retry_policy
+        if not (policy and policy.forgivable(e)):
+            return False
+
+        if future.attempts >= policy.tries:
+            self.counters.incr('dead')
+            if self.on_dead:
+                self.on_dead(future, e)
+            return False
+
+        delay = policy.next_delay(future.attempts)
+        if self.logger:
+            self.logger.debug("task {} failed: {}. Retry in {:.1f} seconds"
+                              "...".format(future.key or func.__name__,
+                                           e, delay))
+        self.counters.incr('retried')
+        with self._lock:
+            self._retrying += 1
+        self._delay_queue.put((future, func, args, kwargs), delay)
+        return True
+
+    def _schedule(self):
+        while True:
+            task = self._delay_queue.get()
+            try:
+                if self._stopping and not self._drain:
+                    self._cancel(task[0])
+                else:
+                    self._put(task, cancellable=False)
+            finally:
+                with self._lock:
+                    self._retrying -= 1
+
+    def _cancel(self, future):
+        self.counters.incr('cancelled')
+        future.cancel()
+        if self.on_cancel:
+            self.on_cancel(future)
+
+    def _report(self):
+        while not self._stopping:
+            time.sleep(self.report_interval)
+            if self.logger:
+                self.logger.info("pool stats: {}".format(self.stats()))
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        for name in ('succeeded', 'failed', 'retried', 'cancelled'):
+            stats.setdefault(name, 0)
+        stats['in_flight'] = self._in_flight
+        stats['queued'] = self._queue.qsize() if self._queue else 0
+        stats['delayed'] = self._retrying
+        stats['workers'] = self._workers
+        elapsed = time.time() - (self._start_time or time.time())
+        stats['rate'] = round((stats['succeeded'] + stats['failed']) /
+                              elapsed, 2) if elapsed > 0 else 0.0
+        return stats
+
+    def submit(self, func, *args, **kwargs):
+        """Submit a task and return its `Future`
+        """
+        return self.submit_keyed(None, func, *args, **kwargs)
+
+    def submit_keyed(self, key, func, *args, **kwargs):
+        """Submit a task identified by `key` and return its `Future`
+        """
+        return self._submit(key, func, args, kwargs)
+
+    def _submit(self, key, func, args, kwargs, checkpoint=False):
+        """Submit a task, which is passed to `on_cancel` as well if
+        `checkpoint` and rejected by shutdown
+        """
+        future = Future(key)
+        if self._stopping:
+            if checkpoint:
+                self._cancel(future)
+            else:
+                future.cancel()
+            return future
+
+        if key is not None:
+            with self._lock:
+                in_flight = self._keyed.get(key)
+                if in_flight is None or in_flight.done():  # not forgotten yet
+                    in_flight = None
+                    self._keyed[key] = future
+            if in_flight is not None:
+                self.counters.incr('coalesced')
+                return in_flight
+            future.add_done_callback(self._forget)
+
+        if not (self._thread_enabled and self._queue):
+            self._run(future, func, args, kwargs)
+            while self._retrying:  # retry in place
+                task = self._delay_queue.get()
+                with self._lock:
+                    self._retrying -= 1
+                self._run(*task)
+            return future
+
+        if not self._put((future, func, args, kwargs)):
+            self._cancel(future)
+        return future
+
+    def _forget(self, future):
+        with self._lock:
+            if self._keyed.get(future.key) is future:
+                del self._keyed[future.key]
+
+    def _put(self, task, cancellable=True):
+        """Put the task into the queue unless cancelled by shutdown
+        """
+        while True:  # NOTE: a blocking put can't be interrupted by signals
+            try:
+                self._queue.put(task, timeout=0.5)
+                return True
+            except Full:
+                if cancellable and self._stopping:
+                    return False
+
+    def add_task(self, func, *args, **kwargs):
+        return self.submit(func, *args, **kwargs)
+
+    def add_tasks(self, func, args_iter, key=None, **kwargs):
+        for args in args_iter:
+            if self._stopping and (self._drain or not self.on_cancel):
+                break  # left unread
+            self._submit(key(args) if key else None, func, args, kwargs,
+                         checkpoint=True)
+
+    def finish(self):
+        queue = self._queue
+        if not queue:
+            return
+
+        # NOTE: a plain `join` can't be interrupted by signals
+        while queue.unfinished_tasks or self._retrying:
+            time.sleep(0.1)
+
+    def shutdown(self, drain=True):
+        """Stop accepting tasks, and drain or cancel the queued ones
+        """
+        self._drain = drain
+        self._stopping = True
+        if not drain and self._delay_queue is not None:
+            tasks = self._delay_queue.clear()
+            for task in tasks:
+                self._cancel(task[0])
+            with self._lock:
+                self._retrying -= len(tasks)
+
+    def handle_interrupt(self):
+        """Shut down(checkpointing the queued tasks if `on_cancel` is set,
+        otherwise draining them) on the first SIGINT, and abort on the next.
+        """
+
+        def handler(signum, frame):
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            if self.logger:
+                self.logger.warn("interrupted, {} the queued tasks(press "
+                                 "Ctrl-C again to abort)...".format(
+                                     "checkpointing" if self.on_cancel
+                                     else "draining"))
+            self.shutdown(drain=self.on_cancel is None)
+
+        signal.signal(signal.SIGINT, handler)
+
+
+class SyncWriter(object):
+    """A thread-safe line writer appending to a lazily opened file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fp = None
+        self._lock = Lock()
+
+    def write_line(self, line):
+        with self._lock:
+            if self._fp is None:
+                self._fp = open(self.filename, 'a')
+            self._fp.write("{}\n".format(line))
+            self._fp.flush()
+
+    def close(self):
+        with self._lock:
+            if self._fp:
+                self._fp.close()
+                self._fp = None
+
+
+class Progress(object):
+    """Thread-safe progress(done out of total) of named parts
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._names = []
+        self._totals = {}
+        self._done = {}
+
+    def add(self, name, total):
+        with self._lock:
+            if name not in self._totals:
+                self._names.append(name)
+                self._done[name] = 0
+            self._totals[name] = total
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._done[name] += n
+
+    def snapshot(self):
+        """Return a list of (name, done, total) in the order of addition
+        """
+        with self._lock:
+            return [(name, self._done[name], self._totals[name])
+                    for name in self._names]
+
+    def __str__(self):
+        return ", ".join("{}: {}/{}".format(*part)
+                         for part in self.snapshot())
+
+
+class ProcessStage(object):
+    """A process pool running CPU-bound `func` for the threads, which
+    keeps at most `capacity` inputs pending(`submit` blocks when it's full)
+
+    The result of each call is handed to the callback given to `submit`,
+    which runs in the pool's result thread, or returned by `call`, so
+    `func` should return errors as results rather than raise them.
+    """
+
+    def __init__(self, func, processes=None, capacity=100, logger=None):
+        from multiprocessing import Pool
+
+        self.func = func
+        self.logger = logger
+        self._slots = BoundedSemaphore(capacity)
+        self._pool = Pool(processes)
+
+    def submit(self, args, callback=None):
+        self._slots.acquire()
+        try:
+            self._pool.apply_async(self.func, args,
+                                   callback=partial(self._done, callback))
+        except Exception:
+            self._slots.release()
+            raise
+
+    def call(self, args):
+        """Call `func` in a process and wait for its result
+        """
+        with self._slots:
+            result = self._pool.apply_async(self.func, args)
+            while not result.ready():  # a plain `get` ignores signals
+                result.wait(0.5)
+            return result.get()
+
+    def _done(self, callback, result):
+        try:
+            if callback:
+                callback(result)
+        except Exception as e:  # otherwise the pool's result thread dies
+            if self.logger:
+                self.logger.error("result callback error: {}".format(e))
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Wait for all the submitted calls to be done
+        """
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+class AsyncJobQueue(JobQueue):
+    """A job queue whose tasks run as greenlets on a single event loop
+
+    It requires `gevent` and the standard library to be monkey-patched(see
+    `patch_engine`), so that blocking calls(e.g. socket I/O, sleep)
+    inside the tasks yield to each other instead of blocking the loop.
+    """
+
+    def __init__(self, threads, capacity=0):
+        # the pool itself bounds the number of pending tasks
+        super(AsyncJobQueue, self).__init__(threads, capacity)
+        self._pool = None
+
+    def start(self):
+        if self._threads <= 1:
+            return
+
+        self._thread_enabled = True
+        if self._pool is not None:  # an empty gevent pool is falsy
+            return
+
+        from gevent.pool import Pool
+        self._pool = Pool(self._threads)
+
+    def finish(self):
+        if self._pool is not None:
+            self._pool.join()
+
+    def add_task(self, func, *args, **kwargs):
+        if self._thread_enabled and self._pool is not None:
+            # block the producer until a slot is free
+            self._pool.spawn(func, *args, **kwargs)
+        else:
+            func(*args, **kwargs)
+
+
+ENGINES = ['thread', 'async']
+
+
+def patch_engine(engine):
+    """Prepare the process for the given engine(one of `ENGINES`), which
+    must be done first in `main`, before any thread or lock is created
+
+    NOTE: the 'async' engine monkey-patches the standard library with gevent,
+    which affects the whole process; the threads and locks created earlier
+    aren't patched, which gevent doesn't support.
+    """
+    if engine == 'async':
+        from gevent import monkey
+        monkey.patch_all()
+
+
+def create_job_queue(engine, threads, capacity=0, **kwargs):
+    """Create a job queue running on the given engine(one of `ENGINES`),
+    see `patch_engine`
+
+    The 'thread' engine creates a `WorkerPool` which takes `kwargs` as its
+    extra arguments, while they are ignored by the 'async' engine.
+    """
+    if engine == 'thread':
+        return WorkerPool(threads, capacity, **kwargs)
+    elif engine == 'async':
+        return AsyncJobQueue(threads, capacity)
+    else:
+        raise ValueError("unknown engine: {}".format(engine))
+
+
+def percentile(sorted_values, p):
+    """Return the p-th(0-100) percentile of the sorted values
+    """
+    if not sorted_values:
+        return None
+    index = int(round((len(sorted_values) - 1) * p / 100.0))
+    return sorted_values[index]
+
+
+class ConcurrencyController(object):
+    """An AIMD(additive increase/multiplicative decrease) concurrency limiter
+
+    Callers wrap each request with `acquire` and `release`, the latter
+    reports the request's latency and whether it failed. After every
+    `window` samples, the limit of in-flight requests is cut by `decrease`
+    if the error rate exceeds `max_error_rate` or the p90 latency exceeds
+    `latency_factor` times the best p50 latency seen so far, otherwise it
+    is raised by `increase`. The observed latencies also decide the
+    per-request timeout(see `timeout`).
+    """
+
+    def __init__(self, max_limit, min_limit=1, initial=None, window=50,
+                 max_error_rate=0.1, latency_factor=3.0, decrease=0.5,
+                 increase=1, timeout_factor=3.0, min_timeout=1,
+                 max_timeout=60, logger=None):
+        if max_limit < min_limit or min_limit < 1:
+            raise ValueError("bad concurrency limits: [{}, {}]".format(
+                min_limit, max_limit))
+
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.latency_factor = latency_factor
+        self.decrease = decrease
+        self.increase = increase
+        self.timeout_factor = timeout_factor
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.logger = logger
+        self._limit = min(max(initial or min_limit, min_limit), max_limit)
+        self._in_flight = 0
+        self._latencies = []
+        self._errors = 0
+        self._base_latency = None
+        self._timeout = None
+        self._cond = Condition()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self):
+        with self._cond:
+            while self._in_flight >= self._limit:
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self, latency, failed=False):
+        with self._cond:
+            self._in_flight -= 1
+            self._record(latency, failed)
+            self._cond.notify_all()
+
+    def record_error(self):
+        """Record a failure detected after the request(e.g. an error page)
+        """
+        with self._cond:
+            self._record(None, True)
+            self._cond.notify_all()
+
+    def timeout(self, default=None):
+        """Return the timeout derived from the observed latencies
+        """
+        return self._timeout or default
+
+    def _record(self, latency, failed):
+        if failed:
+            self._errors += 1
+        else:
+            self._latencies.append(latency)
+        if self._errors + len(self._latencies) >= self.window:
+            self._adjust()
+
+    def _adjust(self):
+        latencies = sorted(self._latencies)
+        error_rate = float(self._errors) / (self._errors + len(latencies))
+        p50, p90, p99 = [percentile(latencies, p) for p in (50, 90, 99)]
+        if p50 is not None and (self._base_latency is None or
+                                p50 < self._base_latency):
+            self._base_latency = p50
+        if p99 is not None:
+            self._timeout = min(max(p99 * self.timeout_factor,
+                                    self.min_timeout), self.max_timeout)
+
+        old_limit = self._limit
+        if error_rate > self.max_error_rate or (
+                p90 is not None and
+                p90 > self._base_latency * self.latency_factor):
+            self._limit = max(int(self._limit * self.decrease),
+                              self.min_limit)
+        else:
+            self._limit = min(self._limit + self.increase, self.max_limit)
+        if self.logger:
+            self.logger.info(
+                "concurrency: {} -> {}(in-flight: {}, p50: {}, p90: {}, "
+                "error rate: {:.2f}, timeout: {})".format(
+                    old_limit, self._limit, self._in_flight,
+                    _format_seconds(p50), _format_seconds(p90), error_rate,
+                    _format_seconds(self._timeout)))
+        self._latencies = []
+        self._errors = 0
+
+
+class TokenBucket(object):
+    """A token bucket which allows `rate` events per second on average and
+    bursts of up to `burst` events(no limit if `rate` is 0)
+
+    It is not thread-safe, the caller guards it with its own lock.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self._tokens + (now - self._updated) *
+                               self.rate, self.burst)
+            self._updated = now
+
+    def wait_time(self, now=None):
+        """Return the seconds until a token is available
+        """
+        if not self.rate:
+            return 0
+        self._refill(now or time.time())
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self, now=None):
+        """Take a token(which may be borrowed from the future)
+        """
+        if self.rate:
+            self._refill(now or time.time())
+            self._tokens -= 1
+
+
+def _format_seconds(seconds):
+    return "-" if seconds is None else "{:.3f}s".format(seconds)
+
 
 @contextmanager
 def threaded(queue):
@@ -136,6 +1065,26 @@ def threaded(queue):
         queue.finish()
 
 
+@contextmanager
+def periodically(func, interval):
+    """Call `func` every `interval` seconds while running the block
+    """
+    stopped = Event()
+
+    def run():
+        while not stopped.wait(interval):
+            func()
+
+    t = Thread(target=run)
+    t.daemon = True
+    t.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        t.join()  # or it may be woken at the interpreter shutdown
+
+
 @contextmanager
 def uniform_open(filename=None, mode="w"):
     if mode == 'w':
@@ -165,3 +1114,37 @@ def trans_str(string, from_chars, to_chars, encoding='utf8'):
     trans_tbl = dict(zip(map(ord, from_unicode), map(ord, to_unicode)))
     str_unicode = string.decode(encoding)
     return str_unicode.translate(trans_tbl).encode(encoding)
+
+
+def stable_hash(key):
+    """A hash of the string which is stable across processes and machines
+    (unlike `hash`)
+    """
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """A consistent hash ring of the nodes, each of which is placed at
+    `replicas` points, so that the keys spread evenly over the nodes and
+    only about 1/N of them move when a node is added or removed
+    """
+
+    def __init__(self, nodes, replicas=256):
+        self.nodes = list(nodes)
+        points = sorted((stable_hash("{}#{}".format(node, i)), node)
+                        for node in self.nodes for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_of(self, key):
+        """The node of the key(the first one clockwise)
+        """
+        i = bisect.bisect(self._hashes, stable_hash(key))
+        return self._nodes[i % len(self._nodes)]
+
+
+def shard_ring(count):
+    """The ring of the shards 0 to `count` - 1, which partitions the ID's
+    for all the tools(i.e. the merged shards and the crawl shards agree)
+    """
+    return HashRing(range(count))
@@ -56,6 +56,10 @@ setup(name=PROJECT_NAME,
 
       packages=PACKAGES,
       install_requires=REQUIRES,
+      extras_require={
+          'async': ['gevent>=1.0'],
+          'lxml': ['lxml>=3.0'],
+      },
       tests_require=[
           'pytest',
           'pytest-cov',
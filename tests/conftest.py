@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""
+Helpers shared by the tests.
+"""
+
+import io
+import os
+
+import pytest
+
+from cnsipo import patent_detail
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def fixture(name):
+    """The text of the fixture page
+    """
+    with io.open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def page(name):
+    """The fixture page as fetched(utf-8)
+    """
+    return fixture(name).encode('utf-8')
+
+
+class FakeClient(object):
+    """A client which serves the pages(utf-8) in order, or by the patent
+    ID's(the 'an' parameter of a transaction request) if a dict
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def post(self, url, params, timeout):
+        if isinstance(self.pages, dict):
+            text = self.pages[params['an']]
+        else:
+            text = self.pages.pop(0)
+
+        class Response(object):
+            pass
+        resp = Response()
+        resp.text = text.decode('utf-8')
+        return resp
+
+    def report_error(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    """Return a function which makes the crawlers query a `FakeClient` of
+    the pages
+    """
+    def install(pages):
+        client = FakeClient(pages)
+        monkeypatch.setattr(patent_detail, "get_client", lambda: client)
+        return client
+    return install
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test the pooled HTTP client.
+"""
+
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import pytest
+
+from cnsipo.client import HttpClient
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = "ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server_url():
+    server = ThreadedHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    yield "http://127.0.0.1:{}/".format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def test_connection_reuse(server_url):
+    client = HttpClient()
+    for _ in range(5):
+        assert client.post(server_url, params={'a': 1}).text == "ok"
+    stats = client.stats()
+    assert stats['requests'] == 5
+    assert stats['connections'] == 1
+    assert stats['reused'] == 4
+    client.close()
+
+
+def test_per_thread_sessions(server_url):
+    client = HttpClient(per_thread=True)
+    threads = [threading.Thread(target=client.post, args=(server_url,))
+               for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert client.stats()['sessions'] == 3
+
+    shared_client = HttpClient(per_thread=False)
+    shared_client.post(server_url)
+    shared_client.post(server_url)
+    assert shared_client.stats()['sessions'] == 1
+    client.close()
+    shared_client.close()
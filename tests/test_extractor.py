@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test extractor.
+"""
+
+import pytest
+
+from cnsipo.extractor import PARSERS, get_parser, is_error_page
+
+from conftest import fixture
+
+
+def parser(name, detail_kind):
+    if name == 'lxml':
+        pytest.importorskip("lxml")
+    return get_parser(name, detail_kind)
+
+
+def test_is_error_page():
+    assert is_error_page(fixture("error.html"), 'detail')
+    assert is_error_page(fixture("error.html"), 'transaction')
+    assert not is_error_page(fixture("detail.html"), 'detail')
+    assert not is_error_page(fixture("transaction.html"), 'transaction')
+    # a valid page of another layout(e.g. 'wgsq' without the digest)
+    page = fixture("detail.html").replace("xm_jsh", "wg_jsh")
+    assert "xm_jsh" not in page
+    assert not is_error_page(page, 'detail')
+    assert is_error_page(u"<html><body>busy</body></html>", 'detail')
+
+
+def test_bs_detail():
+    details = get_parser('bs', 'detail')(fixture("detail.html"), 0)
+    assert len(details) == 11
+    assert details['申请号：'] == "2014100000011"
+    assert details['申请人：'] == "北京某某科技有限公司"
+    assert details['地址：'] == "100084\xc2\xa0北京市海淀区<中关村>"
+    assert details['代理人：'] == "王五 & 赵六"
+    assert details['摘要'] == "摘要：本发明公开了一种数据处理方法，" \
+        "包括：接收请求&返回结果。"
+
+
+def test_bs_transaction():
+    trans = get_parser('bs', 'transaction')(fixture("transaction.html"), 0)
+    assert [t['事务数据公告日：'] for t in trans] == \
+        ["2014.08.27", "2014.09.24", "2016.01.20"]
+    assert trans[1]['事务数据类型：'] == "实质审查的生效"
+
+
+@pytest.mark.parametrize("name", PARSERS)
+@pytest.mark.parametrize("detail_kind", ['detail', 'transaction'])
+def test_parity(name, detail_kind):
+    text = fixture(detail_kind + ".html")
+    assert parser(name, detail_kind)(text, 0) == \
+        get_parser('bs', detail_kind)(text, 0)
+
+
+@pytest.mark.parametrize("name", PARSERS)
+def test_bad_page(name):
+    text = fixture("transaction.html")
+    with pytest.raises(IndexError):
+        parser(name, 'detail')(text, 0)
+    no_digest = fixture("detail.html").replace("xm_jsh", "wg_jsh")
+    with pytest.raises(IndexError):
+        parser(name, 'detail')(no_digest, 0)
+    assert parser(name, 'transaction')(fixture("error.html"), 0) == []
+
+
+def test_unknown_parser():
+    with pytest.raises(ValueError):
+        get_parser('html5', 'detail')
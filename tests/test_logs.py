@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test logs.
+"""
+
+import logging
+import threading
+from optparse import OptionParser
+from Queue import Queue
+
+from cnsipo.logs import QueueHandler, QueueListener, RateLimitFilter, \
+    SampleFilter, enqueue_handlers, add_logging_options, setup_logging
+
+
+class ListHandler(logging.Handler):
+    def __init__(self, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.messages = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+        self.threads.add(threading.current_thread().name)
+
+
+def new_logger(name, *handlers):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    for handler in handlers:
+        logger.addHandler(handler)
+    return logger
+
+
+def test_enqueue_handlers():
+    info, debug = ListHandler(logging.INFO), ListHandler()
+    logger = new_logger("test_enqueue", info, debug)
+    listener = enqueue_handlers(logger)
+    assert enqueue_handlers(logger) is None  # already
+    assert [type(h) for h in logger.handlers] == [QueueHandler]
+    logger.debug("doing with patent: %s", "2014100000011")
+    logger.info("DONE with the patent: %s", "2014100000011")
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logger.exception("FAIL")
+    listener.stop()
+    assert info.messages[0] == "DONE with the patent: 2014100000011"
+    assert len(debug.messages) == 3
+    assert "ZeroDivisionError" in debug.messages[2]
+    assert threading.current_thread().name not in debug.threads
+
+
+def test_queue_full():
+    queue = Queue(2)
+    handler = QueueHandler(queue)
+    logger = new_logger("test_queue_full", handler)
+    for i in range(5):
+        logger.info("message %d", i)
+    assert handler.dropped == 3
+    target = ListHandler()
+    listener = QueueListener(queue, [target])
+    listener.start()
+    listener.stop()
+    assert target.messages == ["message 0", "message 1"]
+
+
+def test_queue_full_warning():
+    queue = Queue(1)
+    handler = QueueHandler(queue)
+    logger = new_logger("test_queue_full_warning", handler)
+    logger.info("message 0")
+    logger.info("message 1")
+    assert handler.dropped == 1
+    target = ListHandler()
+    listener = QueueListener(queue, [target])
+    writer = threading.Timer(0.1, listener.start)
+    writer.start()
+    logger.warning("warning")  # waits for the listener
+    logger.error("error")
+    writer.join()
+    listener.stop()
+    assert handler.dropped == 1
+    assert target.messages == ["message 0", "warning", "error"]
+
+
+def test_rate_limit_filter():
+    handler = ListHandler()
+    f = RateLimitFilter(0.001, burst=2)
+    handler.addFilter(f)
+    logger = new_logger("test_rate_limit", handler)
+    for i in range(5):
+        logger.warn("unrecognized address: %s", i)
+        logger.error("FAIL: %s", i)  # above the max level
+    logger.info("another message")
+    assert handler.messages.count("unrecognized address: 0") == 1
+    assert "unrecognized address: 2" not in handler.messages
+    assert len([m for m in handler.messages if m.startswith("FAIL")]) == 5
+    assert "another message" in handler.messages
+    assert f.suppressed == 3
+
+    f.rate = 0  # unlimited since then
+    f._states.clear()
+    logger.warn("unrecognized address: %s", 5)
+    assert handler.messages[-1] == "unrecognized address: 5"
+
+
+def test_sample_filter():
+    handler = ListHandler()
+    handler.addFilter(SampleFilter(3))
+    logger = new_logger("test_sample", handler)
+    for i in range(7):
+        logger.warn("unrecognized applicant: %s", i)
+    assert handler.messages == [
+        "unrecognized applicant: 0",
+        "unrecognized applicant: 3 (2 similar suppressed)",
+        "unrecognized applicant: 6 (2 similar suppressed)"]
+
+
+def test_setup_logging():
+    parser = OptionParser()
+    add_logging_options(parser)
+    options, _ = parser.parse_args(["--log-queue-size", "0",
+                                    "--log-sample", "2"])
+    handler = ListHandler()
+    logger = new_logger("test_setup", handler)
+    assert setup_logging(logger, options) is None
+    for i in range(4):
+        logger.warn("message %s", i)
+    assert handler.messages == ["message 0", "message 2 (1 similar "
+                                "suppressed)"]
+
+    options, _ = parser.parse_args([])
+    handler = ListHandler()
+    logger = new_logger("test_setup_queued", handler)
+    listener = setup_logging(logger, options)
+    logger.warn("message")
+    listener.stop()
+    assert handler.messages == ["message"]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test manifest.
+"""
+
+from cnsipo.manifest import Manifest, DONE, EMPTY, FAILED
+
+
+def test_manifest(tmpdir):
+    filename = str(tmpdir.join("manifest.db"))
+    manifest = Manifest(filename)
+    view = manifest.view("fmgb", "detail", "2015")
+    assert view.should_fetch("CN1", 1)
+    view.record_failed("CN1", "timeout")
+    view.record_done("CN1", 100)
+    view.record_done("CN2", 3)
+    view.record_failed("CN3", "error page")
+    manifest.close()
+
+    manifest = Manifest(filename)
+    view = manifest.view("fmgb", "detail", "2015")
+    status, attempts, last_error, size, fetched_at = manifest.get(
+        "fmgb", "detail", "CN1")
+    assert (status, attempts, last_error, size) == (DONE, 2, None, 100)
+    assert fetched_at > 0
+    assert manifest.get("fmgb", "detail", "CN3")[:3] == \
+        (FAILED, 1, "error page")
+    assert manifest.get("fmgb", "transaction", "CN1") is None
+
+    assert not view.should_fetch("CN1", 1)
+    assert not view.should_fetch("CN2", 1)
+    assert view.should_fetch("CN2", 2)
+    assert view.should_fetch("CN3", 1)
+    assert view.should_fetch("CN1", 0)
+
+    assert sorted(view.keys([FAILED, EMPTY])) == ["CN2", "CN3"]
+    assert list(manifest.view("fmgb", "detail", "2014").keys()) == []
+    assert view.progress() == {DONE: 1, EMPTY: 1, FAILED: 1}
+    assert manifest.progress(kind="fmgb") == [
+        ("fmgb", "detail", "2015", DONE, 1, 2),
+        ("fmgb", "detail", "2015", EMPTY, 1, 1),
+        ("fmgb", "detail", "2015", FAILED, 1, 1)]
+    manifest.close()
+
+
+def test_manifest_batch(tmpdir):
+    filename = str(tmpdir.join("manifest.db"))
+    manifest = Manifest(filename, batch_size=2, commit_interval=3600)
+    view = manifest.view("fmgb", "detail")
+    for i in range(3):
+        view.record_done("CN{}".format(i), 100)
+    other = Manifest(filename)  # sees committed batches only
+    assert other.progress() == [("fmgb", "detail", None, DONE, 2, 2)]
+    manifest.flush()
+    assert other.progress() == [("fmgb", "detail", None, DONE, 3, 3)]
+    other.close()
+    manifest.close()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test metrics.
+"""
+
+import logging
+
+import requests
+
+from cnsipo.client import HttpClient
+from cnsipo.metrics import Histogram, Registry, exporting
+from cnsipo.mock_sipo import MockSipo
+from cnsipo.utils import Counters
+
+
+def test_histogram():
+    histogram = Histogram([0.1, 1, 10])
+    assert histogram.quantile(0.5) is None
+    for value in [0.05, 0.5, 0.5, 0.5, 5, 50]:
+        histogram.observe(value)
+    counts, count, total = histogram.snapshot()
+    assert counts == [1, 3, 1, 1]
+    assert count == 6
+    assert abs(total - 56.55) < 1e-9
+    assert 0.1 < histogram.quantile(0.5) <= 1
+    assert histogram.quantile(0.99) == 10  # in +Inf
+
+
+def test_render():
+    registry = Registry()
+    counters = Counters()
+    counters.incr('retried', 2)
+    registry.add_counters(counters, 'tasks')
+    registry.incr('skipped')
+    registry.gauge('queue_depth', lambda: 7)
+    registry.gauge('broken', lambda: 1 / 0)
+    registry.histogram('write_seconds', help="seconds of writes",
+                       buckets=[0.1, 1])
+    with registry.timer('write_seconds'):
+        pass
+    lines = registry.render().splitlines()
+    assert "cnsipo_tasks_retried 2" in lines
+    assert "cnsipo_skipped 1" in lines
+    assert "# TYPE cnsipo_queue_depth gauge" in lines
+    assert "cnsipo_queue_depth 7" in lines
+    assert not any("broken" in line for line in lines)
+    assert "# HELP cnsipo_write_seconds seconds of writes" in lines
+    assert 'cnsipo_write_seconds_bucket{le="0.1"} 1' in lines
+    assert 'cnsipo_write_seconds_bucket{le="+Inf"} 1' in lines
+    assert "cnsipo_write_seconds_count 1" in lines
+    summary = registry.summary()
+    assert "tasks_retried=2" in summary
+    assert "write_seconds(n=1" in summary
+
+
+def test_client_metrics():
+    server = MockSipo().start()
+    registry = Registry()
+    client = HttpClient(metrics=registry)
+    try:
+        client.post(server.url + "/fullTran.action", params={'an': "1"})
+        client.get(server.url + "/unknown")
+    finally:
+        client.close()
+        server.stop()
+    assert registry.get('http_requests') == 2
+    assert registry.get('http_errors') == 0
+    assert registry.get('http_response_bytes') == \
+        len(server.pages['transaction']) + len("not found")
+    assert registry.histogram('http_request_seconds').snapshot()[1] == 2
+
+
+def test_export(tmpdir):
+    registry = Registry()
+    registry.incr('skipped', 3)
+    filename = str(tmpdir.join("crawler.prom"))
+    server = registry.serve(0)
+    try:
+        url = "http://127.0.0.1:{}/metrics".format(server.server_port)
+        resp = requests.get(url)
+        assert resp.headers['Content-Type'].startswith("text/plain")
+        assert "cnsipo_skipped 3" in resp.text.splitlines()
+        assert requests.get(url + "x").status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    with exporting(registry, logging.getLogger("test"), 60, filename):
+        registry.incr('skipped')
+    assert "cnsipo_skipped 4" in tmpdir.join("crawler.prom").read()
+    assert not tmpdir.join("crawler.prom.tmp").exists()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test the mock SIPO server.
+"""
+
+import random
+import re
+
+import pytest
+import requests
+
+from cnsipo import patent_detail
+from cnsipo import patent_list
+from cnsipo.client import HttpClient
+from cnsipo.extractor import get_parser, is_error_page
+from cnsipo.mock_sipo import MockSipo, parse_latency, window_ids, main
+
+
+@pytest.fixture
+def mock():
+    servers = []
+
+    def start(**kwargs):
+        servers.append(MockSipo(seed=1, **kwargs).start())
+        return servers[-1]
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def test_parse_latency():
+    r = random.Random(1)
+    assert parse_latency("0.05")(r) == 0.05
+    assert all(0.01 <= parse_latency("uniform:0.01,0.1")(r) <= 0.1
+               for _ in range(10))
+    assert all(parse_latency("normal:0,1")(r) >= 0 for _ in range(10))
+    assert parse_latency("exp:0.05")(r) > 0
+    assert parse_latency("lognormal:-3,0.5")(r) > 0
+    with pytest.raises(ValueError):
+        parse_latency("zipf:1")
+
+
+def test_window_ids():
+    ids = window_ids('fmgb', "2014", "2014", 365)
+    assert len(ids) == 365
+    assert ids[0] == "2014100000011"
+    assert window_ids('fmgb', "2014.02", "2014.02", 365) == ids[31:59]
+    assert window_ids('xxsq', "2014.01.02", "2014.01.03", 730)[0] == \
+        "2014200000033"
+
+
+def test_list_and_detail(mock, tmpdir, monkeypatch):
+    server = mock(patents=50)
+    monkeypatch.setattr(patent_list, "URL",
+                        server.url + "/patentoutline.action")
+    monkeypatch.setattr(patent_detail, "BASE_URL", server.url)
+    params, pages = patent_list.init_params.__wrapped__(
+        "2014", 'fmgb', str(tmpdir.join("input")))
+    assert pages == 3
+    patent_list.query.__wrapped__(params, "2014", 3, str(tmpdir))
+    ids = sorted(tmpdir.join("2014", "3").read().split())
+    assert ids == window_ids('fmgb', "2014", "2014", 50)[40:]
+
+    client = HttpClient()
+    url, params = patent_detail.detail_params(ids[0], 0)
+    text = client.post(url, params=params).text
+    assert get_parser('regex', 'detail')(text, 0)["申请号："] == ids[0]
+    url, params = patent_detail.transaction_params(ids[0], 0)
+    text = client.post(url, params=params).text
+    assert not is_error_page(text, 'transaction')
+    assert server.counters.get('requests') == 4
+    client.close()
+
+
+def test_faults(mock):
+    client = HttpClient()
+    url = mock(error_rate=1).url + "/fullTran.action"
+    assert is_error_page(client.post(url, params={'an': "1"}).text,
+                         'transaction')
+
+    url = mock(reset_rate=1).url + "/fullTran.action"
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post(url, params={'an': "1"})
+
+    server = mock(throttle=2)
+    texts = [client.post(server.url + "/fullTran.action",
+                         params={'an': "1"}).text for _ in range(4)]
+    assert [is_error_page(t, 'transaction') for t in texts] == \
+        [False, False, True, True]
+    assert server.counters.get('throttled') == 2
+
+    server = mock(latency="0.05")
+    elapsed = client.post(server.url + "/fullTran.action",
+                          params={'an': "1"}).elapsed
+    assert elapsed.total_seconds() >= 0.05
+    assert client.get(server.url + "/unknown").status_code == 404
+    assert re.search("error", server.pages['error'])
+    client.close()
+
+
+def test_missing_fixtures_dir(tmpdir, capsys):
+    with pytest.raises(SystemExit):
+        main(["-p", "0", "-f", str(tmpdir.join("missing"))])
+    assert "pass -f" in capsys.readouterr()[1]
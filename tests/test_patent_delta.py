@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test patent delta.
+"""
+
+from cnsipo.patent_delta import IdIndex, diff, commit, read_sources, main
+from cnsipo.store import DirStore
+
+
+def test_diff_commit(tmpdir):
+    pages = tmpdir.join("list", "2014")
+    pages.join("1").write("CN3\nCN1\n", ensure=True)
+    pages.join("2").write("CN2\nCN3\n")
+    tmpdir.join("ids").write("CN5\n\nCN4\n")
+    sources = [str(pages), str(tmpdir.join("ids"))]
+    assert list(read_sources(sources)) == ["CN3", "CN1", "CN2", "CN3",
+                                           "CN5", "CN4"]
+
+    index = IdIndex(str(tmpdir.join("index")), "2014")
+    assert list(index) == []
+    assert index.update(["CN1", "CN3"]) == 2
+    assert index.update(["CN0", "CN3"]) == 1
+    assert list(index) == ["CN0", "CN1", "CN3"]
+
+    delta_file = str(tmpdir.join("delta", "2014"))
+    assert diff(read_sources(sources), index, delta_file, chunk_size=2) == 3
+    assert tmpdir.join("delta", "2014").read() == "CN2\nCN4\nCN5\n"
+
+    store = DirStore(str(tmpdir.join("output")))
+    store.put("CN4", "{}")
+    assert commit(index, delta_file, store) == 1
+    assert list(index) == ["CN0", "CN1", "CN3", "CN4"]
+    assert diff(read_sources(sources), index, delta_file) == 2
+    assert commit(index, delta_file) == 2
+    assert diff(read_sources(sources), index, delta_file) == 0
+
+
+def test_main(tmpdir, capsys):
+    output = DirStore(str(tmpdir.join("output", "2014")))
+    output.put("CN1", "{}")
+    tmpdir.join("ids").write("CN1\nCN2\n")
+    index_dir = str(tmpdir.join("index"))
+    delta_dir = str(tmpdir.join("delta"))
+    assert main([index_dir, "2014", "-b",
+                 "-O", str(tmpdir.join("output"))]) == 0
+    assert main([index_dir, "2014", str(tmpdir.join("ids")),
+                 "-o", delta_dir]) == 0
+    assert tmpdir.join("delta", "2014").read() == "CN2\n"
+    assert main([index_dir, "2014", "-c", "-o", delta_dir]) == 0
+    assert tmpdir.join("index", "2014").read() == "CN1\nCN2\n"
+    out = capsys.readouterr()[0]
+    assert "indexed 1 ID's" in out
+    assert "1 new ID's" in out
+    assert "committed 1 ID's" in out
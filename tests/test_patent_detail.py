@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test patent detail.
+"""
+
+import json
+
+import pytest
+
+from cnsipo.extractor import get_parser
+from cnsipo.shared import ContentError, FORGIVEN_ERROR
+from cnsipo.manifest import Manifest, DONE, FAILED, ANY_KIND
+from cnsipo.patent_detail import archive_key, archived_pages, reparse, \
+    detail_params, transaction_params, query, query_all, parse_page, main
+from cnsipo.store import SegmentStore, DirStore
+from cnsipo.utils import ProcessStage
+
+from conftest import page
+
+
+def test_archive_key():
+    key = archive_key("CN1", *detail_params("CN1", 0))
+    assert key.startswith("CN1|http://epub.sipo.gov.cn/patentdetail.action?")
+    assert len(key.split()) == 1
+    assert key == archive_key("CN1", *detail_params("CN1", 0))
+    assert key != archive_key("CN1", *detail_params("CN1", 1))
+    assert key != archive_key("CN1", *transaction_params("CN1", 0))
+
+
+def test_reparse(tmpdir):
+    archive = SegmentStore(str(tmpdir.join("archive")), compress=True)
+    for patent_id in ["CN1", "CN2", "CN3"]:
+        archive.put(archive_key(patent_id, *detail_params(patent_id, 0)),
+                    page("detail.html"))
+    archive.put(archive_key("CN4", *detail_params("CN4", 0)),
+                page("error.html"))
+    archive.put(archive_key("CN5", *transaction_params("CN5", 0)),
+                page("transaction.html"))
+    assert [p for p, _ in archived_pages(archive, detail_params, 0)] == \
+        ["CN1", "CN2", "CN3", "CN4"]
+    assert [p for p, _ in archived_pages(archive, detail_params, 0,
+                                         ["CN3", "CN5"])] == ["CN3"]
+
+    store = DirStore(str(tmpdir.join("output")))
+    manifest = Manifest(str(tmpdir.join("manifest.db")))
+    view = manifest.view("fmgb", "detail", "2014")
+    parse = get_parser('regex', 'detail')
+    assert reparse(archived_pages(archive, detail_params, 0), parse, 0,
+                   'detail', store, processes=2, manifest=view,
+                   capacity=2) == (3, 1)
+    assert sorted(store.keys()) == ["CN1", "CN2", "CN3"]
+    expected = get_parser('bs', 'detail')(page("detail.html"), 0)
+    assert json.loads(store.get("CN2")) == json.loads(json.dumps(
+        expected, ensure_ascii=False))
+    assert view.progress() == {DONE: 3, FAILED: 1}
+    manifest.close()
+    archive.close()
+
+
+def test_query_parse_stage(tmpdir, fake_client):
+    fake_client([page("detail.html")] * 3)
+    store = DirStore(str(tmpdir))
+    stage = ProcessStage(parse_page, processes=2, capacity=1)
+    parse = get_parser('regex', 'detail')
+    for patent_id in ["CN1", "CN2", "CN3"]:
+        query.__wrapped__(detail_params, parse, 0, patent_id, store, 5, 1,
+                          parse_stage=stage)
+    stage.close()
+    assert sorted(store.keys()) == ["CN1", "CN2", "CN3"]
+    assert json.loads(store.get("CN3"))[u"申请号："] == u"2014100000011"
+
+
+@pytest.mark.parametrize("processes", [0, 1])
+def test_query_parse_stage_errors(tmpdir, fake_client, processes):
+    # the same pages end the same with or without the parse stage
+    stage = ProcessStage(parse_page, processes) if processes else None
+    store = DirStore(str(tmpdir))
+    fake_client([u"<html><table></table></html>".encode('utf-8'),
+                 page("detail.html").replace("xm_jsh", "wg_jsh")])
+    with pytest.raises(ContentError):  # retried
+        query.__wrapped__(transaction_params,
+                          get_parser('regex', 'transaction'), 0, "CN1",
+                          store, 5, 1, parse_stage=stage)
+    with pytest.raises(Exception) as e:
+        query.__wrapped__(detail_params, get_parser('regex', 'detail'), 0,
+                          "CN2", store, 5, 1, parse_stage=stage)
+    assert not isinstance(e.value, FORGIVEN_ERROR)  # not retried
+    if stage:
+        stage.close()
+    assert not list(store.keys())
+
+
+def test_query_all(tmpdir, fake_client):
+    client = fake_client([page("detail.html"), page("error.html")])
+    manifest = Manifest(str(tmpdir.join("manifest.db")))
+    stores = [DirStore(str(tmpdir.join(k))) for k in "dt"]
+    parts = [(detail_params, get_parser('regex', 'detail'), 'detail',
+              stores[0], manifest.view("fmgb", "detail"), None),
+             (transaction_params, get_parser('regex', 'transaction'),
+              'transaction', stores[1],
+              manifest.view(ANY_KIND, "transaction"), None)]
+    with pytest.raises(ContentError):
+        query_all.__wrapped__(parts, 0, "CN1", 5, 1)
+    assert manifest.get("fmgb", "detail", "CN1")[0] == DONE
+    assert manifest.get(ANY_KIND, "transaction", "CN1")[0] == FAILED
+
+    # the detail is done, so only the transaction is fetched again
+    client.pages.append(page("transaction.html"))
+    query_all.__wrapped__(parts, 0, "CN1", 5, 1)
+    assert not client.pages
+    assert manifest.get(ANY_KIND, "transaction", "CN1")[:2] == (DONE, 2)
+    assert manifest.get("fmgb", "detail", "CN1")[1] == 1
+    assert [list(store.keys()) for store in stores] == [["CN1"], ["CN1"]]
+    manifest.close()
+
+
+def test_query_no_digest(tmpdir, fake_client):
+    # a page of another layout fails without retry, unlike an error page
+    fake_client([page("detail.html").replace("xm_jsh", "wg_jsh"),
+                 page("error.html")])
+    manifest = Manifest(str(tmpdir.join("manifest.db")))
+    store = DirStore(str(tmpdir.join("d")))
+    parse = get_parser('regex', 'detail')
+    with pytest.raises(IndexError):
+        query.__wrapped__(detail_params, parse, 0, "CN1", store, 5, 1,
+                          manifest=manifest.view("fmgb", "detail"))
+    with pytest.raises(ContentError):
+        query.__wrapped__(detail_params, parse, 0, "CN2", store, 5, 1,
+                          manifest=manifest.view("fmgb", "detail"))
+    assert manifest.get("fmgb", "detail", "CN1")[0] == FAILED
+    assert manifest.get("fmgb", "detail", "CN2")[0] == FAILED
+    assert not list(store.keys())
+    manifest.close()
+
+
+def test_archive_by_detail_kind(tmpdir, fake_client):
+    archive_dir = tmpdir.join("archive")
+    for detail_kind, name in [("1", "detail"), ("2", "transaction")]:
+        fake_client([page(name + ".html")])
+        assert main(["-K" + detail_kind, "-t1", "-o", str(tmpdir.join(name)),
+                     "-a", str(archive_dir), "2014100000011"]) == 0
+    assert sorted(archive_dir.listdir()) == \
+        [archive_dir.join("detail"), archive_dir.join("transaction")]
+    archive = SegmentStore(str(archive_dir.join("transaction")))
+    assert list(archived_pages(archive, transaction_params, 0)) == \
+        [("2014100000011", page("transaction.html"))]
+    archive.close()
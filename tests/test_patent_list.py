@@ -6,10 +6,24 @@ Test patent list.
 
 import os
 
-from cnsipo.patent_list import KINDS, init_params, query
+import pytest
 
+from cnsipo import patent_list
+from cnsipo.mock_sipo import MockSipo
+from cnsipo.patent_list import KINDS, init_params, query, date_windows, \
+    year_windows, init_windows, parse_range, round_robin, main
 
-def test_query(tmpdir):
+
+@pytest.fixture
+def mock_sipo(monkeypatch):
+    server = MockSipo().start()
+    monkeypatch.setattr(patent_list, "URL",
+                        server.url + "/patentoutline.action")
+    yield server
+    server.stop()
+
+
+def test_query(tmpdir, mock_sipo):
     kind = KINDS[0]
     year = 1985
     input_dir = str(tmpdir.mkdir("input"))
@@ -28,3 +42,91 @@ def test_query(tmpdir):
     assert not os.path.isfile(output_file)
     query(params, year, page_now, output_dir)
     assert os.path.isfile(output_file)
+
+
+def test_year_windows():
+    assert year_windows("2014", 'year') == [("2014", "2014", "2014")]
+    months = year_windows("2012", 'month')
+    assert len(months) == 12
+    assert months[1] == ("2012.02", "2012.02.01", "2012.02.29")
+    days = year_windows("2014", 'day')
+    assert len(days) == 365
+    assert days[59] == ("2014.03.01", "2014.03.01", "2014.03.01")
+    assert date_windows("2014.03.01") == []
+
+
+def test_init_windows(tmpdir):
+    kind = KINDS[0]
+    input_dir = str(tmpdir)
+    for label, count in [("2014.01", 50), ("2014.02", 1000),
+                         ("2014.02.03", 401)]:
+        tmpdir.join("{}-{}.html".format(kind, label)).write(
+            'ksjs.strLicenseCode.value = "code"\n'
+            'ksjs.numFMGB.value = "{}"\n'.format(count))
+    for w in year_windows("2014", 'month') + year_windows("2014", 'day'):
+        page = tmpdir.join("{}-{}.html".format(kind, w[0]))
+        if not page.check():  # empty
+            page.write('ksjs.strLicenseCode.value = "code"\n'
+                       'ksjs.numFMGB.value = "0"\n')
+
+    windows = init_windows("2014", kind, input_dir, 'month', 4, max_pages=10)
+    labels = [w[0][0] for w in windows]
+    assert labels[0] == "2014.01"
+    assert labels[1:29] == ["2014.02.{:02d}".format(d) for d in range(1, 29)]
+    assert len(labels) == 1 + 28 + 10
+    assert [w[2] for w in windows[:5]] == [3, 0, 0, 21, 0]
+    params = windows[3][1]
+    assert "2014.02.03" in params['strWord']
+    assert params['numFMGB'] == "401"
+
+    tmpdir.join("{}-2014.03.html".format(kind)).remove()
+    tmpdir.mkdir("{}-2014.03.html".format(kind))  # unreadable
+    with pytest.raises(IOError):  # not missing its pages silently
+        init_windows("2014", kind, input_dir, 'month', 4)
+
+
+def test_parse_range():
+    assert parse_range("1", 1, 4) == [1]
+    assert parse_range("1,3-4", 1, 4) == [1, 3, 4]
+    assert parse_range("1985-1987", 1, 9999) == [1985, 1986, 1987]
+    for s in ["0", "1-5", "3-2", "a"]:
+        with pytest.raises(ValueError):
+            parse_range(s, 1, 4)
+
+
+def test_round_robin():
+    assert list(round_robin([[1, 2, 3], [], "ab", [4]])) == \
+        [1, 'a', 4, 2, 'b', 3]
+
+
+def test_main(tmpdir):
+    input_dir = tmpdir.mkdir("input")
+    output_dir = tmpdir.join("output")
+    for kind, count in [("fmgb", 30), ("fmsq", 50)]:
+        for year in ["2013", "2014"]:
+            input_dir.join("{}-{}.html".format(kind, year)).write(
+                'ksjs.strLicenseCode.value = "code"\n'
+                'ksjs.num{}.value = "{}"\n'.format(kind.upper(), count))
+    assert main(["-k", "1-2", "-n", "-i", str(input_dir), "-o",
+                 str(output_dir), "2013-2014"]) == 0
+    assert sorted(p.basename for p in output_dir.listdir()) == \
+        ["fmgb", "fmsq"]
+    assert output_dir.join("fmsq", "2014").check(dir=1)
+
+    input_dir.join("fmsq-2014.html").remove()
+    input_dir.mkdir("fmsq-2014.html")
+    assert main(["-k", "1-2", "-n", "-i", str(input_dir), "-o",
+                 str(output_dir), "2013-2014"]) == 1
+
+
+def test_main_patch_engine(tmpdir, monkeypatch):
+    calls = []
+    monkeypatch.setattr(patent_list, "patch_engine", calls.append)
+
+    def setup_logging(logger, options):
+        calls.append("logging")
+        raise KeyboardInterrupt  # enough
+    monkeypatch.setattr(patent_list, "setup_logging", setup_logging)
+    with pytest.raises(KeyboardInterrupt):
+        main(["-E", "async", "-o", str(tmpdir), "2014"])
+    assert calls == ["async", "logging"]
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test patent merge.
+"""
+
+from cnsipo.patent_merge import merge_ids, difference, unique, main
+from cnsipo.patent_shard import select_shard
+
+
+def write_pages(dirname, pages):
+    for i, ids in enumerate(pages):
+        dirname.join(str(i + 1)).write("".join(i + "\n" for i in ids),
+                                       ensure=True)
+    return str(dirname)
+
+
+def test_difference():
+    assert list(unique([1, 1, 2, 3, 3, 3])) == [1, 2, 3]
+    assert list(difference([1, 2, 4, 6, 7], [0, 2, 3, 6, 8])) == [1, 4, 7]
+    assert list(difference([1, 2], [])) == [1, 2]
+
+
+def test_merge_ids(tmpdir):
+    fmgb = write_pages(tmpdir.join("list", "fmgb", "2014"),
+                       [["CN3", "CN1"], ["CN2", "CN3"], ["CN5", "CN1"]])
+    fmsq = write_pages(tmpdir.join("list", "fmsq", "2014"),
+                       [["CN2", "CN4"], ["CN6"]])
+    output_dir = tmpdir.join("merged")
+    counters = merge_ids({'fmgb': [fmgb]}, str(output_dir), "2014",
+                         chunk_size=2)
+    assert output_dir.join("2014").read() == "CN1\nCN2\nCN3\nCN5\n"
+    assert counters['fmgb'].snapshot() == {'read': 6, 'unique': 4}
+    assert counters['all'].get('written') == 4
+
+    counters = merge_ids({'fmgb': [fmgb], 'fmsq': [fmsq]}, str(output_dir),
+                         "2014", chunk_size=2, shards=3)
+    assert output_dir.join("2014").read() == \
+        "CN1\nCN2\nCN3\nCN4\nCN5\nCN6\n"
+    for i in range(3):
+        ids = output_dir.join("shard-{}".format(i), "2014").read().split()
+        assert ids == list(select_shard(ids, i, 3))  # as crawled
+        assert counters['all'].get("shard-{}".format(i)) == len(ids)
+    assert sum(counters['all'].get("shard-{}".format(i))
+               for i in range(3)) == 6
+
+
+def test_merge_ids_cross_kind(tmpdir):
+    fmgb = write_pages(tmpdir.join("list", "fmgb", "2014"),
+                       [["CN3", "CN1"], ["CN2", "CN3"]])
+    fmsq = write_pages(tmpdir.join("list", "fmsq", "2014"),
+                       [["CN2", "CN4"], ["CN4", "CN1"]])
+    output_dir = tmpdir.join("merged")
+    counters = merge_ids({'fmgb': [fmgb], 'fmsq': [fmsq]}, str(output_dir),
+                         "2014", cross_kind=True)
+    assert output_dir.join("fmgb", "2014").read() == "CN1\nCN2\nCN3\n"
+    assert output_dir.join("fmsq", "2014").read() == "CN4\n"
+    assert counters['fmsq'].snapshot() == {
+        'read': 4, 'unique': 3, 'written': 1, 'cross_kind_duplicates': 2}
+
+    output_dir.remove()
+    assert main(["-x", str(output_dir), fmsq, fmgb]) == 0
+    assert output_dir.join("fmsq", "2014").read() == "CN1\nCN2\nCN4\n"
+    assert output_dir.join("fmgb", "2014").read() == "CN3\n"
+
+
+def test_merged_shards(tmpdir):
+    ids = ["2014{:08d}{}".format(i, i % 10) for i in range(1000)]
+    source = write_pages(tmpdir.join("list", "fmgb", "2014"), [ids])
+    output_dir = tmpdir.join("merged")
+    merge_ids({'fmgb': [source]}, str(output_dir), "2014", shards=4)
+    for i in range(4):
+        merged = output_dir.join("shard-{}".format(i), "2014").read().split()
+        assert merged == list(select_shard(sorted(ids), i, 4))
+        assert 150 < len(merged) < 350
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test patent refresh.
+"""
+
+import datetime
+import json
+import time
+
+import psycopg2
+
+from cnsipo.extractor import get_parser
+from cnsipo.manifest import Manifest, ANY_KIND, DONE, FAILED
+from cnsipo.patent_db import APP_NO
+from cnsipo.patent_refresh import score, plan, refetch, update_db, \
+    TRANSACTION
+from cnsipo.store import DirStore
+
+from conftest import page
+
+DAY = 86400
+NOW = time.mktime(datetime.date(2016, 6, 1).timetuple())
+
+
+def days_ago(days):
+    return datetime.date.fromtimestamp(NOW - days * DAY)
+
+
+def test_score():
+    applied = days_ago(700)
+    # never fetched: since the last transaction
+    assert score("2014100000011", applied, days_ago(100), "授权", None,
+                 NOW) > score("2014100000011", applied, days_ago(50), "授权",
+                              None, NOW)
+    # since the last fetch
+    assert score("2014100000011", applied, days_ago(100), "授权",
+                 NOW - DAY, NOW) < \
+        score("2014100000011", applied, days_ago(100), "授权", None, NOW)
+    # under examination
+    assert score("2014100000011", applied, days_ago(100), "实质审查的生效",
+                 None, NOW) == 2 * score("2014100000011", applied,
+                                         days_ago(100), "授权", None, NOW)
+    # the older the lower
+    assert score("2010100000011", days_ago(2000), days_ago(100), "授权",
+                 None, NOW) < score("2014100000011", applied, days_ago(100),
+                                    "授权", None, NOW)
+    # dead or expired
+    assert score("2014100000011", applied, days_ago(100),
+                 "专利权的终止", None, NOW) == 0
+    assert score("2004200000011", days_ago(4000), days_ago(100), "授权",
+                 None, NOW) == 0
+
+
+def test_plan(tmpdir):
+    manifest = Manifest(str(tmpdir.join("manifest.db")))
+    manifest.record(ANY_KIND, TRANSACTION, "CN2", DONE)  # just fetched
+    candidates = [
+        ("2014", ("CN1", days_ago(700), days_ago(300), "授权")),
+        ("2014", ("CN2", days_ago(700), days_ago(600), "授权")),
+        ("2014", ("CN3", days_ago(700), days_ago(200), "视为撤回")),
+        ("2015", ("CN4", days_ago(300), None, None)),
+        ("2015", ("CN5", days_ago(300), days_ago(100), "授权")),
+    ]
+    assert [p[1:] for p in plan(candidates, manifest, 3, NOW)] == \
+        [("2015", "CN4"), ("2014", "CN1"), ("2015", "CN5")]
+    assert [p[2] for p in plan(candidates, None, 10, NOW)] == \
+        ["CN4", "CN2", "CN1", "CN5"]
+    manifest.close()
+
+
+def test_refetch(tmpdir, fake_client):
+    fake_client({"CN1": page("transaction.html"),
+                 "CN2": page("error.html"),
+                 "CN3": page("transaction.html")})
+    stores = {"2014": DirStore(str(tmpdir.join("2014"))),
+              "2015": DirStore(str(tmpdir.join("2015")))}
+    manifest = Manifest(str(tmpdir.join("manifest.db")))
+    selected = [(3.0, "2014", "CN1"), (2.0, "2014", "CN2"),
+                (1.0, "2015", "CN3")]
+    fetched = refetch(selected, stores, get_parser('regex', TRANSACTION), 2,
+                      5, manifest)
+    assert fetched == {"2014": ["CN1"], "2015": ["CN3"]}
+    assert len(json.loads(stores["2015"].get("CN3"))) == 3
+    assert manifest.get(ANY_KIND, TRANSACTION, "CN1")[0] == DONE
+    assert manifest.get(ANY_KIND, TRANSACTION, "CN2")[0] == FAILED
+    manifest.close()
+
+
+class FakeDb(object):
+    """A transactions table in memory with savepoints, whose statements on
+    the `bad` patent fail
+    """
+
+    def __init__(self, bad):
+        self.bad = bad
+        self.rows = {}
+        self.committed = {}
+        self.savepoint = None
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.committed = dict(self.rows)
+
+    def rollback(self):
+        self.rows = dict(self.committed)
+
+
+class FakeCursor(object):
+    rowcount = 0
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, stmt, args=None):
+        db = self.db
+        if stmt.startswith("SAVEPOINT"):
+            db.savepoint = dict(db.rows)
+        elif stmt.startswith("ROLLBACK TO"):
+            db.rows = dict(db.savepoint)
+        elif stmt.startswith("DELETE"):
+            self.rowcount = len(db.rows.pop(args[0], []))
+
+    def executemany(self, stmt, batch_vals):
+        db = self.db
+        for vals in batch_vals:
+            db.rows[vals[APP_NO]] = db.rows.get(vals[APP_NO], []) + [vals]
+            if vals[APP_NO] == db.bad:
+                raise psycopg2.DatabaseError("bad row")
+
+
+def test_update_db(tmpdir):
+    store = DirStore(str(tmpdir))
+    result = [{u"事务数据公告日": "2015.01.07", u"事务数据类型": u"授权"},
+              {u"事务数据公告日": "2014.03.05", u"事务数据类型": u"公开"}]
+    for app_no in ["CN1", "CN2", "CN3"]:
+        store.put(app_no, json.dumps(result))
+    conn = FakeDb("CN2")
+    counters = update_db(conn, "trans", store, ["CN1", "CN2", "CN3"],
+                         batch_size=10)
+    assert sorted(conn.committed) == ["CN1", "CN3"]  # CN1 isn't lost
+    assert len(conn.committed["CN1"]) == len(result)
+    assert counters.get('updated') == 2
+    assert counters.get('failed') == 1
+    assert counters.get('inserted') == 2 * len(result)
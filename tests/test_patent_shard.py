@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test patent shard.
+"""
+
+import pytest
+
+from cnsipo.patent_shard import parse_shard, select_shard, verify, main
+from cnsipo.store import DirStore, SegmentStore
+
+
+def test_parse_shard():
+    assert parse_shard("0/4") == (0, 4)
+    assert parse_shard("3/4") == (3, 4)
+    for s in ["4/4", "-1/4", "1", "a/b"]:
+        with pytest.raises(ValueError):
+            parse_shard(s)
+
+
+def test_select_shard():
+    ids = ["CN{}".format(i) for i in range(1000)]
+    shards = [list(select_shard(ids, i, 3)) for i in range(3)]
+    assert sorted(sum(shards, [])) == sorted(ids)
+    assert all(len(shard) > 250 for shard in shards)
+
+
+def test_verify(tmpdir):
+    ids = ["CN{}".format(i) for i in range(100)]
+    id_file = tmpdir.join("2014")
+    id_file.write("\n".join(ids) + "\n")
+    stores = [DirStore(str(tmpdir.join("out{}".format(i)))) for i in range(3)]
+    for i, store in enumerate(stores):
+        for patent_id in select_shard(ids, i, 3):
+            store.put(patent_id, "{}")
+    output_dirs = [store.dirname for store in stores]
+    assert main([str(id_file)] + output_dirs) == 0
+
+    missing = next(select_shard(ids, 0, 3))
+    misplaced = next(select_shard(ids, 1, 3))
+    tmpdir.join("out0", missing).remove()
+    stores[0].put(misplaced, "{}")
+    results = verify(ids, stores)
+    assert results[0]['missing'] == [missing]
+    assert results[0]['misplaced'] == [misplaced]
+    assert results[1]['duplicated'] == [misplaced]
+    assert results[2]['done'] == results[2]['expected']
+    assert sum(r['expected'] for r in results) == 100
+    assert main([str(id_file)] + output_dirs) == 1
+    assert main(["-p", str(id_file)] + output_dirs) == 0
+
+
+def test_verify_live(tmpdir):
+    # verifying doesn't disturb the crawlers still writing the shards
+    ids = ["CN{}".format(i) for i in range(10)]
+    id_file = tmpdir.join("2014")
+    id_file.write("\n".join(ids) + "\n")
+    stores = [SegmentStore(str(tmpdir.join("out{}".format(i))))
+              for i in range(2)]
+    for i, store in enumerate(stores):
+        for patent_id in select_shard(ids, i, 2):
+            store.put(patent_id, "{}")
+    output_dirs = [store.dirname for store in stores]
+    assert main(["-S", "segment", str(id_file)] + output_dirs) == 0
+    stores[0].put("CN10", "{}")  # still writable
+    for store in stores:
+        store.close()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test profiler.
+"""
+
+import pstats
+import threading
+import time
+from StringIO import StringIO
+from optparse import OptionParser
+
+from cnsipo.profiler import Profiler, Sampler, add_profile_options, \
+    start_profiling
+
+
+def spin(stopped):
+    while not stopped.is_set():
+        sum(range(100))
+
+
+def test_sampler():
+    stopped = threading.Event()
+    worker = threading.Thread(target=spin, args=(stopped,))
+    worker.start()
+    sampler = Sampler(0.001)
+    try:
+        for _ in range(20):
+            sampler.sample(threading.current_thread().ident)
+            time.sleep(0.001)
+    finally:
+        stopped.set()
+        worker.join()
+    assert sampler.samples == 20
+    assert all(not stack.endswith("test_sampler (test_profiler.py:21)")
+               for stack in sampler.stacks)
+    top = dict((label, total) for label, _, total in sampler.top())
+    assert any(label.startswith("spin (test_profiler.py:") and total > 10
+               for label, total in top.items())
+
+
+def test_profiler(tmpdir):
+    prefix = str(tmpdir.join("profiles", "run"))
+    out = StringIO()
+    stopped = threading.Event()
+    worker = threading.Thread(target=spin, args=(stopped,))
+    profiler = Profiler(prefix, 0.001, top=5, stream=out).start()
+    worker.start()
+    sorted(range(10000), key=lambda i: -i)
+    time.sleep(0.05)
+    stopped.set()
+    worker.join()
+    profiler.stop()
+    profiler.stop()  # no-op
+
+    stats = pstats.Stats(prefix + ".pstats")
+    assert any(func[2] == "<lambda>" for func in stats.stats)
+    lines = tmpdir.join("profiles", "run.collapsed").readlines()
+    assert any("spin (test_profiler.py:" in line for line in lines)
+    assert all(int(line.rsplit(" ", 1)[1]) > 0 for line in lines)
+    summary = out.getvalue()
+    assert "run.pstats" in summary
+    assert "samples of all threads" in summary
+
+
+def test_start_profiling(tmpdir):
+    parser = OptionParser()
+    add_profile_options(parser)
+    options, _ = parser.parse_args([])
+    assert start_profiling(options) is None
+
+    prefix = str(tmpdir.join("run"))
+    options, _ = parser.parse_args(["--profile", prefix])
+    profiler = start_profiling(options)
+    assert profiler.sampler is None
+    profiler.stream = StringIO()
+    profiler.stop()
+    assert tmpdir.join("run.pstats").check()
+    assert not tmpdir.join("run.collapsed").check()
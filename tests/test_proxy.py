@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test proxy.
+"""
+
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import pytest
+
+from cnsipo.client import HttpClient
+from cnsipo.proxy import ProxyPool, load_proxies
+
+
+class StandInProxy(ThreadingMixIn, HTTPServer):
+    """A local stand-in proxy, which answers the proxied requests itself
+    with `status`
+    """
+
+    daemon_threads = True
+
+    def __init__(self, status=200):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), ProxyHandler)
+        self.status = status
+        self.paths = []
+        self.url = "http://127.0.0.1:{}".format(self.server_port)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        body = self.server.url
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def proxies():
+    servers = [StandInProxy(), StandInProxy(), StandInProxy(500)]
+    yield servers
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_proxy_pool():
+    pool = ProxyPool(["http://p1", "http://p2"], max_failures=2, cooldown=0.2)
+    p1 = pool.acquire()
+    p2 = pool.acquire()
+    assert set([p1.url, p2.url]) == set(["http://p1", "http://p2"])
+    pool.release(p1, True)
+    pool.release(p2)
+    assert pool.acquire() is p2  # the better score
+    pool.release(p2)
+    pool.report_error(p1)  # ejected
+    assert [pool.acquire() for _ in range(3)] == [p2] * 3
+    time.sleep(0.25)  # readmitted
+    assert pool.acquire() is p1  # fewer in-flight requests
+    pool.release(p1, True)  # on probation
+    assert p1.ejections == 2
+    assert pool.stats()["http://p1"]['errors'] == 3
+
+
+def test_proxy_error_pages():
+    pool = ProxyPool(["http://p1"], max_failures=3, cooldown=60)
+    for _ in range(3):  # each response is fine but an error page
+        proxy = pool.acquire()
+        pool.release(proxy)
+        pool.report_error(proxy)
+    stats = pool.stats()["http://p1"]
+    assert stats['errors'] == 3
+    assert stats['ejections'] == 1
+
+    pool = ProxyPool(["http://p1"], max_failures=3)
+    for failed in (True, False, False):  # reset by the valid content
+        proxy = pool.acquire()
+        pool.release(proxy, failed)
+    proxy = pool.acquire()
+    pool.release(proxy)
+    pool.report_error(proxy)
+    assert proxy.failures == 1
+
+
+def test_proxy_rate():
+    pool = ProxyPool(["http://p1", "http://p2"], rate=20)
+    start = time.time()
+    urls = [pool.acquire().url for _ in range(8)]
+    assert time.time() - start > 0.1  # 6 tokens at 40/s in total
+    assert urls.count("http://p1") == 4
+
+
+def test_client_proxies(proxies):
+    pool = ProxyPool([p.url for p in proxies], rate=20, max_failures=2,
+                     cooldown=60)
+    client = HttpClient(proxy_pool=pool)
+    served = [client.get("http://sipo.invalid/page", timeout=5).text
+              for _ in range(12)]
+    assert served.count(proxies[2].url) == 2  # ejected
+    assert served.count(proxies[0].url) == 5
+    assert proxies[0].paths[0] == "http://sipo.invalid/page"
+
+    client.report_error()  # an error page from the last proxy
+    client.report_error()
+    stats = pool.stats()
+    assert stats[proxies[2].url]['ejections'] == 1
+    assert sum(s['ejections'] for s in stats.values()) == 2
+    client.close()
+
+
+def test_load_proxies(tmpdir):
+    tmpdir.join("proxies").write("http://p1:3128\n\n# backup\n"
+                                 "http://p2:3128  # slow\n")
+    assert load_proxies(str(tmpdir.join("proxies"))) == \
+        ["http://p1:3128", "http://p2:3128"]
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test stores.
+"""
+
+import os
+
+import pytest
+
+from cnsipo.store import DirStore, SegmentStore, open_store, STORE_LAYOUTS
+
+
+@pytest.mark.parametrize("layout", STORE_LAYOUTS)
+def test_store(tmpdir, layout):
+    store = open_store(layout, str(tmpdir.join("2015")))
+    assert not store.exists("CN1")
+    store.put("CN1", '{"a": 1}\n')
+    store.put("CN2", "")
+    store.put("CN1", '{"a": 2}\n')  # overwritten
+    assert store.exists("CN1")
+    assert store.size("CN1") == 9
+    assert store.size("CN2") == 0
+    assert store.get("CN1") == '{"a": 2}\n'
+    assert sorted(store.keys()) == ["CN1", "CN2"]
+    assert sorted(store.scan()) == [("CN1", '{"a": 2}\n'), ("CN2", "")]
+    store.close()
+
+    store = open_store(layout, str(tmpdir.join("2015")))
+    assert store.get("CN1") == '{"a": 2}\n'
+    assert sorted(store.keys()) == ["CN1", "CN2"]
+    store.close()
+
+
+def test_dir_store_layout(tmpdir):
+    store = DirStore(str(tmpdir))
+    store.put("CN1", "data")
+    assert tmpdir.join("CN1").read() == "data"
+    tmpdir.join("CN2.tmp").write("torn")
+    assert store.keys() == ["CN1"]
+
+
+def test_segment_store_compress(tmpdir):
+    data = "专利" * 1000
+    store = SegmentStore(str(tmpdir), compress=True)
+    store.put("CN1", data)
+    assert store.size("CN1") == len(data)
+    assert store.get("CN1") == data
+    store.close()
+    assert os.path.getsize(str(tmpdir.join("seg-000000"))) < len(data) / 10
+
+    store = SegmentStore(str(tmpdir))  # reads compressed records as well
+    assert store.get("CN1") == data
+    store.put("CN2", data)
+    assert store.get("CN2") == data
+    store.close()
+
+
+def test_segment_store_rollover(tmpdir):
+    store = SegmentStore(str(tmpdir), segment_size=100)
+    for i in range(10):
+        store.put("CN{}".format(i), "x" * 40)
+    store.close()
+    segments = sorted(f for f in os.listdir(str(tmpdir))
+                      if f.startswith("seg-"))
+    assert len(segments) == 10
+
+    store = SegmentStore(str(tmpdir), segment_size=100)
+    assert [k for k, _ in store.scan()] == ["CN{}".format(i)
+                                            for i in range(10)]
+    store.put("CN10", "y" * 40)
+    store.close()
+    # 11 segments, the index and the lock file
+    assert len(os.listdir(str(tmpdir))) == 13
+
+
+def test_segment_store_recovery(tmpdir):
+    store = SegmentStore(str(tmpdir))
+    store.put("CN1", "one")
+    store.put("CN2", "two")
+    store.close()
+
+    index = tmpdir.join("index")
+    lines = index.read().splitlines(True)
+    index.write(lines[0] + lines[1][:5])  # lost an index line and torn
+    segment = tmpdir.join("seg-000000")
+    with open(str(segment), 'ab') as f:
+        f.write("\xc5\x00\x00\x03")  # torn record
+
+    store = SegmentStore(str(tmpdir))
+    assert sorted(store.scan()) == [("CN1", "one"), ("CN2", "two")]
+    store.put("CN3", "three")
+    store.close()
+
+    store = SegmentStore(str(tmpdir))
+    assert sorted(store.scan()) == [("CN1", "one"), ("CN2", "two"),
+                                    ("CN3", "three")]
+    store.close()
+    assert len(index.read().splitlines()) == 3
+
+
+def test_segment_store_bad_key(tmpdir):
+    store = SegmentStore(str(tmpdir))
+    for key in ["", "CN 1", "CN1\n"]:
+        with pytest.raises(ValueError):
+            store.put(key, "data")
+    store.close()
+
+
+def test_segment_store_single_writer(tmpdir):
+    store = SegmentStore(str(tmpdir))
+    store.put("x", "one")
+    with pytest.raises(IOError):
+        SegmentStore(str(tmpdir))
+    store.put("y", "two")
+    store.close()
+
+    store = SegmentStore(str(tmpdir))  # unlocked by closing
+    assert store.get("y") == "two"
+    store.close()
+
+
+def test_segment_store_readonly(tmpdir):
+    store = SegmentStore(str(tmpdir))
+    store.put("CN1", "one")
+    store.put("CN2", "two")
+    segment = tmpdir.join("seg-000000")
+    with open(str(segment), 'ab') as f:
+        f.write("\xc5\x00\x00\x03")  # a record being written
+    size = segment.size()
+    index = tmpdir.join("index").read()
+
+    reader = open_store('segment', str(tmpdir), readonly=True)
+    assert sorted(reader.scan()) == [("CN1", "one"), ("CN2", "two")]
+    with pytest.raises(IOError):
+        reader.put("CN3", "three")
+    reader.close()
+    assert segment.size() == size  # not truncated
+    assert tmpdir.join("index").read() == index
+    store.close()
+
+    reader = SegmentStore(str(tmpdir.join("missing")), readonly=True)
+    assert reader.keys() == []
+    reader.close()
+    assert not tmpdir.join("missing").check()
@@ -4,7 +4,14 @@
 Test utils.
 """
 
-from cnsipo.utils import trans_str
+import time
+
+import pytest
+
+from cnsipo.utils import trans_str, JobQueue, AsyncJobQueue, threaded, \
+    percentile, ConcurrencyController, WorkerPool, retry, RetryPolicy, \
+    DelayQueue, CircuitBreaker, ProcessStage, Progress, periodically, \
+    HashRing
 
 
 def test_trans_str():
@@ -15,3 +22,353 @@ def test_trans_str():
 
     assert trans_str("他说：“‘好’极了！”", "“”‘’：！", "\"\"'':!") \
         == "他说:\"'好'极了!\""
+
+
+def test_job_queue():
+    results = []
+    job_queue = JobQueue(4)
+    with threaded(job_queue):
+        for i in range(100):
+            job_queue.add_task(results.append, i)
+    assert sorted(results) == range(100)
+
+
+def test_bounded_job_queue():
+    import threading
+    gate = threading.Event()
+    results = []
+
+    def task(i):
+        gate.wait()
+        results.append(i)
+
+    job_queue = JobQueue(2, capacity=3)
+    job_queue.start()
+    feeder = threading.Thread(
+        target=job_queue.add_tasks, args=(task, ((i,) for i in range(20))))
+    feeder.daemon = True
+    feeder.start()
+    feeder.join(0.5)
+    assert feeder.is_alive()  # blocked by the full queue
+    assert job_queue._queue.qsize() == 3
+    gate.set()
+    feeder.join()
+    job_queue.finish()
+    assert sorted(results) == range(20)
+
+
+def test_async_job_queue():
+    pytest.importorskip("gevent")
+    results = []
+    job_queue = AsyncJobQueue(1000)
+    with threaded(job_queue):
+        for i in range(100):
+            job_queue.add_task(results.append, i)
+    assert sorted(results) == range(100)
+
+
+def test_async_job_queue_concurrency():
+    gevent = pytest.importorskip("gevent")
+    job_queue = AsyncJobQueue(20)
+    start = time.time()
+    with threaded(job_queue):
+        for i in range(20):
+            job_queue.add_task(gevent.sleep, 0.1)
+    assert time.time() - start < 0.5  # overlapped, not 20 x 0.1s
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    values = range(1, 101)
+    assert percentile(values, 0) == 1
+    assert percentile(values, 50) == 51
+    assert percentile(values, 100) == 100
+
+
+def test_concurrency_controller():
+    controller = ConcurrencyController(10, initial=4, window=10)
+    assert controller.limit == 4
+    assert controller.timeout(5) == 5
+
+    def run(latency, failed=False, times=10):
+        for _ in range(times):
+            controller.acquire()
+            controller.release(latency, failed)
+
+    run(0.1)  # healthy: additive increase
+    assert controller.limit == 5
+    assert controller.timeout(5) == 1  # min timeout
+    run(0.1, times=100)
+    assert controller.limit == 10  # capped
+    run(0.1, failed=True)  # errors: multiplicative decrease
+    assert controller.limit == 5
+    run(1.0)  # slow: multiplicative decrease
+    assert controller.limit == 2
+    assert controller.timeout(5) == 3.0
+    for _ in range(10):
+        controller.record_error()
+    assert controller.limit == 1
+
+
+def test_worker_pool():
+    pool = WorkerPool(3)
+
+    def task(i):
+        if i % 10 == 0:
+            raise ValueError(i)
+        if i == 5:
+            raise SystemExit  # kills the worker
+        return i * 2
+
+    with threaded(pool):
+        futures = [pool.submit(task, i) for i in range(50)]
+    assert [f.result() for f in futures if f.key is None and
+            not f.exception()][:3] == [2, 4, 6]
+    assert isinstance(futures[10].exception(), ValueError)
+    stats = pool.stats()
+    assert stats['succeeded'] == 44
+    assert stats['failed'] == 6
+    assert stats['healed'] == 1
+    assert stats['workers'] == 3
+    assert stats['in_flight'] == 0
+
+
+def test_worker_pool_retried():
+    pool = WorkerPool(2)
+    calls = []
+
+    @retry(ValueError, tries=3, delay=0, counters=pool.counters)
+    def flaky(i):
+        calls.append(i)
+        if calls.count(i) < 2:
+            raise ValueError(i)
+
+    with threaded(pool):
+        pool.add_tasks(flaky, ((i,) for i in range(5)))
+    assert pool.stats()['retried'] == 5
+    assert pool.stats()['succeeded'] == 5
+
+
+def test_worker_pool_shutdown():
+    import threading
+    gate = threading.Event()
+    cancelled = []
+    pool = WorkerPool(2, on_cancel=lambda f: cancelled.append(f.key))
+    pool.start()
+    for _ in range(2):
+        pool.submit(gate.wait)
+    while pool.stats()['in_flight'] < 2:
+        time.sleep(0.01)
+    futures = [pool.submit_keyed(i, lambda: None) for i in range(5)]
+    pool.shutdown(drain=False)
+    assert pool.submit(lambda: None).cancelled()
+    gate.set()
+    pool.finish()
+    assert cancelled == range(5)
+    assert all(f.cancelled() for f in futures)
+    assert pool.stats()['cancelled'] == 5
+
+
+def test_worker_pool_shutdown_unread():
+    cancelled = []
+    pool = WorkerPool(2, capacity=1,
+                      on_cancel=lambda f: cancelled.append(f.key))
+
+    def task(i):
+        if i == 3:
+            pool.shutdown(drain=False)
+
+    with threaded(pool):
+        pool.add_tasks(task, ((i,) for i in range(10)), key=lambda a: a[0])
+    # the queued tasks and the rest of the input are checkpointed
+    assert sorted(cancelled)[-1] == 9
+    assert len(cancelled) == pool.stats()['cancelled']
+    assert pool.stats()['succeeded'] + len(cancelled) == 10
+
+
+def test_worker_pool_coalesced():
+    import threading
+    gate = threading.Event()
+    calls = []
+
+    def task(key):
+        calls.append(key)
+        gate.wait()
+        return key
+
+    pool = WorkerPool(2)
+    with threaded(pool):
+        first = pool.submit_keyed("CN1", task, "CN1")
+        assert pool.submit_keyed("CN1", task, "CN1") is first
+        other = pool.submit_keyed("CN2", task, "CN2")
+        assert other is not first
+        gate.set()
+        assert first.result() == "CN1"
+        again = pool.submit_keyed("CN1", task, "CN1")
+        assert again is not first
+    assert again.result() == "CN1"
+    assert sorted(calls) == ["CN1", "CN1", "CN2"]
+    assert pool.counters.get('coalesced') == 1
+
+
+def test_retry_policy():
+    policy = RetryPolicy(ValueError, tries=3, delay=1, backoff=2,
+                         max_delay=3)
+    assert policy.forgivable(ValueError())
+    assert not policy.forgivable(KeyError())
+    assert [policy.next_delay(i) for i in range(1, 4)] == [1, 2, 3]
+    policy.jitter = 0.5
+    assert all(0.5 <= policy.next_delay(1) <= 1.5 for _ in range(100))
+
+
+def test_delay_queue():
+    queue = DelayQueue()
+    queue.put('c', 0.2)
+    queue.put('a', 0)
+    queue.put('b', 0.1)
+    start = time.time()
+    assert [queue.get() for _ in range(3)] == ['a', 'b', 'c']
+    assert time.time() - start >= 0.2
+    queue.put('d', 10)
+    assert queue.clear() == ['d'] and len(queue) == 0
+
+
+def test_worker_pool_deferred_retry():
+    dead = []
+    calls = {}
+
+    def flaky(i):
+        calls[i] = calls.get(i, 0) + 1
+        if i % 2 and calls[i] < 3 or i == 4:
+            raise ValueError(i)
+        return i
+
+    pool = WorkerPool(2, on_dead=lambda f, e: dead.append(f.key),
+                      retry_policy=RetryPolicy(ValueError, tries=3,
+                                               delay=0.01))
+    with threaded(pool):
+        futures = [pool.submit_keyed(i, flaky, i) for i in range(6)]
+    assert [f.result() for f in futures if not f.exception()] \
+        == [0, 1, 2, 3, 5]
+    assert dead == [4]
+    assert calls == {0: 1, 1: 3, 2: 1, 3: 3, 4: 3, 5: 3}
+    stats = pool.stats()
+    assert stats['retried'] == 8
+    assert stats['dead'] == 1
+    assert stats['failed'] == 1
+    assert stats['delayed'] == 0
+
+    # retry in place without threads
+    pool = WorkerPool(1, retry_policy=RetryPolicy(ValueError, tries=3,
+                                                  delay=0.01))
+    calls.clear()
+    assert pool.submit(flaky, 1).result() == 1
+    assert calls == {1: 3}
+
+
+def test_circuit_breaker():
+    import threading
+    breaker = CircuitBreaker(3, cooldown=0.1, max_cooldown=0.15)
+    for _ in range(2):
+        breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED
+    for _ in range(2):
+        breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    start = time.time()
+    breaker.wait()  # the probe
+    assert time.time() - start >= 0.1
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    waiter = threading.Thread(target=breaker.wait)
+    waiter.start()
+    waiter.join(0.05)
+    assert waiter.is_alive()  # blocked during probing
+    breaker.record(False)  # failed probe
+    assert breaker.state == CircuitBreaker.OPEN
+    waiter.join(2)  # the waiter becomes the next probe
+    assert not waiter.is_alive()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    disabled = CircuitBreaker()
+    for _ in range(100):
+        disabled.record(False)
+    disabled.wait()
+
+
+def test_retry_with_breaker():
+    breaker = CircuitBreaker(2, cooldown=0.05)
+    calls = []
+
+    @retry(ValueError, tries=5, delay=0, breaker=breaker)
+    def flaky():
+        calls.append(breaker.state)
+        if len(calls) < 3:
+            raise ValueError()
+
+    flaky()
+    assert calls == [CircuitBreaker.CLOSED, CircuitBreaker.CLOSED,
+                     CircuitBreaker.HALF_OPEN]
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def square(x):
+    return x * x
+
+
+def test_process_stage():
+    results = []
+
+    def on_result(result):
+        results.append(result)
+        if result == 4:
+            raise ValueError("bad callback")
+
+    stage = ProcessStage(square, processes=2, capacity=3)
+    for i in range(20):
+        stage.submit((i,), on_result)
+    assert stage.call((7,)) == 49
+    stage.close()
+    assert sorted(results) == [i * i for i in range(20)]
+
+
+def test_progress():
+    progress = Progress()
+    progress.add("fmgb-2014", 3)
+    progress.add("fmgb-2013", 2)
+    job_queue = JobQueue(4)
+    with threaded(job_queue):
+        for _ in range(3):
+            job_queue.add_task(progress.incr, "fmgb-2014")
+    assert progress.snapshot() == [("fmgb-2014", 3, 3), ("fmgb-2013", 0, 2)]
+    assert str(progress) == "fmgb-2014: 3/3, fmgb-2013: 0/2"
+
+
+def test_periodically():
+    calls = []
+    with periodically(lambda: calls.append(1), 0.01):
+        time.sleep(0.1)
+    n = len(calls)
+    assert n >= 3
+    time.sleep(0.05)
+    assert len(calls) == n
+
+
+def test_hash_ring():
+    keys = ["CN{}".format(i) for i in range(20000)]
+    ring = HashRing(range(4))
+    nodes = [ring.node_of(k) for k in keys]
+    for node in range(4):
+        assert 4000 < nodes.count(node) < 6000
+    same_ring = HashRing(range(4))
+    assert nodes == [same_ring.node_of(k) for k in keys]
+
+    # only the keys of the new node move
+    ring5 = HashRing(range(5))
+    moved = [k for k, n in zip(keys, nodes) if ring5.node_of(k) != n]
+    assert all(ring5.node_of(k) == 4 for k in moved)
+    assert len(moved) < len(keys) * 0.3